@@ -0,0 +1,217 @@
+import os
+import json
+import uuid
+import threading
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor, Future
+from backup import copy_file, reflink_file, DEFAULT_WORKERS
+from duplicates import full_hash
+from progress import start, check
+from metrics import registry as metrics
+
+
+class BackupRepository:
+    """Deduplicating backup store: file content is kept once per hash and each backup is a small snapshot index.
+
+    Layout: `objects/<2 hex>/<digest>` holds content, `snapshots/<id>.json` lists (path, size, mtime, digest).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # digest -> Future of the copy storing it, resolved once the object is in place.
+        self._stored = {}
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _store_object(self, src, digest):
+        """Copy `src` into the store under `digest` unless it is already there. Returns bytes written.
+
+        Several workers may hash identical files at once; only the first one copies, and the others wait for
+        that copy. If it fails, the digest is released and a waiting worker copies its own file instead.
+        """
+        while True:
+            with self._lock:
+                future = self._stored.get(digest)
+                owner = future is None
+                if owner:
+                    future = self._stored[digest] = Future()
+            if owner:
+                break
+            try:
+                future.result()
+                return 0
+            except Exception:
+                continue
+        try:
+            written = self._write_object(src, digest)
+        except BaseException as e:
+            with self._lock:
+                del self._stored[digest]
+            future.set_exception(e)
+            raise
+        future.set_result(written)
+        return written
+
+    def _write_object(self, src, digest):
+        dst = self.object_path(digest)
+        if os.path.exists(dst):
+            return 0
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # Write under a unique temporary name so a crash never leaves a truncated object behind.
+        tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+        try:
+            try:
+                reflink_file(src, tmp)
+            except OSError:
+                copy_file(src, tmp)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return os.path.getsize(dst)
+
+    def backup(self, snapshot, catalog=None, max_workers=DEFAULT_WORKERS, progress=None):
+        """Store a FolderSnapshot's files and record a snapshot index. Returns (snapshot_id, stats)."""
+        files = snapshot.files()
+        if catalog:
+            catalog.sync(snapshot)
+        cached = catalog.lookup(files) if catalog else {}
+        stats = {"files": len(files), "new_objects": 0, "bytes": 0}
+        new_hashes = {}
+
+        def work(entry):
+            check(progress)
+            row = cached.get(os.path.abspath(entry.path))
+            digest = row["full_hash"] if row and row["full_hash"] else None
+            fresh = digest is None
+            if fresh:
+                digest = full_hash(entry.path)
+            return entry, digest, fresh, self._store_object(entry.path, digest)
+
+        index = []
+        start(progress, "backup", len(files), sum(e.size for e in files))
+        with metrics.span("copy"):
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for entry, digest, fresh, written in pool.map(work, files):
+                    index.append([entry.rel_path, entry.size, entry.mtime, digest])
+                    if fresh:
+                        new_hashes[entry.path] = digest
+                    if written:
+                        stats["new_objects"] += 1
+                        stats["bytes"] += written
+                    if progress:
+                        progress.advance(1, entry.size)
+        metrics.count("files_copied", stats["new_objects"])
+        metrics.count("bytes_copied", stats["bytes"])
+        if catalog:
+            catalog.store_hashes(full=new_hashes)
+
+        created = datetime.datetime.now()
+        snapshot_id = f"{created.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:6]}"
+        record = {"id": snapshot_id, "created": created.isoformat(timespec="seconds"),
+                  "source": os.path.abspath(snapshot.folder_path), "files": index}
+        tmp = os.path.join(self.snapshots_dir, f"{snapshot_id}.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, os.path.join(self.snapshots_dir, f"{snapshot_id}.json"))
+        logging.info("Repository snapshot %s: %s files, %s new objects", snapshot_id, stats["files"],
+                     stats["new_objects"])
+        return snapshot_id, stats
+
+    def load_snapshot(self, snapshot_id):
+        with open(os.path.join(self.snapshots_dir, f"{snapshot_id}.json"), "r") as f:
+            return json.load(f)
+
+    def list_snapshots(self):
+        """Return snapshot summaries (id, created, source, files), oldest first."""
+        result = []
+        for name in sorted(os.listdir(self.snapshots_dir)):
+            if name.endswith(".json"):
+                record = self.load_snapshot(name[:-5])
+                result.append({"id": record["id"], "created": record["created"], "source": record["source"],
+                               "files": len(record["files"])})
+        return result
+
+    def prune(self, keep_last=None, keep_daily=None, keep_weekly=None):
+        """Delete snapshots outside the retention policy (applied per source folder). Returns the removed ids.
+
+        Keeps the newest `keep_last` snapshots plus the newest snapshot of each of the last `keep_daily`
+        days and `keep_weekly` ISO weeks. With no policy given nothing is removed.
+        """
+        if keep_last is None and keep_daily is None and keep_weekly is None:
+            return []
+        by_source = {}
+        for snap in self.list_snapshots():
+            by_source.setdefault(snap["source"], []).append(snap)
+        removed = []
+        for snaps in by_source.values():
+            snaps.sort(key=lambda s: s["id"], reverse=True)
+            keep = {s["id"] for s in snaps[:keep_last or 0]}
+            for count, period in ((keep_daily, lambda d: d.date()),
+                                  (keep_weekly, lambda d: d.isocalendar()[:2])):
+                seen = set()
+                for snap in snaps:
+                    key = period(datetime.datetime.fromisoformat(snap["created"]))
+                    if count and key not in seen and len(seen) < count:
+                        seen.add(key)
+                        keep.add(snap["id"])
+            for snap in snaps:
+                if snap["id"] not in keep:
+                    os.remove(os.path.join(self.snapshots_dir, f"{snap['id']}.json"))
+                    removed.append(snap["id"])
+        logging.info("Pruned %s repository snapshots", len(removed))
+        return removed
+
+    def gc(self):
+        """Delete objects no snapshot refers to. Returns (objects removed, bytes freed)."""
+        referenced = set()
+        for name in os.listdir(self.snapshots_dir):
+            if name.endswith(".json"):
+                referenced.update(f[3] for f in self.load_snapshot(name[:-5])["files"])
+        removed = freed = 0
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            with os.scandir(prefix_dir) as it:
+                for entry in it:
+                    if entry.name not in referenced:
+                        freed += entry.stat().st_size
+                        os.remove(entry.path)
+                        removed += 1
+        logging.info("Repository gc: %s objects removed, %s bytes freed", removed, freed)
+        return removed, freed
+
+    def restore(self, snapshot_id, dest, path=None, max_workers=DEFAULT_WORKERS, progress=None):
+        """Restore a snapshot (or only the file at relative `path`) under `dest`. Returns the files restored.
+
+        Objects are reflinked where the filesystem supports it and copied otherwise; mtimes are restored.
+        """
+        files = self.load_snapshot(snapshot_id)["files"]
+        if path is not None:
+            files = [f for f in files if os.path.normcase(f[0]) == os.path.normcase(path)]
+
+        def work(item):
+            check(progress)
+            rel_path, size, mtime, digest = item
+            dst = os.path.join(dest, rel_path)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            try:
+                reflink_file(self.object_path(digest), dst)
+            except OSError:
+                copy_file(self.object_path(digest), dst)
+            os.utime(dst, (mtime, mtime))
+            return size
+
+        start(progress, "restore", len(files), sum(f[1] for f in files))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for size in pool.map(work, files):
+                if progress:
+                    progress.advance(1, size)
+        logging.info("Restored %s files from snapshot %s to %s", len(files), snapshot_id, dest)
+        return len(files)
@@ -0,0 +1,162 @@
+import os
+import time
+import logging
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from scanner import BACKUP_DIR_PREFIX, JOURNAL_DIR
+from journal import Journal
+from sinks import ListSink, error
+from utils import setup_logging, worker_log_queue
+from metrics import registry as metrics
+
+# Folders on one disk processed at the same time; more mostly adds seeks.
+DEFAULT_PER_DEVICE = 2
+# Commands that move files and leave a journal operation behind.
+JOURNALED_COMMANDS = ("rename", "organize")
+# Commands that read or fill the shared file catalog.
+CATALOG_COMMANDS = ("dupes", "backup", "report")
+
+# Outcome of one folder: its records, error count, wall time, the journal operation it created (or None) and
+# the worker's raw metrics when they are being collected (see metrics.Metrics.raw).
+FolderResult = namedtuple("FolderResult", ["folder", "records", "errors", "elapsed", "operation", "metrics"],
+                          defaults=(None,))
+
+
+def subfolders(root):
+    """Immediate subfolders of `root`, sorted, skipping backup and journal folders."""
+    try:
+        with os.scandir(root) as it:
+            names = [e.name for e in it if e.is_dir(follow_symlinks=False)
+                     and not e.name.startswith(BACKUP_DIR_PREFIX) and e.name != JOURNAL_DIR]
+    except OSError as e:
+        logging.error("Error listing %s: %s", root, e)
+        return []
+    return [os.path.join(root, name) for name in sorted(names)]
+
+
+def device_of(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def _last_operation(folder_path):
+    stack = Journal(folder_path).undo_stack()
+    return stack[-1]["id"] if stack else None
+
+
+_catalog = None
+
+
+def _worker_catalog(command):
+    # Each worker process opens the shared SQLite catalog once; WAL mode lets them write concurrently.
+    global _catalog
+    if _catalog is None and command in CATALOG_COMMANDS:
+        from catalog import open_catalog
+        _catalog = open_catalog()
+    return _catalog
+
+
+def metrics_requested(args):
+    return bool(getattr(args, "metrics_json", None) or getattr(args, "metrics_prom", None))
+
+
+def run_folder(args, folder_path):
+    """Run the parsed subcommand `args` on one folder and collect its output. Runs inside pool workers."""
+    from cli import run_command
+    sink = ListSink()
+    started = time.perf_counter()
+    operation = None
+    collect = metrics_requested(args)
+    if collect:
+        metrics.enabled = True
+        metrics.reset()
+    if not os.path.isdir(folder_path):
+        sink.emit(error(f"Not a folder: {folder_path}\n"))
+    else:
+        journaled = args.command in JOURNALED_COMMANDS
+        before = _last_operation(folder_path) if journaled else None
+        try:
+            run_command(args, folder_path, sink, catalog=_worker_catalog(args.command))
+        except Exception as e:
+            sink.emit(error(f"Error processing {folder_path}: {str(e)}\n"))
+            logging.error("Error in run_folder: %s", e)
+        if journaled:
+            after = _last_operation(folder_path)
+            operation = after if after != before else None
+    raw = None
+    if collect:
+        raw = metrics.raw()
+        # The parent counts skips and errors itself when it re-emits these records.
+        for key in [k for k in raw["counters"] if k[0] in ("skips", "errors")]:
+            del raw["counters"][key]
+    return FolderResult(folder_path, sink.records, sink.errors, time.perf_counter() - started, operation, raw)
+
+
+def _failed(folder_path, started, exc):
+    # The worker died or its result could not be sent back; the folder gets an error instead of a result.
+    logging.error("Error in run_batch for %s: %s", folder_path, exc)
+    return FolderResult(folder_path, [error(f"Error processing {folder_path}: worker failed: {exc!r}\n")], 1,
+                        time.perf_counter() - started, None)
+
+
+def run_batch(args, folders, max_workers=None, per_device=DEFAULT_PER_DEVICE, progress=None):
+    """Run a subcommand over many folders on a process pool. Yields FolderResults as folders finish.
+
+    At most `max_workers` folders run at once (default: CPU count), and at most `per_device` of them on any
+    one filesystem device, so several disks are kept busy without thrashing any single one. A folder whose
+    worker fails gets an error result; if a worker process dies, the folders running with it get one too and
+    the rest continue on a new pool.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    queues = {}
+    for folder_path in folders:
+        queues.setdefault(device_of(folder_path), deque()).append(folder_path)
+    total = sum(len(q) for q in queues.values())
+    if progress is not None:
+        progress.start("folders", total)
+    active = {dev: 0 for dev in queues}
+    # future -> (device, folder, submit time)
+    running = {}
+    with worker_log_queue() as log_queue:
+        def new_pool():
+            return ProcessPoolExecutor(max_workers=max_workers, initializer=setup_logging, initargs=(log_queue,))
+        pool = new_pool()
+        try:
+            while queues or running:
+                # Round-robin over devices so one large disk cannot take every worker.
+                submitted = True
+                while submitted and len(running) < max_workers:
+                    submitted = False
+                    for dev in list(queues):
+                        if len(running) >= max_workers:
+                            break
+                        if active[dev] < per_device:
+                            folder_path = queues[dev].popleft()
+                            if not queues[dev]:
+                                del queues[dev]
+                            try:
+                                future = pool.submit(run_folder, args, folder_path)
+                            except BrokenProcessPool:
+                                # The folders still running on the broken pool fail below; new ones get a new pool.
+                                pool.shutdown(wait=False)
+                                pool = new_pool()
+                                future = pool.submit(run_folder, args, folder_path)
+                            running[future] = (dev, folder_path, time.perf_counter())
+                            active[dev] += 1
+                            submitted = True
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dev, folder_path, started = running.pop(future)
+                    active[dev] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = _failed(folder_path, started, e)
+                    yield result
+                    if progress is not None:
+                        progress.advance()
+        finally:
+            pool.shutdown()
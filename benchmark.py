@@ -0,0 +1,254 @@
+"""Benchmark the file operations on a generated library.
+
+    python3 benchmark.py --files 10000 --out bench.json [--baseline previous.json]
+
+A synthetic tree of course folders is generated in a temporary directory (or --root), then each entry point
+is timed on it. Results are written as JSON; with --baseline, operations that got slower are reported.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from scanner import scan_folder
+from catalog import FileCatalog
+from sinks import NullSink
+from utils import setup_logging
+from file_ops import (detect_content_duplicates, preview_changes, replace_text_in_filenames, undo_last_action,
+                      organize_by_timestamp, backup_files)
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then reported as None.
+    resource = None
+
+EXTENSION_WEIGHTS = {".mp4": 50, ".pdf": 20, ".mkv": 10, ".txt": 8, ".srt": 6, ".avi": 3, ".mov": 3}
+TOPICS = ("Intro", "Setup", "Models", "Views", "Routing", "Testing", "Deploy", "Security", "Caching", "Review")
+# os functions counted during each operation; `open` is counted as well.
+COUNTED_CALLS = ("stat", "lstat", "scandir", "listdir", "rename", "replace", "remove", "makedirs", "mkdir",
+                 "link", "utime", "fsync", "copy_file_range")
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+SPARSE_SIZES = (64 * 1024 * 1024, 1024 * 1024 * 1024)
+# Files at least this large are sparse: listed at full size but left out of the bytes-read totals.
+SPARSE_MIN = SPARSE_SIZES[0]
+
+
+def _file_size(rng, sparse_ratio):
+    if rng.random() < sparse_ratio:
+        # Real videos almost never share an exact size, so these stay out of the duplicate candidates.
+        return rng.randint(*SPARSE_SIZES)
+    # Log-normal sizes, mostly a few KB, so large libraries stay cheap to generate.
+    return min(int(rng.lognormvariate(8, 1.2)), 4 * 1024 * 1024)
+
+
+def generate_library(root, files=10000, files_per_folder=100, duplicate_ratio=0.05, sparse_ratio=0.01, seed=0):
+    """Create a tree of course/section folders with `files` lesson files under `root`. Returns the leaf folders.
+
+    Names mimic real downloads (numbered lessons, part numbers, resolution tags), a share of files are
+    byte-identical copies of earlier ones, and a few are large sparse files that take no disk space.
+    """
+    rng = random.Random(seed)
+    extensions = list(EXTENSION_WEIGHTS)
+    weights = list(EXTENSION_WEIGHTS.values())
+    folders = []
+    created = []
+    for index in range(files):
+        if index % files_per_folder == 0:
+            folder_no = index // files_per_folder
+            course = f"{folder_no // 10 + 1}-{rng.choice(TOPICS)} Course {folder_no // 10 + 1}h"
+            folder = os.path.join(root, course, f"Section {folder_no % 10 + 1:02d}")
+            os.makedirs(folder, exist_ok=True)
+            folders.append(folder)
+        lesson = index % files_per_folder + 1
+        ext = rng.choices(extensions, weights)[0]
+        tag = rng.choice(("", " [720p]", " [1080p]", " (1)", ""))
+        path = os.path.join(folders[-1], f"{lesson:03d} - {rng.choice(TOPICS)} part{rng.randint(1, 9)}{tag}{ext}")
+        if created and rng.random() < duplicate_ratio:
+            shutil.copyfile(rng.choice(created), path)
+            continue
+        size = _file_size(rng, sparse_ratio)
+        with open(path, "wb") as f:
+            if size >= SPARSE_MIN:
+                f.truncate(size)
+                continue
+            f.write(rng.randbytes(size) if hasattr(rng, "randbytes") else os.urandom(size))
+        created.append(path)
+    return folders
+
+
+def process_peak_rss_kb():
+    """Highest RSS of this process since it started, in KB. It never goes down, so per operation it is cumulative:
+    an operation only shows up when it pushes the peak above every earlier one."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _proc_io():
+    """Read/write syscall counters from /proc/self/io (Linux only), or None."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read": int(fields["syscr"]), "write": int(fields["syscw"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+@contextmanager
+def count_os_calls():
+    """Count calls to common filesystem functions in the os module (and open) while the block runs."""
+    counts = Counter()
+    lock = threading.Lock()
+    originals = {}
+
+    def wrap(name, func):
+        def counted(*args, **kwargs):
+            with lock:
+                counts[name] += 1
+            return func(*args, **kwargs)
+        return counted
+
+    import builtins
+    for name in COUNTED_CALLS:
+        if hasattr(os, name):
+            originals[(os, name)] = getattr(os, name)
+            setattr(os, name, wrap(name, originals[(os, name)]))
+    originals[(builtins, "open")] = builtins.open
+    builtins.open = wrap("open", builtins.open)
+    io_before = _proc_io()
+    try:
+        yield counts
+    finally:
+        for (module, name), func in originals.items():
+            setattr(module, name, func)
+        io_after = _proc_io()
+        if io_before and io_after:
+            counts["read_syscalls"] = io_after["read"] - io_before["read"]
+            counts["write_syscalls"] = io_after["write"] - io_before["write"]
+
+
+def _measure(name, func, files, total_bytes):
+    with count_os_calls() as counts:
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+    return {"op": name, "seconds": round(elapsed, 4), "files": files,
+            "files_per_sec": round(files / elapsed, 1) if elapsed else None,
+            "mb_per_sec": round(total_bytes / elapsed / 1e6, 1) if elapsed and total_bytes else None,
+            "process_peak_rss_kb": process_peak_rss_kb(), "syscalls": dict(counts)}
+
+
+def run_benchmarks(root, folders, backup_mode="hardlink"):
+    """Time each operation over the generated folders and return a list of result dicts."""
+    snapshot = scan_folder(root, recursive=True)
+    files = snapshot.files()
+    count = len(files)
+    data_bytes = sum(e.size for e in files if e.size < SPARSE_MIN)
+    sink = NullSink()
+    catalog = FileCatalog(os.path.join(root, "bench_catalog.db"))
+    patterns = [r"part\d", r"\[\d+p\]"]
+
+    def each(func):
+        return lambda: [func(folder) for folder in folders]
+
+    def preview(folder):
+        return preview_changes(folder, patterns, "", remove_mode=True, sink=sink)
+
+    def rename(folder):
+        replace_text_in_filenames(folder, patterns, "", preview(folder), sink=sink)
+
+    steps = [
+        ("scan", lambda: scan_folder(root, recursive=True), 0),
+        ("dupes_cold", each(lambda f: detect_content_duplicates(f, catalog=catalog, sink=sink)), data_bytes),
+        ("dupes_warm", each(lambda f: detect_content_duplicates(f, catalog=catalog, sink=sink)), 0),
+        ("preview", each(preview), 0),
+        ("rename", each(rename), 0),
+        ("undo_rename", each(lambda f: undo_last_action(f, sink=sink)), 0),
+        ("organize", each(lambda f: organize_by_timestamp(f, sink=sink, bucket_key="extension")), 0),
+        ("undo_organize", each(lambda f: undo_last_action(f, sink=sink)), 0),
+        # Hardlink and reflink backups copy no data, so MB/s is only reported for copies; files/s covers all modes.
+        ("backup", each(lambda f: backup_files(f, mode=backup_mode, sink=sink)),
+         data_bytes if backup_mode == "copy" else 0),
+    ]
+    try:
+        return [_measure(name, func, count, nbytes) for name, func, nbytes in steps]
+    finally:
+        catalog.close()
+
+
+def compare(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Return (op, old seconds, new seconds) for operations more than `threshold` slower than the baseline."""
+    old = {r["op"]: r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = old.get(result["op"])
+        if before and before["seconds"] and result["seconds"] > before["seconds"] * (1 + threshold):
+            regressions.append((result["op"], before["seconds"], result["seconds"]))
+    return regressions
+
+
+def benchmark(files=10000, root=None, seed=0, backup_mode="hardlink", files_per_folder=100):
+    """Generate a library, run every benchmark and return the report dict."""
+    tmp = None
+    if root is None:
+        tmp = root = tempfile.mkdtemp(prefix="pfm-bench-")
+    try:
+        started = time.perf_counter()
+        folders = generate_library(root, files, files_per_folder=files_per_folder, seed=seed)
+        generated = time.perf_counter() - started
+        results = run_benchmarks(root, folders, backup_mode)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return {"meta": {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+                     "python": platform.python_version(), "platform": platform.platform(),
+                     "cpus": os.cpu_count(), "files": files, "folders": len(folders), "seed": seed,
+                     "backup_mode": backup_mode, "generate_seconds": round(generated, 2)},
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark file operations on a synthetic library.")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--files-per-folder", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--root", help="generate the library here and keep it (must be empty or missing)")
+    parser.add_argument("--backup-mode", default="hardlink", choices=("copy", "hardlink", "reflink"))
+    parser.add_argument("--out", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+    if args.root and os.path.exists(args.root) and os.listdir(args.root):
+        parser.error("--root must be empty or missing")
+    # Log like a normal run, so logging overhead is part of the measurement.
+    setup_logging()
+    report = benchmark(args.files, args.root, args.seed, args.backup_mode, args.files_per_folder)
+    for r in report["results"]:
+        calls = sum(v for k, v in r["syscalls"].items() if not k.endswith("_syscalls"))
+        print(f"{r['op']:<14} {r['seconds']:>9.3f}s {r['files_per_sec'] or 0:>12.0f} files/s  "
+              f"process peak rss {r['process_peak_rss_kb']} KB  calls {calls}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for op, before, after in regressions:
+            print(f"REGRESSION {op}: {before:.3f}s -> {after:.3f}s")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import os
+import json
+import sqlite3
+import threading
+import logging
+from utils import CONFIG_FILE
+
+# The catalog lives next to config.json so the CLI and GUI share it.
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), "file_catalog.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    ino INTEGER NOT NULL,
+    ctime REAL NOT NULL,
+    partial_hash TEXT,
+    full_hash TEXT,
+    meta TEXT
+)
+"""
+
+# SQLite's default limit on bound parameters is 999 on older builds.
+_BATCH = 500
+
+
+def _key(entry):
+    return (entry.size, entry.mtime, entry.ino)
+
+
+class FileCatalog:
+    """Persistent per-file cache keyed by path plus (size, mtime, inode)."""
+
+    def __init__(self, db_path=CATALOG_FILE):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, entries):
+        """Return {path: row} for entries whose cached key still matches; stale rows are left out."""
+        wanted = {os.path.abspath(e.path): e for e in entries if not e.is_dir}
+        paths = list(wanted)
+        rows = {}
+        with self._lock:
+            for i in range(0, len(paths), _BATCH):
+                chunk = paths[i:i + _BATCH]
+                query = ("SELECT path, size, mtime, ino, partial_hash, full_hash, meta FROM files "
+                         f"WHERE path IN ({','.join('?' * len(chunk))})")
+                for path, size, mtime, ino, partial, full, meta in self._conn.execute(query, chunk):
+                    if (size, mtime, ino) == _key(wanted[path]):
+                        rows[path] = {"partial_hash": partial, "full_hash": full,
+                                      "meta": json.loads(meta) if meta else None}
+        return rows
+
+    def sync(self, snapshot):
+        """Record a snapshot's stat data and return the file entries that are new or changed since the last sync."""
+        files = snapshot.files()
+        fresh = self.lookup(files)
+        changed = [e for e in files if os.path.abspath(e.path) not in fresh]
+        if changed:
+            with self._lock:
+                # A changed key invalidates everything derived from the old content.
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO files (path, size, mtime, ino, ctime) VALUES (?, ?, ?, ?, ?)",
+                    [(os.path.abspath(e.path), e.size, e.mtime, e.ino, e.ctime) for e in changed])
+                self._conn.commit()
+        removed = self.prune(snapshot)
+        logging.info("Catalog sync: %s of %s files changed, %s removed", len(changed), len(files), removed)
+        return changed
+
+    def _update(self, column, values):
+        with self._lock:
+            self._conn.executemany(f"UPDATE files SET {column} = ? WHERE path = ?",
+                                   [(v, os.path.abspath(p)) for p, v in values.items()])
+            self._conn.commit()
+
+    def store_hashes(self, partial=None, full=None):
+        """Save {path: digest} maps of partial and full content hashes."""
+        if partial:
+            self._update("partial_hash", partial)
+        if full:
+            self._update("full_hash", full)
+
+    def store_meta(self, metadata):
+        """Save {path: dict} of derived metadata."""
+        if metadata:
+            self._update("meta", {p: json.dumps(m) for p, m in metadata.items()})
+
+    def prune(self, snapshot):
+        """Drop catalog rows for files that disappeared from a snapshot's folder."""
+        root = os.path.join(os.path.abspath(snapshot.folder_path), "")
+        present = {os.path.abspath(e.path) for e in snapshot.files()}
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(root), root))
+            gone = [(p,) for (p,) in rows
+                    if p not in present and (snapshot.recursive or os.sep not in p[len(root):])]
+            self._conn.executemany("DELETE FROM files WHERE path = ?", gone)
+            self._conn.commit()
+        return len(gone)
+
+
+def open_catalog(db_path=CATALOG_FILE):
+    """Open the shared catalog, or return None if it cannot be opened (e.g. read-only install directory)."""
+    try:
+        return FileCatalog(db_path)
+    except sqlite3.Error as e:
+        logging.error("Error opening catalog: %s", e)
+        return None
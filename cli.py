@@ -1,9 +1,27 @@
 import platform
 import os
-from utils import load_config, save_config
+import sys
+import time
+import argparse
+from utils import load_config, save_config, get_setting, save_setting
+from duplicates import format_size
+from scanner import scan_folder
+from catalog import open_catalog
+from progress import ProgressReporter, TerminalProgress
+from backup_repo import BackupRepository
+from organizer import DEFAULT_BUCKET_KEY, ORGANIZE_KEYS
+from backup import BACKUP_MODES
+from rules import RenamePipeline
+from plans import PlanWriter
+from sinks import ConsoleSink, JsonLinesSink, error
+from fuzzy import DEFAULT_THRESHOLD
+from watcher import FolderWatcher, apply_rules, DEFAULT_SETTLE, DEFAULT_POLL_INTERVAL
+from batch_runner import run_batch, subfolders, metrics_requested, DEFAULT_PER_DEVICE, CATALOG_COMMANDS
+import metrics
 from file_ops import (
-    get_video_titles, backup_files, detect_duplicates, validate_regex,
-    preview_changes, replace_text_in_filenames, organize_by_timestamp, undo_last_action
+    get_video_titles, backup_files, detect_duplicates, detect_content_duplicates, validate_regex,
+    preview_changes, replace_text_in_filenames, organize_by_timestamp, undo_last_action, redo_last_action,
+    media_report, detect_fuzzy_duplicates, apply_plan_file
 )
 
 def print_welcome_note():
@@ -59,6 +77,45 @@ def navigate_directory():
         else:
             print("\nInvalid choice! Please select 1-5.")
 
+def _ask_int(prompt):
+    value = input(prompt).strip()
+    return int(value) if value.isdigit() else None
+
+def manage_repository(folder_path):
+    repository = get_setting("backup_repository")
+    if not repository:
+        repository = input("Enter a backup repository path (outside the managed folder): ").strip()
+        if not repository:
+            return
+        save_setting("backup_repository", repository)
+        print(f"\nBackups will now be stored in: {repository}")
+    repo = BackupRepository(repository)
+    print("\n **Repository Options:**\n1. List snapshots\n2. Restore a snapshot\n3. Restore a single file\n4. Prune old snapshots\n")
+    choice = input("Choose an option (1-4): ").strip()
+    if choice == "1":
+        snapshots = repo.list_snapshots()
+        if snapshots:
+            print("\n" + "\n".join(f"{s['id']}  {s['files']} files  {s['source']}" for s in snapshots))
+        else:
+            print("\nNo snapshots in repository.")
+    elif choice in ["2", "3"]:
+        snapshot_id = input("Enter snapshot id: ").strip()
+        path = input("Enter the file path relative to the folder: ").strip() if choice == "3" else None
+        dest = input(f"Restore into (default: {folder_path}): ").strip() or folder_path
+        try:
+            count = repo.restore(snapshot_id, dest, path, progress=ProgressReporter(TerminalProgress()))
+            print(f"\nRestored {count} files into: {dest}")
+        except OSError as e:
+            print(f"Error restoring snapshot: {str(e)}")
+    elif choice == "4":
+        removed = repo.prune(keep_last=_ask_int("Keep last N snapshots: "),
+                             keep_daily=_ask_int("Keep daily snapshots for N days: "),
+                             keep_weekly=_ask_int("Keep weekly snapshots for N weeks: "))
+        objects, freed = repo.gc()
+        print(f"\nRemoved {len(removed)} snapshots and {objects} unreferenced objects ({format_size(freed)} freed).")
+    else:
+        print("\nInvalid choice!")
+
 def cli_main():
     print_welcome_note()
     print("\n **Choose Directory Method:**")
@@ -76,27 +133,39 @@ def cli_main():
         print("Invalid folder path!")
         return
     save_config(folder_path)
+    # Scanned lazily and reused across menu actions; dropped after anything that changes the folder.
+    snapshot = None
+    catalog = open_catalog()
+    progress = ProgressReporter(TerminalProgress())
     while True:
         print("\n **Menu Options:**")
         print("1. Scrape file titles")
         print("2. Replace text in filenames")
         print("3. Remove text from filenames")
-        print("4. Organize files by creation date")
+        print("4. Organize files into folders (by date or extension)")
         print("5. Undo last action")
-        print("6. Exit")
-        choice = input("Choose an option (1-6): ").strip()
-        if choice in ["1", "2", "3", "4", "5"]:
+        print("6. Find duplicate files (by content)")
+        print("7. Manage backup repository")
+        print("8. Redo last undone action")
+        print("9. Course report (durations, page counts)")
+        print("10. Exit")
+        choice = input("Choose an option (1-10): ").strip()
+        if choice in ["1", "2", "3", "4", "5", "6", "9"]:
+            if snapshot is None:
+                snapshot = scan_folder(folder_path)
             if choice in ["1", "2", "3", "4"]:
                 backup = input("\nCreate a backup before proceeding? (y/n): ").strip().lower()
                 if backup == 'y':
-                    backup_files(folder_path)
+                    backup_files(folder_path, snapshot=snapshot, mode=get_setting("backup_mode", "copy"),
+                                 repository=get_setting("backup_repository"), catalog=catalog,
+                                 progress_callback=progress)
             if choice in ["2", "3"]:
-                if not detect_duplicates(folder_path):
+                if not detect_duplicates(folder_path, snapshot=snapshot):
                     proceed = input("\nDuplicates found. Proceed anyway? (y/n): ").strip().lower()
                     if proceed != 'y':
                         continue
         if choice == "1":
-            get_video_titles(folder_path)
+            get_video_titles(folder_path, snapshot=snapshot)
         elif choice == "2":
             patterns = input("Enter regex patterns (comma-separated, e.g., 'part[0-9]+,lesson'): ").strip().split(',')
             patterns = [p.strip() for p in patterns]
@@ -106,11 +175,12 @@ def cli_main():
             if not validate_regex(patterns):
                 continue
             replacement = input("Enter replacement text: ").strip()
-            changes = preview_changes(folder_path, patterns, replacement)
+            changes = preview_changes(folder_path, patterns, replacement, snapshot=snapshot, progress_callback=progress)
             if changes:
                 proceed = input("\nApply these changes? (y/n): ").strip().lower()
                 if proceed == 'y':
-                    replace_text_in_filenames(folder_path, patterns, replacement, changes)
+                    replace_text_in_filenames(folder_path, patterns, replacement, changes, progress_callback=progress)
+                    snapshot = None
                     print(" Text replacement completed.")
         elif choice == "3":
             patterns = input("Enter regex patterns to remove (comma-separated, e.g., 'part[0-9]+,lesson'): ").strip().split(',')
@@ -120,19 +190,368 @@ def cli_main():
                 continue
             if not validate_regex(patterns):
                 continue
-            changes = preview_changes(folder_path, patterns, '', remove_mode=True)
+            changes = preview_changes(folder_path, patterns, '', remove_mode=True, snapshot=snapshot,
+                                      progress_callback=progress)
             if changes:
                 proceed = input("\nApply these changes? (y/n): ").strip().lower()
                 if proceed == 'y':
-                    replace_text_in_filenames(folder_path, patterns, '', changes)
+                    replace_text_in_filenames(folder_path, patterns, '', changes, progress_callback=progress)
+                    snapshot = None
                     print(" Text removal completed.")
         elif choice == "4":
-            organize_by_timestamp(folder_path)
-            print(" Files organized by creation date.")
+            default_key = get_setting("organize_key", DEFAULT_BUCKET_KEY)
+            bucket_key = input(f"Organize by ({', '.join(ORGANIZE_KEYS)}) [{default_key}]: ").strip() or default_key
+            if bucket_key not in ORGANIZE_KEYS:
+                print("Invalid choice!")
+                continue
+            save_setting("organize_key", bucket_key)
+            organize_by_timestamp(folder_path, snapshot=snapshot, bucket_key=bucket_key, progress_callback=progress)
+            snapshot = None
         elif choice == "5":
             undo_last_action(folder_path)
+            snapshot = None
         elif choice == "6":
+            detect_content_duplicates(folder_path, snapshot=snapshot, catalog=catalog, progress_callback=progress)
+        elif choice == "7":
+            manage_repository(folder_path)
+        elif choice == "8":
+            redo_last_action(folder_path)
+            snapshot = None
+        elif choice == "9":
+            media_report(folder_path, snapshot=snapshot, catalog=catalog, progress_callback=progress)
+        elif choice == "10":
             print("Exiting...")
+            if catalog:
+                catalog.close()
             break
         else:
-            print("Invalid choice! Please select 1-6.")
+            print("Invalid choice! Please select 1-10.")
+
+# Non-interactive interface: `python3 main.py <command> [folders...]`. Output is JSON lines on stdout
+# (or text with --text); the exit status is 0 on success, 1 if any folder reported an error, 2 on bad usage.
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+
+
+def _add_rule_arguments(parser, required=True):
+    parser.add_argument("-p", "--pattern", action="append", required=required,
+                        help="regex pattern; repeat or separate with commas")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-r", "--replace", default="", help="replacement text (default: empty)")
+    group.add_argument("--remove", action="store_true", help="remove matches (patterns applied in order)")
+
+
+def build_parser(parser_class=argparse.ArgumentParser):
+    """Parser for the subcommands; `parser_class` (also used for the subcommands) lets callers change how
+    errors are reported."""
+    parser = parser_class(prog="main.py", description="Batch file management for video and PDF folders.")
+    parser.add_argument("--text", action="store_true", help="human-readable output instead of JSON lines")
+    parser.add_argument("--progress", action="store_true", help="show a progress line on stderr")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="process this many folders in parallel")
+    parser.add_argument("--per-device", type=int, default=DEFAULT_PER_DEVICE,
+                        help="with --jobs, at most this many folders at once per disk")
+    parser.add_argument("--subfolders", action="store_true", help="process each folder's immediate subfolders")
+    parser.add_argument("--metrics-json", metavar="PATH", help="write counters, phase timings and latencies as JSON")
+    parser.add_argument("--metrics-prom", metavar="PATH",
+                        help="write the same metrics as a Prometheus text file (node-exporter textfile collector)")
+    parser.add_argument("--service", action="store_true",
+                        help="run the command in a service started with `serve`, falling back to running it here "
+                             "when none is reachable (commands with --plan always run here)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def command(name, help_text):
+        sub = commands.add_parser(name, help=help_text)
+        sub.add_argument("folders", nargs="*", help="folders to process; '-' or no folders with piped input "
+                                                    "reads one folder per line from stdin")
+        return sub
+
+    command("scan", "list unique file titles")
+    command("report", "durations, frame sizes and page counts read from file headers, with totals")
+    dupes = command("dupes", "find duplicate files")
+    dupes.add_argument("--by", choices=("content", "name", "fuzzy"), default="content")
+    dupes.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                       help="minimum title similarity (0-1) for --by fuzzy")
+    preview = command("preview", "preview regex renames")
+    _add_rule_arguments(preview)
+    preview.add_argument("--plan", default=None, metavar="FILE",
+                         help="also write the renames to a plan file for `apply`")
+    _add_rule_arguments(command("rename", "apply regex renames (journaled for undo)"))
+    organize = command("organize", "move files into folders by date or extension")
+    organize.add_argument("--key", choices=ORGANIZE_KEYS, default=None)
+    organize.add_argument("--dest", default=None, help="root for the bucket folders (default: the folder itself)")
+    organize.add_argument("--plan", default=None, metavar="FILE",
+                          help="write the moves to a plan file for `apply` instead of moving files")
+    apply = commands.add_parser("apply", help="apply plan files written by preview or organize --plan")
+    apply.add_argument("folders", nargs="*", metavar="PLAN", help="plan files; '-' or none with piped input "
+                                                                 "reads one path per line from stdin")
+    backup = command("backup", "back up the folder")
+    backup.add_argument("--mode", choices=BACKUP_MODES, default=None)
+    backup.add_argument("--repository", default=None, help="content-addressed backup repository path")
+    backup.add_argument("--full", action="store_true", help="copy every file even if unchanged since the last backup")
+    command("undo", "undo the last rename or organize in each folder")
+    command("redo", "redo the last undone operation in each folder")
+    watch = command("watch", "apply rename and organize rules to files as they arrive, until interrupted")
+    _add_rule_arguments(watch, required=False)
+    watch.add_argument("--organize", action="store_true", help="also organize new files (see --key and --dest)")
+    watch.add_argument("--key", choices=ORGANIZE_KEYS, default=None)
+    watch.add_argument("--dest", default=None, help="root for the bucket folders (default: the folder itself)")
+    watch.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                       help="seconds a new file must stop growing before it is handled")
+    watch.add_argument("--interval", type=float, default=DEFAULT_POLL_INTERVAL, help="polling interval in seconds")
+    watch.add_argument("--poll", action="store_true", help="poll the folders instead of using inotify")
+    serve = commands.add_parser("serve", help="keep snapshots and caches warm and run commands for --service "
+                                              "clients over JSON-RPC, until interrupted")
+    serve.add_argument("--address", default=None,
+                       help="Unix socket path or HOST:PORT (default: the service_address setting, else pfm.sock in "
+                            "$XDG_RUNTIME_DIR or a private pfm-<uid> temp folder, or localhost TCP on Windows)")
+    serve.add_argument("--workers", type=int, default=None, help="commands run at the same time (default: 4)")
+    return parser
+
+
+# Top-level options that shape the local run; the rest of the parsed arguments belong to the subcommand.
+_GLOBAL_OPTIONS = ("text", "progress", "jobs", "per_device", "subfolders", "metrics_json", "metrics_prom", "service",
+                   "command", "folders")
+
+
+def _iter_folders(folders, stdin=None):
+    stdin = stdin or sys.stdin
+    if folders == ["-"] or (not folders and not stdin.isatty()):
+        for line in stdin:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+    else:
+        yield from folders
+
+
+def _patterns(args):
+    return [p.strip() for value in args.pattern for p in value.split(",") if p.strip()]
+
+
+def run_command(args, folder_path, sink, progress=None, catalog=None, plan_writer=None, snapshot=None,
+                pipeline=None):
+    """Run one subcommand on one folder (one plan file for `apply`), writing records to `sink`.
+
+    `plan_writer` is the PlanWriter for `--plan`, shared by every folder of the run. A long-running caller
+    (see service.py) can pass a warm `snapshot` of the folder and a compiled `pipeline` for the patterns.
+    """
+    command = args.command
+    if command == "scan":
+        get_video_titles(folder_path, progress_callback=progress, snapshot=snapshot, sink=sink)
+    elif command == "report":
+        media_report(folder_path, progress_callback=progress, snapshot=snapshot, catalog=catalog, sink=sink)
+    elif command == "dupes":
+        if args.by == "name":
+            detect_duplicates(folder_path, progress_callback=progress, snapshot=snapshot, sink=sink)
+        elif args.by == "fuzzy":
+            detect_fuzzy_duplicates(folder_path, progress_callback=progress, snapshot=snapshot, sink=sink,
+                                    threshold=args.threshold)
+        else:
+            detect_content_duplicates(folder_path, progress_callback=progress, snapshot=snapshot, catalog=catalog,
+                                      sink=sink)
+    elif command in ("preview", "rename"):
+        patterns = _patterns(args)
+        snapshot = scan_folder(folder_path) if snapshot is None else snapshot
+        changes = preview_changes(folder_path, patterns, args.replace, args.remove, progress_callback=progress,
+                                  snapshot=snapshot, pipeline=pipeline, sink=sink, plan_writer=plan_writer)
+        if command == "rename" and changes:
+            replace_text_in_filenames(folder_path, patterns, args.replace, changes, progress_callback=progress,
+                                      sink=sink, snapshot=snapshot)
+    elif command == "organize":
+        organize_by_timestamp(folder_path, snapshot=snapshot, sink=sink, progress_callback=progress,
+                              bucket_key=args.key or get_setting("organize_key", DEFAULT_BUCKET_KEY),
+                              dest_root=args.dest, plan_writer=plan_writer)
+    elif command == "apply":
+        apply_plan_file(folder_path, progress_callback=progress, sink=sink)
+    elif command == "backup":
+        backup_files(folder_path, progress_callback=progress, mode=args.mode or get_setting("backup_mode", "copy"),
+                     incremental=not args.full, repository=args.repository or get_setting("backup_repository"),
+                     snapshot=snapshot, catalog=catalog, sink=sink)
+    elif command == "undo":
+        undo_last_action(folder_path, sink=sink)
+    elif command == "redo":
+        redo_last_action(folder_path, sink=sink)
+
+
+def check_args(args):
+    """Return what is wrong with parsed subcommand arguments that argparse cannot check, or None."""
+    if args.command == "watch" and not args.pattern and not args.organize:
+        return "watch needs --pattern and/or --organize"
+    if getattr(args, "plan", None) and args.jobs > 1:
+        return "--plan writes one file and cannot be combined with --jobs"
+    if args.command == "dupes" and not 0 < args.threshold <= 1:
+        return "--threshold must be between 0 and 1"
+    if getattr(args, "pattern", None):
+        invalid = RenamePipeline(_patterns(args)).invalid
+        if invalid:
+            return f"Invalid regex patterns: {', '.join(invalid)}"
+    return None
+
+
+def batch_main(argv=None, stdin=None):
+    """Entry point for the subcommand interface. Returns the process exit status."""
+    parser = build_parser()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else EXIT_USAGE
+    problem = check_args(args)
+    if problem:
+        print(problem, file=sys.stderr)
+        return EXIT_USAGE
+    if args.command == "serve":
+        return _serve(args)
+    progress = ProgressReporter(TerminalProgress()) if args.progress else None
+    folders = _iter_folders(args.folders, stdin)
+    if args.subfolders:
+        folders = (sub for folder_path in folders for sub in subfolders(folder_path))
+    collect = metrics_requested(args)
+    if collect:
+        metrics.enable()
+    status = None
+    if args.service and args.command != "watch" and not getattr(args, "plan", None):
+        status = _batch_service(args, folders)
+    if status is None:
+        status = _batch_local(args, folders, progress)
+    if collect and not metrics.export(args.metrics_json, args.metrics_prom):
+        print("Could not write metrics, see file_manager.log", file=sys.stderr)
+        status = EXIT_ERROR
+    return status
+
+
+def _batch_local(args, folders, progress=None):
+    if args.command == "watch":
+        return _watch(args, list(folders))
+    if args.jobs > 1 and args.command != "apply":
+        return _batch_parallel(args, list(folders), progress)
+    return _batch_serial(args, folders, progress)
+
+
+def _batch_serial(args, folders, progress=None):
+    catalog = open_catalog() if args.command in CATALOG_COMMANDS else None
+    plan_writer = PlanWriter(args.plan) if getattr(args, "plan", None) else None
+    status = EXIT_OK
+    try:
+        for folder_path in folders:
+            sink = ConsoleSink() if args.text else JsonLinesSink(command=args.command, folder=folder_path)
+            if args.command == "apply" and not os.path.isfile(folder_path):
+                sink.emit(error(f"Not a plan file: {folder_path}\n"))
+            elif args.command != "apply" and not os.path.isdir(folder_path):
+                sink.emit(error(f"Not a folder: {folder_path}\n"))
+            else:
+                run_command(args, folder_path, sink, progress, catalog, plan_writer)
+            sink.close()
+            if sink.errors:
+                status = EXIT_ERROR
+    finally:
+        if catalog:
+            catalog.close()
+        if plan_writer:
+            plan_writer.close()
+    return status
+
+
+def _batch_service(args, folders):
+    """Run `args.command` on each folder in a running service and print the records it sends back. Returns
+    None, before reading any folder, when no service is reachable."""
+    from service import ServiceClient, ServiceError
+    try:
+        client = ServiceClient()
+    except OSError as e:
+        print(f"No service address ({e}); running here", file=sys.stderr)
+        return None
+    try:
+        client.connect()
+    except OSError as e:
+        print(f"No service reachable at {client.address} ({e}); running here", file=sys.stderr)
+        return None
+    options = {k: v for k, v in vars(args).items() if k not in _GLOBAL_OPTIONS}
+    # Paths are resolved here: the service runs in another working directory.
+    for key in ("dest", "repository"):
+        if options.get(key):
+            options[key] = os.path.abspath(options[key])
+    status = EXIT_OK
+    with client:
+        for folder_path in folders:
+            sink = ConsoleSink() if args.text else JsonLinesSink(command=args.command, folder=folder_path)
+            try:
+                result = client.call(args.command, folder=os.path.abspath(folder_path), options=options)
+                for record in result["records"]:
+                    sink.emit(record)
+            except (ServiceError, OSError) as e:
+                sink.emit(error(f"Service error for {folder_path}: {str(e)}\n"))
+            sink.close()
+            if sink.errors:
+                status = EXIT_ERROR
+    return status
+
+
+def _serve(args):
+    """Run the service in the foreground until interrupted or asked to shut down."""
+    from service import Service
+    try:
+        service = Service(args.address, args.workers)
+    except OSError as e:
+        print(f"Cannot serve: {str(e)}", file=sys.stderr)
+        return EXIT_ERROR
+    print(f"Serving on {service.address} (Ctrl+C to stop)", file=sys.stderr)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Cannot serve on {service.address}: {str(e)}", file=sys.stderr)
+        return EXIT_ERROR
+    return EXIT_OK
+
+
+def _watch(args, folders):
+    """Apply the rules to files arriving in `folders` until interrupted."""
+    missing = [f for f in folders if not os.path.isdir(f)]
+    if missing or not folders:
+        print(f"Not a folder: {', '.join(missing)}" if missing else "No folders to watch", file=sys.stderr)
+        return EXIT_ERROR
+    pipeline = RenamePipeline(_patterns(args), args.replace, args.remove) if args.pattern else None
+    bucket_key = (args.key or get_setting("organize_key", DEFAULT_BUCKET_KEY)) if args.organize else None
+
+    def on_ready(folder_path, names, listing):
+        sink = ConsoleSink() if args.text else JsonLinesSink(command="watch", folder=folder_path)
+        try:
+            return apply_rules(folder_path, names, listing, sink, pipeline, bucket_key, args.dest)
+        finally:
+            sink.close()
+
+    watcher = FolderWatcher(folders, on_ready, args.settle, args.interval, args.poll)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return EXIT_OK
+
+
+def _batch_parallel(args, folders, progress=None):
+    """Run `args.command` over `folders` on a process pool, printing each folder's output as it finishes."""
+    status = EXIT_OK
+    started = time.perf_counter()
+    failed = operations = 0
+    for result in run_batch(args, folders, args.jobs, args.per_device, progress):
+        if result.metrics:
+            metrics.registry.merge(result.metrics)
+        context = {"command": args.command, "folder": result.folder}
+        if result.operation:
+            # The journal operation to undo in that folder if the batch needs reverting.
+            context["operation"] = result.operation
+            operations += 1
+        sink = ConsoleSink() if args.text else JsonLinesSink(**context)
+        for record in result.records:
+            sink.emit(record)
+        sink.close()
+        if result.errors:
+            failed += 1
+            status = EXIT_ERROR
+    summary = ConsoleSink() if args.text else JsonLinesSink(command=args.command)
+    summary.write(f"Processed {len(folders)} folders in {time.perf_counter() - started:.1f}s: "
+                  f"{failed} with errors, {operations} journaled operations\n")
+    summary.close()
+    return status
@@ -0,0 +1,144 @@
+import os
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from progress import start, check
+from metrics import registry as metrics
+from file_table import FileTable
+
+# Bytes hashed from each end of a file before falling back to a full-content hash.
+PARTIAL_HASH_SIZE = 4096
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DuplicateGroup = namedtuple("DuplicateGroup", ["size", "digest", "entries"])
+
+
+def reclaimable_bytes(group):
+    """Bytes freed by keeping a single copy of a duplicate group."""
+    return group.size * (len(group.entries) - 1)
+
+
+def partial_hash(path, size, block_size=PARTIAL_HASH_SIZE):
+    """Hash the first and last `block_size` bytes of a file (the whole file if it is small)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if size <= 2 * block_size:
+            h.update(f.read())
+        else:
+            h.update(f.read(block_size))
+            f.seek(-block_size, os.SEEK_END)
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+
+def full_hash(path):
+    """Hash the full content of a file in fixed-size chunks."""
+    h = hashlib.blake2b()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def _group_by(entries, key_func):
+    groups = {}
+    for entry in entries:
+        try:
+            key = key_func(entry)
+        except OSError:
+            continue
+        groups.setdefault(key, []).append(entry)
+    return [(key, g) for key, g in groups.items() if len(g) > 1]
+
+
+def _hash_many(pool, entries, hash_func, cached, field, progress=None, phase="hashing"):
+    """Return {path: digest}, taking digests from the catalog rows in `cached` and hashing the rest on `pool`."""
+    digests = {}
+    missing = []
+    for entry in entries:
+        row = cached.get(os.path.abspath(entry.path))
+        if row and row[field]:
+            digests[entry.path] = row[field]
+        else:
+            missing.append(entry)
+
+    def work(entry):
+        # Queued files are skipped quickly once the operation is cancelled.
+        check(progress)
+        return hash_func(entry)
+
+    start(progress, phase, len(missing), sum(e.size for e in missing))
+    with metrics.span(phase):
+        for entry, digest in zip(missing, pool.map(work, missing)):
+            if digest is not None:
+                digests[entry.path] = digest
+            if progress:
+                progress.advance(1, entry.size)
+    metrics.count("files_hashed", len(missing), phase=phase)
+    metrics.count("hash_cache_hits", len(entries) - len(missing))
+    return digests, {e.path: digests[e.path] for e in missing if e.path in digests}
+
+
+def find_content_duplicates(entries, max_workers=None, progress=None, catalog=None):
+    """Group byte-identical files: bucket by size, then by partial hash, then by full hash on a thread pool.
+
+    `entries` is a list of FileEntry records or a FileTable (see FolderSnapshot.supported). With a
+    FileCatalog, hashes of unchanged files are reused and new ones are stored. `progress` is an optional
+    ProgressReporter, advanced once per file hashed in each phase.
+    """
+    table = entries if isinstance(entries, FileTable) else FileTable(entries)
+    # Hard links to the same inode are one file on disk, so only one of them takes part.
+    size_groups = table.select(nonempty=True).distinct_inodes().size_groups()
+    sized = [e for group in size_groups for e in group]
+    cached = catalog.lookup(sized) if catalog else {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        partials, new_partials = _hash_many(
+            pool, sized, _safe_partial_hash, cached, "partial_hash", progress, "partial hash")
+        candidates = []
+        for group in size_groups:
+            candidates.extend(_group_by([e for e in group if e.path in partials], lambda e: partials[e.path]))
+        # Files no larger than the two partial blocks were already hashed in full.
+        to_hash = [e for _, group in candidates for e in group if e.size > 2 * PARTIAL_HASH_SIZE]
+        digests, new_fulls = _hash_many(
+            pool, to_hash, _safe_full_hash, cached, "full_hash", progress, "full hash")
+    if catalog:
+        catalog.store_hashes(partial=new_partials, full=new_fulls)
+
+    result = []
+    for partial, group in candidates:
+        size = group[0].size
+        if size <= 2 * PARTIAL_HASH_SIZE:
+            result.append(DuplicateGroup(size, partial, group))
+            continue
+        for digest, members in _group_by([e for e in group if e.path in digests], lambda e: digests[e.path]):
+            result.append(DuplicateGroup(size, digest, members))
+    result.sort(key=reclaimable_bytes, reverse=True)
+    return result
+
+
+def _safe_partial_hash(entry):
+    try:
+        return partial_hash(entry.path, entry.size)
+    except OSError:
+        return None
+
+
+def _safe_full_hash(entry):
+    try:
+        return full_hash(entry.path)
+    except OSError:
+        return None
+
+
+def format_size(num_bytes):
+    """Format a byte count for display (e.g. 1.5 GB)."""
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1024 or unit == "TB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
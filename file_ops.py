@@ -1,307 +1,642 @@
-
 import os
 import re
+import queue
 import shutil
 import datetime
 import logging
-import json
+import threading
+from scanner import get_snapshot
+from duplicates import find_content_duplicates, reclaimable_bytes, format_size
+from backup import run_backup, find_previous_backup, DEFAULT_WORKERS
+from backup_repo import BackupRepository
+from rules import RenamePipeline
+from sinks import ResultRecord, make_sink, error
+from planner import plan_renames, execute_plan, name_key, RenameTransactionError
+from journal import Journal
+from organizer import (plan_organize, execute_organize, bucket_labels, describe_bucket_key,
+                       DEFAULT_BUCKET_KEY)
+from progress import as_reporter, start, OperationCancelled
+from metrics import instrumented, registry as metrics
+from metadata import extract_metadata, format_duration
+from fuzzy import find_fuzzy_duplicates, DEFAULT_THRESHOLD
+from plans import add_rename_plan, add_organize_plan, apply_plan
+from worker import QueueSink
 
 # Supported extensions for all file operations
 SUPPORTED_EXTENSIONS = {".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".pdf"}
 
-def get_video_titles(folder_path, text_widget=None, progress_callback=None):
+# `progress_callback` arguments take a function receiving progress.ProgressEvent tuples (called at most every
+# 50 ms or 1%), or a ProgressReporter to share between calls. A reporter with a cancel event stops the
+# operation at the next file boundary; the functions below report that and return as if nothing was found.
+
+
+def _report_cancelled(sink, text):
+    sink.write(f"\n {text}\n")
+    logging.info(text)
+
+
+def iter_video_titles(folder_path, snapshot=None, progress_callback=None):
+    """Yield a `title` record for each unique supported-file title, in scan order."""
+    seen = set()
+    stems = get_snapshot(folder_path, snapshot).supported(SUPPORTED_EXTENSIONS).stems()
+    progress = start(as_reporter(progress_callback), "titles", len(stems))
+    for name in stems:
+        if name not in seen:
+            seen.add(name)
+            yield ResultRecord("title", name)
+        if progress:
+            progress.advance()
+
+
+@instrumented
+def get_video_titles(folder_path, text_widget=None, progress_callback=None, snapshot=None, sink=None):
     """Extract and print unique video titles from the specified folder."""
+    sink = sink or make_sink(text_widget)
     try:
-        folder_name = os.path.basename(folder_path)
-        video_titles = set()
-        files = os.listdir(folder_path)
-        for i, filename in enumerate(files):
-            name, ext = os.path.splitext(filename)
-            if ext.lower() in SUPPORTED_EXTENSIONS:
-                video_titles.add(name)
-            if progress_callback:
-                progress = (i + 1) / len(files) * 100
-                progress_callback(progress)
-        output = f"\n **Folder Name:** {folder_name}\n\n📜 **Unique File Titles:**\n"
-        for title in sorted(video_titles):
-            output += f"- {title}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.info(f"Scraped titles from: {os.path.basename(folder_path)}")
+        titles = sorted(r.name for r in iter_video_titles(folder_path, snapshot, progress_callback))
+        sink.write(f"\n **Folder Name:** {os.path.basename(folder_path)}\n\n📜 **Unique File Titles:**\n")
+        for title in titles:
+            sink.emit(ResultRecord("title", title))
+        logging.info("Scraped titles from: %s", os.path.basename(folder_path))
+    except OperationCancelled:
+        _report_cancelled(sink, "Title scan cancelled.")
     except Exception as e:
-        output = f"Error scraping titles: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in get_video_titles: {str(e)}")
+        sink.emit(error(f"Error scraping titles: {str(e)}\n"))
+        logging.error("Error in get_video_titles: %s", e)
+    finally:
+        sink.flush()
+
+
+def _lesson_order(name):
+    # Numbered lessons in numeric order: "2 - Setup" before "10 - Deploy".
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def iter_media_info(folder_path, snapshot=None, progress_callback=None, catalog=None):
+    """Yield a `media` record per supported file in lesson order; `detail` is its metadata dict."""
+    snapshot = get_snapshot(folder_path, snapshot)
+    if catalog:
+        catalog.sync(snapshot)
+    files = snapshot.supported_files(SUPPORTED_EXTENSIONS)
+    info = extract_metadata(files, catalog, progress=as_reporter(progress_callback))
+    for entry in sorted(files, key=lambda e: _lesson_order(e.rel_path)):
+        yield ResultRecord("media", entry.rel_path, detail=info.get(entry.path, {}))
+
+
+@instrumented
+def media_report(folder_path, text_widget=None, progress_callback=None, snapshot=None, catalog=None, sink=None):
+    """List durations, frame sizes and page counts read from the file headers, with folder totals."""
+    sink = sink or make_sink(text_widget)
+    totals = {"videos": 0, "duration": 0.0, "pdfs": 0, "pages": 0}
+    try:
+        sink.write(f"\n **Course Report:** {os.path.basename(folder_path)}\n\n")
+        for record in iter_media_info(folder_path, snapshot, progress_callback, catalog):
+            info = record.detail
+            if info.get("duration") is not None:
+                totals["videos"] += 1
+                totals["duration"] += info["duration"]
+            if info.get("pages") is not None:
+                totals["pdfs"] += 1
+                totals["pages"] += info["pages"]
+            sink.emit(record)
+        sink.write(f"\n Total: {totals['videos']} videos, {format_duration(totals['duration'])}; "
+                   f"{totals['pdfs']} PDFs, {totals['pages']} pages\n")
+        logging.info("Course report for %s: %s videos, %s PDFs", os.path.basename(folder_path), totals["videos"],
+                     totals["pdfs"])
+    except OperationCancelled:
+        _report_cancelled(sink, "Course report cancelled.")
+    except Exception as e:
+        sink.emit(error(f"Error reading file metadata: {str(e)}\n"))
+        logging.error("Error in media_report: %s", e)
+    finally:
+        sink.flush()
+    return totals
 
 
-def backup_files(folder_path, text_widget=None, progress_callback=None):
-    """Create a backup of all files in the folder. Note: Subdirectories are not backed up."""
+@instrumented
+def backup_files(folder_path, text_widget=None, progress_callback=None, snapshot=None, mode="copy",
+                 incremental=True, max_workers=DEFAULT_WORKERS, repository=None, catalog=None, sink=None):
+    """Create a backup of all files in the folder. Note: Subdirectories are not backed up.
+
+    `mode` is "copy", "hardlink" or "reflink"; with `incremental`, files unchanged since the previous backup
+    are hard-linked from it instead of copied again. With a `repository` path, the backup goes to that
+    content-addressed store instead of a backup_<timestamp> folder.
+    """
+    sink = sink or make_sink(text_widget)
+    if repository:
+        return backup_to_repository(folder_path, repository, progress_callback=progress_callback, snapshot=snapshot,
+                                    catalog=catalog, sink=sink)
+    backup_dir = None
     try:
+        files = [e for e in get_snapshot(folder_path, snapshot).files() if e.rel_path == e.name]
         backup_dir = os.path.join(folder_path, f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}")
         os.makedirs(backup_dir, exist_ok=True)
-        files = os.listdir(folder_path)
-        for i, filename in enumerate(files):
-            src = os.path.join(folder_path, filename)
-            dst = os.path.join(backup_dir, filename)
-            if os.path.isfile(src):
-                shutil.copy2(src, dst)
-            if progress_callback:
-                progress = (i + 1) / len(files) * 100
-                progress_callback(progress)
-        output = f"\n Backup created at: {os.path.basename(backup_dir)}\n(Warning: Subdirectories are not included in the backup.)\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.info(f"Backup created at: {os.path.basename(backup_dir)}")
+        previous = find_previous_backup(folder_path, exclude=backup_dir) if incremental else None
+        stats = run_backup(files, backup_dir, mode, previous, max_workers, as_reporter(progress_callback))
+        sink.write(f"\n Backup created at: {os.path.basename(backup_dir)}\n"
+                   f"({stats['copied']} files written in {mode} mode, {stats['linked']} unchanged since last backup, "
+                   f"{format_size(stats['bytes'])} copied)\n"
+                   "(Warning: Subdirectories are not included in the backup.)\n")
+        logging.info("Backup created at: %s", os.path.basename(backup_dir))
         return backup_dir
+    except OperationCancelled:
+        # A backup without its manifest is never used as a base for the next one, so drop the partial copy.
+        if backup_dir:
+            shutil.rmtree(backup_dir, ignore_errors=True)
+        _report_cancelled(sink, "Backup cancelled; the partial backup was removed.")
+        return None
     except Exception as e:
-        output = f"Error creating backup: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in backup_files: {str(e)}")
+        sink.emit(error(f"Error creating backup: {str(e)}\n"))
+        logging.error("Error in backup_files: %s", e)
         return None
+    finally:
+        sink.flush()
 
 
-def detect_duplicates(folder_path, text_widget=None, progress_callback=None):
+@instrumented
+def backup_to_repository(folder_path, repository, text_widget=None, progress_callback=None, snapshot=None,
+                         catalog=None, sink=None):
+    """Back up the folder (including subdirectories) into a deduplicating backup repository."""
+    sink = sink or make_sink(text_widget)
+    try:
+        source = os.path.join(os.path.normcase(os.path.abspath(folder_path)), "")
+        if os.path.normcase(os.path.abspath(repository)).startswith(source):
+            raise ValueError("the backup repository must be outside the folder being backed up")
+        snapshot = get_snapshot(folder_path, snapshot if snapshot is not None and snapshot.recursive else None,
+                                recursive=True)
+        snapshot_id, stats = BackupRepository(repository).backup(snapshot, catalog,
+                                                                 progress=as_reporter(progress_callback))
+        sink.write(f"\n Backup snapshot {snapshot_id} stored in: {repository}\n"
+                   f"({stats['files']} files, {stats['new_objects']} new, {format_size(stats['bytes'])} stored)\n")
+        return snapshot_id
+    except OperationCancelled:
+        _report_cancelled(sink, "Backup cancelled; no snapshot was recorded.")
+        return None
+    except Exception as e:
+        sink.emit(error(f"Error creating backup: {str(e)}\n"))
+        logging.error("Error in backup_to_repository: %s", e)
+        return None
+    finally:
+        sink.flush()
+
+
+def iter_duplicates(folder_path, snapshot=None, progress_callback=None):
+    """Yield a `duplicate` record the first time a supported-file title is seen twice (ignoring extensions)."""
+    name_count = {}
+    stems = get_snapshot(folder_path, snapshot).supported(SUPPORTED_EXTENSIONS).stems()
+    progress = start(as_reporter(progress_callback), "duplicates", len(stems))
+    for name in stems:
+        name_count[name] = name_count.get(name, 0) + 1
+        if name_count[name] == 2:
+            yield ResultRecord("duplicate", name)
+        if progress:
+            progress.advance()
+
+
+@instrumented
+def detect_duplicates(folder_path, text_widget=None, progress_callback=None, snapshot=None, sink=None):
     """Detect and report duplicate filenames (ignoring extensions)."""
+    sink = sink or make_sink(text_widget)
     try:
-        name_count = {}
-        duplicates = []
-        files = os.listdir(folder_path)
-        for i, filename in enumerate(files):
-            name, ext = os.path.splitext(filename)
-            if ext.lower() in SUPPORTED_EXTENSIONS:
-                name_count[name] = name_count.get(name, 0) + 1
-                if name_count[name] > 1:
-                    duplicates.append(name)
-            if progress_callback:
-                progress = (i + 1) / len(files) * 100
-                progress_callback(progress)
+        duplicates = [r.name for r in iter_duplicates(folder_path, snapshot, progress_callback)]
         if duplicates:
-            output = "\n **Duplicate Filenames Detected:**\n" + "\n".join(f"- {dup}" for dup in set(duplicates)) + "\n"
-            if text_widget:
-                text_widget.insert('end', output)
-            else:
-                print(output)
-            logging.warning(f"Duplicates found: {', '.join(set(duplicates))}")
+            sink.write("\n **Duplicate Filenames Detected:**\n")
+            for name in duplicates:
+                sink.emit(ResultRecord("duplicate", name))
+            logging.warning("Duplicates found: %s", ", ".join(duplicates))
             return False
-        output = "\n No duplicate filenames detected.\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
+        sink.write("\n No duplicate filenames detected.\n")
         logging.info("No duplicates found")
         return True
+    except OperationCancelled:
+        _report_cancelled(sink, "Duplicate check cancelled.")
+        return False
     except Exception as e:
-        output = f"Error detecting duplicates: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in detect_duplicates: {str(e)}")
+        sink.emit(error(f"Error detecting duplicates: {str(e)}\n"))
+        logging.error("Error in detect_duplicates: %s", e)
         return False
+    finally:
+        sink.flush()
+
+
+def _group_record(group):
+    return ResultRecord("duplicate_group", group.entries[0].rel_path, detail={
+        "size": group.size, "reclaimable": reclaimable_bytes(group), "digest": group.digest,
+        "files": [entry.rel_path for entry in group.entries]})
+
+
+def _content_duplicate_groups(folder_path, snapshot, progress_callback, catalog):
+    snapshot = get_snapshot(folder_path, snapshot)
+    if catalog:
+        catalog.sync(snapshot)
+    return find_content_duplicates(snapshot.supported(SUPPORTED_EXTENSIONS), progress=as_reporter(progress_callback),
+                                   catalog=catalog)
+
+
+def iter_content_duplicates(folder_path, snapshot=None, progress_callback=None, catalog=None):
+    """Yield a `duplicate_group` record per set of byte-identical supported files, largest savings first."""
+    for group in _content_duplicate_groups(folder_path, snapshot, progress_callback, catalog):
+        yield _group_record(group)
+
+
+@instrumented
+def detect_content_duplicates(folder_path, text_widget=None, progress_callback=None, snapshot=None, catalog=None,
+                              sink=None):
+    """Detect byte-identical files regardless of name and report reclaimable space."""
+    sink = sink or make_sink(text_widget)
+    try:
+        groups = _content_duplicate_groups(folder_path, snapshot, progress_callback, catalog)
+        if groups:
+            total = sum(reclaimable_bytes(g) for g in groups)
+            sink.write(f"\n **Duplicate Files Detected (by content):** {len(groups)} groups, "
+                       f"{format_size(total)} reclaimable\n")
+            for group in groups:
+                sink.emit(_group_record(group))
+            logging.warning("Content duplicates found: %s groups, %s bytes reclaimable", len(groups), total)
+        else:
+            sink.write("\n No duplicate file contents detected.\n")
+            logging.info("No content duplicates found")
+        return groups
+    except OperationCancelled:
+        _report_cancelled(sink, "Duplicate search cancelled.")
+        return []
+    except Exception as e:
+        sink.emit(error(f"Error detecting duplicates: {str(e)}\n"))
+        logging.error("Error in detect_content_duplicates: %s", e)
+        return []
+    finally:
+        sink.flush()
 
 
-def validate_regex(patterns, text_widget=None):
+def _fuzzy_record(group):
+    return ResultRecord("fuzzy_group", group.entries[0].rel_path, detail={
+        "score": group.score, "title": group.title, "files": [entry.rel_path for entry in group.entries]})
+
+
+def iter_fuzzy_duplicates(folder_path, snapshot=None, progress_callback=None, threshold=DEFAULT_THRESHOLD):
+    """Yield a `fuzzy_group` record per cluster of supported files with near-identical titles, largest first."""
+    files = get_snapshot(folder_path, snapshot).supported_files(SUPPORTED_EXTENSIONS)
+    for group in find_fuzzy_duplicates(files, threshold, progress=as_reporter(progress_callback)):
+        yield _fuzzy_record(group)
+
+
+@instrumented
+def detect_fuzzy_duplicates(folder_path, text_widget=None, progress_callback=None, snapshot=None, sink=None,
+                            threshold=DEFAULT_THRESHOLD):
+    """Detect files whose titles differ only in case, numbering style, tags like "(1)" or "[720p]" and the like."""
+    sink = sink or make_sink(text_widget)
+    try:
+        records = list(iter_fuzzy_duplicates(folder_path, snapshot, progress_callback, threshold))
+        if records:
+            sink.write(f"\n **Near-Duplicate Titles Detected:** {len(records)} groups\n")
+            for record in records:
+                sink.emit(record)
+            logging.warning("Near-duplicate titles found: %s groups", len(records))
+        else:
+            sink.write("\n No near-duplicate titles detected.\n")
+            logging.info("No near-duplicate titles found")
+        return records
+    except OperationCancelled:
+        _report_cancelled(sink, "Duplicate search cancelled.")
+        return []
+    except Exception as e:
+        sink.emit(error(f"Error detecting duplicates: {str(e)}\n"))
+        logging.error("Error in detect_fuzzy_duplicates: %s", e)
+        return []
+    finally:
+        sink.flush()
+
+
+def _report_invalid(invalid_patterns, sink):
+    sink.emit(error(f"Invalid regex patterns: {', '.join(invalid_patterns)}\n"))
+    sink.flush()
+    logging.error("Invalid regex patterns: %s", invalid_patterns)
+
+
+def validate_regex(patterns, text_widget=None, sink=None):
     """Validate regex patterns to ensure they are correct."""
-    invalid_patterns = []
-    for pattern in patterns:
-        try:
-            re.compile(pattern)
-        except re.error:
-            invalid_patterns.append(pattern)
+    invalid_patterns = RenamePipeline(patterns).invalid
     if invalid_patterns:
-        output = f"Invalid regex patterns: {', '.join(invalid_patterns)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Invalid regex patterns: {invalid_patterns}")
+        _report_invalid(invalid_patterns, sink or make_sink(text_widget))
         return False
     return True
 
 
-def preview_changes(folder_path, patterns, replacement, remove_mode=False, text_widget=None, progress_callback=None):
-    """Preview filename changes before applying them. Prevents overwriting files."""
+def iter_change_records(candidates, snapshot, existing_keys=None):
+    """Turn (src, dst) rename candidates for `snapshot`'s folder into `change` and `skip` records.
+
+    Changes to free names are yielded as soon as they are found. Changes onto a name that exists in the
+    folder wait until the candidates run out, when the rename planner decides whether that name is vacated
+    by another change (chains and swaps) or really blocked. `existing_keys` may pass in the snapshot's
+    name_key set when it is reused across calls.
+    """
+    if existing_keys is None:
+        existing_keys = {name_key(n) for n in snapshot.names()}
+    changes = []
+    claimed = set()
+    deferred = False
+    for filename, candidate in candidates:
+        changes.append((filename, candidate))
+        key = name_key(candidate)
+        if key not in existing_keys and key not in claimed:
+            claimed.add(key)
+            yield ResultRecord("change", filename, candidate)
+        else:
+            deferred = True
+    if deferred:
+        with metrics.span("plan"):
+            plan = plan_renames(changes, snapshot.names())
+        for src, dst in plan.changes:
+            if name_key(dst) not in claimed:
+                yield ResultRecord("change", src, dst)
+        for skip in plan.skipped:
+            yield ResultRecord("skip", skip.src, skip.dst, skip.reason)
+
+
+def iter_preview_changes(folder_path, pipeline, snapshot=None, progress_callback=None):
+    """Yield `change` records for files the pipeline would rename, and `skip` records for blocked ones."""
+    snapshot = get_snapshot(folder_path, snapshot)
+    files = snapshot.supported(SUPPORTED_EXTENSIONS)
+    progress = start(as_reporter(progress_callback), "preview", len(files))
+
+    def candidates():
+        for rel_path, (name, ext) in zip(files.rel_paths(), files.split_names()):
+            new_name = pipeline.apply(name)
+            if new_name != name and new_name.strip():
+                yield rel_path, os.path.join(os.path.dirname(rel_path), new_name + ext)
+            if progress:
+                progress.advance()
+    for record in iter_change_records(candidates(), snapshot):
+        if record.kind == "skip":
+            logging.warning("Skipping rename %s -> %s (%s)", record.name, record.target, record.detail,
+                            extra={"file_event": "skipped"})
+        yield record
+
+
+@instrumented
+def preview_changes(folder_path, patterns, replacement, remove_mode=False, text_widget=None, progress_callback=None,
+                    snapshot=None, pipeline=None, sink=None, plan_writer=None):
+    """Preview filename changes before applying them. Prevents overwriting files.
+
+    A prebuilt RenamePipeline can be passed as `pipeline` to reuse compiled rules across folders. With a
+    plans.PlanWriter as `plan_writer`, the renames are also written to the plan file, to be applied later.
+    """
+    sink = sink or make_sink(text_widget)
     try:
-        if not validate_regex(patterns, text_widget):
+        if pipeline is None:
+            pipeline = RenamePipeline(patterns, replacement, remove_mode)
+        if not pipeline.valid:
+            # The pipeline compiled (or failed to compile) every pattern already.
+            _report_invalid(pipeline.invalid, sink)
             return []
         changes = []
-        files = os.listdir(folder_path)
-        existing_files = set(files)
-        for i, filename in enumerate(files):
-            name, ext = os.path.splitext(filename)
-            if ext.lower() in SUPPORTED_EXTENSIONS:
-                new_name = name
-                for pattern in patterns:
-                    if remove_mode:
-                        new_name = re.sub(pattern, '', new_name, flags=re.IGNORECASE)
-                    else:
-                        new_name = re.sub(pattern, replacement, new_name, flags=re.IGNORECASE)
-                if new_name != name and new_name.strip():
-                    candidate = new_name + ext
-                    if candidate in existing_files and candidate != filename:
-                        output = f"[SKIP] {filename} -> {candidate} (Target exists, skipping to prevent overwrite)\n"
-                        if text_widget:
-                            text_widget.insert('end', output)
-                        else:
-                            print(output)
-                        logging.warning(f"Skipping rename {filename} -> {candidate} (target exists)")
-                        continue
-                    changes.append((filename, candidate))
-            if progress_callback:
-                progress = (i + 1) / len(files) * 100
-                progress_callback(progress)
-        if changes:
-            output = "\n **Preview of Changes:**\n" + "\n".join(f"{os.path.basename(old)} -> {os.path.basename(new)}" for old, new in changes) + "\n"
-        else:
-            output = "\nNo changes to preview.\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.info(f"Previewed changes: {len(changes)} files")
+        header = False
+        for record in iter_preview_changes(folder_path, pipeline, snapshot, progress_callback):
+            if record.kind == "change":
+                if not header:
+                    sink.write("\n **Preview of Changes:**\n")
+                    header = True
+                changes.append((record.name, record.target))
+            sink.emit(record)
+        if not changes:
+            sink.write("\nNo changes to preview.\n")
+        elif plan_writer is not None:
+            snapshot = get_snapshot(folder_path, snapshot)
+            entries = {e.rel_path: e for e in snapshot.files()}
+            add_rename_plan(plan_writer, folder_path, plan_renames(changes, snapshot.names()), entries)
+            sink.write(f"\n Rename plan for {len(changes)} files written to {plan_writer.path}\n")
+        logging.info("Previewed changes: %s files", len(changes))
         return changes
+    except OperationCancelled:
+        _report_cancelled(sink, "Preview cancelled.")
+        return []
     except Exception as e:
-        output = f"Error previewing changes: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in preview_changes: {str(e)}")
+        sink.emit(error(f"Error previewing changes: {str(e)}\n"))
+        logging.error("Error in preview_changes: %s", e)
         return []
+    finally:
+        sink.flush()
 
 
-def replace_text_in_filenames(folder_path, patterns, replacement, changes, text_widget=None, progress_callback=None):
-    """Apply filename changes and log for undo. Prevents overwriting files."""
-    UNDO_FILE = "undo.json"
+@instrumented
+def replace_text_in_filenames(folder_path, patterns, replacement, changes, text_widget=None, progress_callback=None,
+                              sink=None, snapshot=None):
+    """Apply filename changes and journal them for undo. Prevents overwriting files.
+
+    The whole batch is planned up front (so chains and swaps work) and applied as one transaction: if any
+    rename fails, the ones already done are rolled back.
+    """
+    sink = sink or make_sink(text_widget)
     try:
-        undo_log = []
-        for i, (old_name, new_name) in enumerate(changes):
-            src = os.path.join(folder_path, old_name)
-            dst = os.path.join(folder_path, new_name)
-            if os.path.exists(dst):
-                output = f"[SKIP] {old_name} -> {new_name} (Target exists, skipping to prevent overwrite)\n"
-                if text_widget:
-                    text_widget.insert('end', output)
-                else:
-                    print(output)
-                logging.warning(f"Skipping rename {old_name} -> {new_name} (target exists)")
-                continue
-            os.rename(src, dst)
-            undo_log.append((dst, src))
-            output = f"Renamed: {os.path.basename(old_name)} -> {os.path.basename(new_name)}\n"
-            if text_widget:
-                text_widget.insert('end', output)
-            else:
-                print(output)
-            logging.info(f"Renamed: {os.path.basename(old_name)} -> {os.path.basename(new_name)}")
-            if progress_callback:
-                progress = (i + 1) / len(changes) * 100
-                progress_callback(progress)
-        with open(UNDO_FILE, "w") as f:
-            json.dump(undo_log, f)
-        logging.info("Saved undo log")
+        with metrics.span("plan"):
+            plan = plan_renames(changes, get_snapshot(folder_path, snapshot).names())
+        for skip in plan.skipped:
+            sink.emit(ResultRecord("skip", skip.src, skip.dst, skip.reason))
+            logging.warning("Skipping rename %s -> %s (%s)", skip.src, skip.dst, skip.reason,
+                            extra={"file_event": "skipped"})
+        if not plan.steps:
+            return
+        op = Journal(folder_path).begin("rename", f"{len(plan.changes)} files")
+        try:
+            execute_plan(folder_path, plan, as_reporter(progress_callback),
+                         before_step=lambda src, dst: op.record(os.path.abspath(src), os.path.abspath(dst)))
+        except (RenameTransactionError, OperationCancelled):
+            op.abort()
+            raise
+        op.commit()
+        for old_name, new_name in plan.changes:
+            sink.emit(ResultRecord("renamed", old_name, new_name))
+            logging.info("Renamed: %s -> %s", old_name, new_name, extra={"file_event": "renamed"})
+        logging.info("Saved undo journal")
+    except OperationCancelled:
+        _report_cancelled(sink, "Rename cancelled; every file keeps its original name.")
     except Exception as e:
-        output = f"Error renaming files: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in replace_text_in_filenames: {str(e)}")
+        sink.emit(error(f"Error renaming files: {str(e)}\n"))
+        logging.error("Error in replace_text_in_filenames: %s", e)
+    finally:
+        sink.flush()
+
+
+def _replay_journal(folder_path, redo, sink):
+    journal = Journal(folder_path)
+
+    def on_move(src, dst):
+        sink.emit(ResultRecord("undone" if not redo else "moved", os.path.basename(src), os.path.basename(dst)))
+
+    op = journal.redo(on_move) if redo else journal.undo(on_move)
+    if op is None:
+        sink.write(f"No actions to {'redo' if redo else 'undo'}.\n")
+        logging.info("Nothing to %s in journal", "redo" if redo else "undo")
+        return None
+    verb = "Redid" if redo else "Undid"
+    sink.write(f"{verb} {op['action']} ({op['description']}): {op['moved']} files moved"
+               + (f", {op['missing']} already in place or missing" if op["missing"] else "") + "\n")
+    logging.info("%s journal operation %s: %s moved, %s skipped", verb, op["id"], op["moved"], op["missing"])
+    return op
 
 
-def undo_last_action(folder_path, text_widget=None):
-    """Undo the last rename or move operation."""
-    UNDO_FILE = "undo.json"
+@instrumented
+def undo_last_action(folder_path, text_widget=None, sink=None):
+    """Undo the last rename or move operation in this folder. Repeated calls step further back."""
+    sink = sink or make_sink(text_widget)
     try:
-        if not os.path.exists(UNDO_FILE):
-            output = "No actions to undo.\n"
-            if text_widget:
-                text_widget.insert('end', output)
-            else:
-                print(output)
-            logging.info("No undo log found")
-            return
-        with open(UNDO_FILE, "r") as f:
-            undo_log = json.load(f)
-        for dst, src in undo_log:
-            if os.path.exists(dst):
-                os.rename(dst, src)
-                output = f"Undid: {os.path.basename(dst)} -> {os.path.basename(src)}\n"
-                if text_widget:
-                    text_widget.insert('end', output)
-                else:
-                    print(output)
-                logging.info(f"Undid: {dst} -> {src}")
-        os.remove(UNDO_FILE)
-        logging.info("Cleared undo log")
+        return _replay_journal(folder_path, False, sink)
     except Exception as e:
-        output = f"Error undoing action: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in undo_last_action: {str(e)}")
+        sink.emit(error(f"Error undoing action: {str(e)}\n"))
+        logging.error("Error in undo_last_action: %s", e)
+    finally:
+        sink.flush()
 
 
-def organize_by_timestamp(folder_path, text_widget=None):
-    """Organize files into folders based on creation timestamp. Prevents overwriting files."""
+@instrumented
+def redo_last_action(folder_path, text_widget=None, sink=None):
+    """Redo the most recently undone operation in this folder."""
+    sink = sink or make_sink(text_widget)
     try:
-        UNDO_FILE = "undo.json"
-        undo_log = []
-        files = os.listdir(folder_path)
-        for i, filename in enumerate(files):
-            src = os.path.join(folder_path, filename)
-            if os.path.isfile(src):
-                name, ext = os.path.splitext(filename)
-                if ext.lower() in SUPPORTED_EXTENSIONS:
-                    ctime = os.path.getctime(src)
-                    date_folder = datetime.datetime.fromtimestamp(ctime).strftime('%Y-%m-%d')
-                    dest_folder = os.path.join(folder_path, date_folder)
-                    os.makedirs(dest_folder, exist_ok=True)
-                    dst = os.path.join(dest_folder, filename)
-                    if os.path.exists(dst):
-                        output = f"[SKIP] {filename} -> {dest_folder} (Target exists, skipping to prevent overwrite)\n"
-                        if text_widget:
-                            text_widget.insert('end', output)
-                        else:
-                            print(output)
-                        logging.warning(f"Skipping move {filename} -> {dst} (target exists)")
-                        continue
-                    shutil.move(src, dst)
-                    undo_log.append((dst, src))
-                    output = f"Moved: {filename} -> {dest_folder}\n"
-                    if text_widget:
-                        text_widget.insert('end', output)
-                    else:
-                        print(output)
-                    logging.info(f"Moved: {filename} -> {dest_folder}")
-            if text_widget:
-                progress = (i + 1) / len(files) * 100
-                text_widget.master.children['!progressbar']['value'] = progress
-                text_widget.master.update()
-        with open(UNDO_FILE, "w") as f:
-            json.dump(undo_log, f)
-        logging.info("Saved undo log")
-        output = " Files organized by creation date.\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.info("Files organized by creation date")
+        return _replay_journal(folder_path, True, sink)
     except Exception as e:
-        output = f"Error organizing files: {str(e)}\n"
-        if text_widget:
-            text_widget.insert('end', output)
-        else:
-            print(output)
-        logging.error(f"Error in organize_by_timestamp: {str(e)}")
+        sink.emit(error(f"Error redoing action: {str(e)}\n"))
+        logging.error("Error in redo_last_action: %s", e)
+    finally:
+        sink.flush()
+
+
+@instrumented
+def apply_plan_file(plan_path, text_widget=None, progress_callback=None, sink=None):
+    """Apply a plan file written by a preview or organize, skipping files that changed since it was made."""
+    sink = sink or make_sink(text_widget)
+
+    def on_move(action, src, dst):
+        kind = "renamed" if action == "rename" else "moved"
+        sink.emit(ResultRecord(kind, src, dst))
+        logging.info("%s: %s -> %s", kind.capitalize(), src, dst, extra={"file_event": kind})
+
+    def on_skip(action, src, dst, reason):
+        sink.emit(ResultRecord("skip", src, dst, reason))
+        logging.warning("Skipping move %s -> %s (%s)", src, dst, reason, extra={"file_event": "skipped"})
+
+    try:
+        results = apply_plan(plan_path, as_reporter(progress_callback), on_move, on_skip)
+        for result in results:
+            sink.write(f" Applied {result['action']} plan to {result['folder']}: {result['moved']} files moved"
+                       + (f", {result['skipped']} skipped" if result["skipped"] else "") + "\n")
+            logging.info("Applied %s plan to %s: %s moved, %s skipped", result["action"], result["folder"],
+                         result["moved"], result["skipped"])
+        return results
+    except OperationCancelled:
+        _report_cancelled(sink, "Apply cancelled; the files moved so far can be undone.")
+        return []
+    except Exception as e:
+        sink.emit(error(f"Error applying plan: {str(e)}\n"))
+        logging.error("Error in apply_plan_file: %s", e)
+        return []
+    finally:
+        sink.flush()
+
+
+@instrumented
+def organize_by_timestamp(folder_path, text_widget=None, snapshot=None, sink=None, progress_callback=None,
+                          bucket_key=DEFAULT_BUCKET_KEY, dest_root=None, plan_writer=None):
+    """Organize files into folders based on creation timestamp. Prevents overwriting files.
+
+    `bucket_key` picks the folder for each file: "ctime", "mtime" or "birthtime" with ":day", ":month" or
+    ":year", "extension", or any callable taking a FileEntry. Folders are created under `dest_root`
+    (default: the folder itself). With a plans.PlanWriter as `plan_writer`, the moves are written to the plan file
+    instead of being made.
+    """
+    sink = sink or make_sink(text_widget)
+    try:
+        dest_root = dest_root or folder_path
+        snapshot = get_snapshot(folder_path, snapshot)
+        # Only files directly inside the folder are organized.
+        files = snapshot.table().select(SUPPORTED_EXTENSIONS, top_level=snapshot.recursive)
+        if plan_writer is None:
+            os.makedirs(dest_root, exist_ok=True)
+        plan = plan_organize(files.entries(), dest_root, bucket_labels(files, bucket_key))
+        for entry, bucket, reason in plan.skipped:
+            sink.emit(ResultRecord("skip", entry.name, bucket, reason))
+            logging.warning("Skipping move %s -> %s (%s)", entry.name, bucket, reason,
+                            extra={"file_event": "skipped"})
+        description = f"{len(plan.moves)} files by {describe_bucket_key(bucket_key)}"
+        if plan_writer is not None:
+            add_organize_plan(plan_writer, folder_path, dest_root, plan, description)
+            sink.write(f" Organize plan for {description} written to {plan_writer.path}.\n")
+            logging.info("Wrote organize plan for %s to %s", description, plan_writer.path)
+            return
+        if plan.moves:
+            with Journal(folder_path).begin("organize", description) as op:
+                execute_organize(plan, dest_root, op, as_reporter(progress_callback),
+                                 on_move=lambda entry, bucket: sink.emit(ResultRecord("moved", entry.name, bucket)))
+        logging.info("Saved undo journal")
+        sink.write(f" Files organized by {describe_bucket_key(bucket_key)}.\n")
+        logging.info("Files organized by %s", describe_bucket_key(bucket_key))
+    except OperationCancelled:
+        _report_cancelled(sink, "Organize cancelled; the files moved so far can be undone.")
+    except Exception as e:
+        sink.emit(error(f"Error organizing files: {str(e)}\n"))
+        logging.error("Error in organize_by_timestamp: %s", e)
+    finally:
+        sink.flush()
+
+
+def iter_operation(func, *args, **kwargs):
+    """Run a file operation that changes files on a worker thread and yield its records as it emits them.
+
+    `func` is one of the sink-based functions above; the generator's return value (StopIteration.value) is
+    what `func` returned. Closing the generator early does not stop the operation half-way: it finishes
+    first. To stop it, pass a ProgressReporter with a cancel event as `progress_callback`.
+    """
+    records = queue.Queue()
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = func(*args, sink=QueueSink(records, batch_size=1), **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            records.put(None)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = records.get()
+            if item is None:
+                break
+            yield from item[1]
+    finally:
+        thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome.get("result")
+
+
+def iter_backup(folder_path, **kwargs):
+    """Generator version of backup_files."""
+    return iter_operation(backup_files, folder_path, **kwargs)
+
+
+def iter_renames(folder_path, patterns, replacement, changes, **kwargs):
+    """Generator version of replace_text_in_filenames: `skip` and `renamed` records."""
+    return iter_operation(replace_text_in_filenames, folder_path, patterns, replacement, changes, **kwargs)
+
+
+def iter_organize(folder_path, **kwargs):
+    """Generator version of organize_by_timestamp: `skip` and `moved` records."""
+    return iter_operation(organize_by_timestamp, folder_path, **kwargs)
+
+
+def iter_undo(folder_path):
+    """Generator version of undo_last_action: one `undone` record per file moved back."""
+    return iter_operation(undo_last_action, folder_path)
+
+
+def iter_redo(folder_path):
+    """Generator version of redo_last_action."""
+    return iter_operation(redo_last_action, folder_path)
+
+
+def iter_apply_plan(plan_path, **kwargs):
+    """Generator version of apply_plan_file: `renamed`, `moved` and `skip` records."""
+    return iter_operation(apply_plan_file, plan_path, **kwargs)
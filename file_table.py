@@ -0,0 +1,228 @@
+import os
+from array import array
+from itertools import accumulate, compress, groupby
+from operator import attrgetter
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional: without NumPy the same operations run over `array` columns with C-level builtins.
+    np = None
+
+# Column name -> array typecode. The typecodes double as NumPy dtype codes for zero-copy views.
+COLUMNS = {"start": "Q", "length": "I", "dir_length": "I", "stem_length": "I", "ext": "I", "root": "I",
+           "is_dir": "B", "size": "q", "mtime": "d", "ctime": "d", "birthtime": "d", "has_birthtime": "B",
+           "ino": "Q", "dev": "Q"}
+
+
+class FileTable:
+    """Column-oriented index over FileEntry rows, for filtering and grouping without per-file Python work.
+
+    The columns are the only storage. Relative paths share one string pool (offsets and lengths per row, the
+    length of the directory part, and the stem length so name, stem and extension are split once); extensions
+    and the directories that full paths start with are interned as integer codes into `extensions` and `roots`;
+    sizes, timestamps, inodes and devices are typed `array` columns. `birthtime` falls back to ctime where the
+    platform has none. FileEntry records are only built for the rows an operation asks for (`entry`,
+    `entries`, `size_groups`).
+    """
+
+    def __init__(self, entries):
+        entries = entries if isinstance(entries, list) else list(entries)
+        rel_paths = [e.rel_path for e in entries]
+        names = [e.name for e in entries]
+        exts = [os.path.splitext(n)[1] for n in names]
+        self.pool = "\0".join(rel_paths)
+        self.extensions = []
+        self._codes = {}
+        self.roots = []
+        self._root_codes = {}
+        self.start = array("Q", accumulate((len(p) + 1 for p in rel_paths), initial=0))[:len(rel_paths)]
+        self.length = array("I", map(len, rel_paths))
+        self.dir_length = array("I", (len(p) - len(n) for p, n in zip(rel_paths, names)))
+        self.stem_length = array("I", (len(n) - len(x) for n, x in zip(names, exts)))
+        self.ext = array("I", map(self.ext_code, map(str.lower, exts)))
+        # Full paths are their directory (as listed, interned once per directory) followed by the name.
+        self.root = array("I", (self._root_code(e.path[:len(e.path) - len(e.name)]) for e in entries))
+        self.is_dir = array("B", map(attrgetter("is_dir"), entries))
+        self.size = array("q", map(attrgetter("size"), entries))
+        self.mtime = array("d", map(attrgetter("mtime"), entries))
+        self.ctime = array("d", map(attrgetter("ctime"), entries))
+        self.birthtime = array("d", (e.ctime if e.birthtime is None else e.birthtime for e in entries))
+        self.has_birthtime = array("B", (e.birthtime is not None for e in entries))
+        self.ino = array("Q", map(attrgetter("ino"), entries))
+        self.dev = array("Q", map(attrgetter("dev"), entries))
+
+    def __len__(self):
+        return len(self.start)
+
+    def _root_code(self, root):
+        code = self._root_codes.get(root)
+        if code is None:
+            code = self._root_codes[root] = len(self.roots)
+            self.roots.append(root)
+        return code
+
+    def ext_code(self, ext):
+        """Interned code of a lowercased extension (with its dot, "" for none)."""
+        code = self._codes.get(ext)
+        if code is None:
+            code = self._codes[ext] = len(self.extensions)
+            self.extensions.append(ext)
+        return code
+
+    def column(self, name):
+        """A column as a NumPy view when NumPy is available, otherwise the `array` itself."""
+        values = getattr(self, name)
+        return np.frombuffer(values, dtype=values.typecode) if np is not None and len(values) else values
+
+    def take(self, indices):
+        """New table with the rows at `indices`, sharing this table's name pool and extension codes."""
+        indices = indices.tolist() if np is not None and isinstance(indices, np.ndarray) else list(indices)
+        table = FileTable.__new__(FileTable)
+        table.pool = self.pool
+        table.extensions = self.extensions
+        table._codes = self._codes
+        table.roots = self.roots
+        table._root_codes = self._root_codes
+        for name, typecode in COLUMNS.items():
+            setattr(table, name, array(typecode, map(getattr(self, name).__getitem__, indices)))
+        return table
+
+    def select(self, extensions=None, files_only=True, nonempty=False, top_level=False):
+        """Rows that are files (unless not `files_only`), non-empty if `nonempty`, directly in the listed
+        folder if `top_level`, with a lowercased extension in `extensions` if given."""
+        n = len(self)
+        if n == 0:
+            return self
+        if np is not None:
+            mask = np.ones(n, dtype=bool)
+            if extensions is not None:
+                mask &= np.isin(self.column("ext"), [self._codes[x] for x in extensions if x in self._codes])
+            if files_only:
+                mask &= self.column("is_dir") == 0
+            if nonempty:
+                mask &= self.column("size") > 0
+            if top_level:
+                mask &= self.column("dir_length") == 0
+            return self.take(np.flatnonzero(mask))
+        masks = []
+        if extensions is not None:
+            wanted = bytearray(len(self.extensions))
+            for ext in extensions:
+                if ext in self._codes:
+                    wanted[self._codes[ext]] = 1
+            masks.append(map(wanted.__getitem__, self.ext))
+        if files_only:
+            masks.append(map((1).__gt__, self.is_dir))
+        if nonempty:
+            masks.append(map((0).__lt__, self.size))
+        if top_level:
+            masks.append(map((0).__eq__, self.dir_length))
+        if not masks:
+            return self
+        return self.take(compress(range(n), masks[0] if len(masks) == 1 else map(all, zip(*masks))))
+
+    def rel_paths(self):
+        pool = self.pool
+        return [pool[s:s + n] for s, n in zip(self.start, self.length)]
+
+    def names(self):
+        pool = self.pool
+        return [pool[s + d:s + n] for s, d, n in zip(self.start, self.dir_length, self.length)]
+
+    def stems(self):
+        pool = self.pool
+        return [pool[s + d:s + d + k] for s, d, k in zip(self.start, self.dir_length, self.stem_length)]
+
+    def split_names(self):
+        """(stem, extension) per row, with the extension in its original case."""
+        pool = self.pool
+        return [(pool[s + d:s + d + k], pool[s + d + k:s + n])
+                for s, d, k, n in zip(self.start, self.dir_length, self.stem_length, self.length)]
+
+    def entry(self, index):
+        """FileEntry record of one row."""
+        return self._build((index,))[0]
+
+    def entries(self):
+        """FileEntry records of every row, built on demand (the table does not keep them)."""
+        return self._build(range(len(self)))
+
+    def _build(self, indices):
+        # Imported here: scanner builds its tables from this module.
+        from scanner import FileEntry
+        pool, roots = self.pool, self.roots
+        rows = []
+        for i in indices:
+            s, d, n = self.start[i], self.dir_length[i], self.length[i]
+            rel_path = pool[s:s + n]
+            name = pool[s + d:s + n]
+            rows.append(FileEntry(name, roots[self.root[i]] + name, rel_path, bool(self.is_dir[i]), self.size[i],
+                                  self.mtime[i], self.ctime[i], self.ino[i], self.dev[i],
+                                  self.birthtime[i] if self.has_birthtime[i] else None))
+        return rows
+
+    def distinct_inodes(self):
+        """Drop rows that are further hard links to an inode already in the table (the first one is kept)."""
+        n = len(self)
+        if n == 0:
+            return self
+        if np is not None:
+            ino = self.column("ino")
+            _, first = np.unique(np.stack([self.column("dev"), ino], axis=1), axis=0, return_index=True)
+            keep = np.zeros(n, dtype=bool)
+            keep[first] = True
+            # Inode 0 means "unknown" (some Windows filesystems): those rows are always kept.
+            keep |= ino == 0
+            return self.take(np.flatnonzero(keep))
+        # Assigning in reverse leaves each key mapped to its first row.
+        first = dict(zip(zip(reversed(self.dev), reversed(self.ino)), range(n - 1, -1, -1)))
+        keep = set(first.values())
+        keep.update(compress(range(n), map((0).__eq__, self.ino)))
+        return self.take(sorted(keep))
+
+    def size_groups(self):
+        """Lists of entries sharing a size, for sizes held by more than one row; rows keep table order."""
+        n = len(self)
+        if n < 2:
+            return []
+        if np is not None:
+            sizes = self.column("size")
+            _, inverse, counts = np.unique(sizes, return_inverse=True, return_counts=True)
+            shared = np.flatnonzero(counts[inverse] > 1)
+            if not len(shared):
+                return []
+            order = shared[np.argsort(sizes[shared], kind="stable")]
+            bounds = np.flatnonzero(np.diff(sizes[order])) + 1
+            return [self._build(part.tolist()) for part in np.split(order, bounds)]
+        order = sorted(range(n), key=self.size.__getitem__)
+        groups = []
+        for _, rows in groupby(order, key=self.size.__getitem__):
+            rows = list(rows)
+            if len(rows) > 1:
+                groups.append(self._build(rows))
+        return groups
+
+    def slot_labels(self, name, width, label):
+        """Label every row by the `width`-wide slot its `name` column falls in; `label(slot_start)` runs once
+        per distinct slot rather than once per row."""
+        if not len(self):
+            return []
+        if np is not None:
+            slots, inverse = np.unique(np.floor_divide(self.column(name), width), return_inverse=True)
+            labels = [label(slot * width) for slot in slots.tolist()]
+            return list(map(labels.__getitem__, inverse.ravel().tolist()))
+        cache = {}
+
+        def lookup(value):
+            slot = value // width
+            result = cache.get(slot)
+            if result is None:
+                result = cache[slot] = label(slot * width)
+            return result
+        return list(map(lookup, getattr(self, name)))
+
+    def ext_labels(self, label):
+        """Label every row by its extension; `label(ext)` runs once per distinct extension."""
+        labels = [label(ext) for ext in self.extensions]
+        return list(map(labels.__getitem__, self.ext))
@@ -0,0 +1,156 @@
+import os
+import re
+import zlib
+import random
+from collections import namedtuple
+from progress import start
+
+NGRAM = 3
+NUM_PERM = 32
+# 8 bands of 4 rows: titles with a Jaccard similarity around 0.6 share a band about half the time, 0.8 almost always.
+BANDS = 8
+DEFAULT_THRESHOLD = 0.6
+# Buckets larger than this are chained instead of compared pairwise, so one popular title cannot go quadratic.
+MAX_BUCKET = 64
+_PRIME = (1 << 61) - 1
+
+_TAG = re.compile(r"[\[({][^\])}]*[\])}]")
+_QUALITY = re.compile(r"\b\d{3,4}p\b")
+_TOKEN = re.compile(r"\d+|[^\W\d_]+")
+
+# Cluster of near-duplicate files: the lowest similarity that links it, a normalized title, and the entries.
+FuzzyGroup = namedtuple("FuzzyGroup", ["score", "title", "entries"])
+
+
+def normalize_title(stem):
+    """Reduce a filename stem to (text, numbers) for comparison.
+
+    Case, bracketed tags like "(1)" or "[720p]", resolution tags, separators, leading zeros and word order are
+    ignored, so "Lesson 05 - Intro (1)" and "05 lesson intro [720p]" both become ("5 intro lesson", (5,)).
+    The numbers are kept apart because titles that differ only in their lesson number are different files.
+    """
+    text = _QUALITY.sub(" ", _TAG.sub(" ", stem.lower()))
+    tokens = [str(int(t)) if t.isdigit() else t for t in _TOKEN.findall(text)]
+    numbers = tuple(sorted(int(t) for t in tokens if t.isdigit()))
+    return " ".join(sorted(tokens)), numbers
+
+
+def shingles(word, n=NGRAM):
+    """Character n-grams of one word, padded so short words and word boundaries count."""
+    padded = f" {word} "
+    return frozenset(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+
+
+class MinHasher:
+    """MinHash signatures over the character n-grams of a title's words.
+
+    Word order is already normalized away, so a title's n-grams are the union of its words' n-grams, and
+    its signature is the element-wise minimum of its words' signatures. Those are computed once per distinct
+    word, which keeps the per-title cost at a `map(min, zip(...))` over a handful of rows.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = random.Random(seed)
+        self._params = [(rng.randrange(1, _PRIME), rng.randrange(_PRIME)) for _ in range(num_perm)]
+        self._words = {}
+
+    def word(self, word):
+        """(n-grams, signature) of one word, cached."""
+        cached = self._words.get(word)
+        if cached is None:
+            grams = shingles(word)
+            rows = []
+            for gram in grams:
+                x = zlib.crc32(gram.encode("utf-8"))
+                rows.append([(a * x + b) % _PRIME for a, b in self._params])
+            cached = self._words[word] = (grams, tuple(map(min, zip(*rows))))
+        return cached
+
+    def signature(self, text):
+        """Signature of a normalized title."""
+        words = [self.word(w)[1] for w in text.split()] or [self.word("")[1]]
+        return words[0] if len(words) == 1 else tuple(map(min, zip(*words)))
+
+    def grams(self, text):
+        """N-gram set of a normalized title."""
+        return frozenset().union(*(self.word(w)[0] for w in text.split() or [""]))
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def _candidate_pairs(members):
+    if len(members) <= MAX_BUCKET:
+        return ((a, b) for i, a in enumerate(members) for b in members[i + 1:])
+    # Chain large buckets: neighbours plus the first member, enough to connect a cluster.
+    return [(members[i], members[i + 1]) for i in range(len(members) - 1)] + [(members[0], m) for m in members[2:]]
+
+
+def find_fuzzy_duplicates(entries, threshold=DEFAULT_THRESHOLD, progress=None, bands=BANDS):
+    """Cluster entries whose normalized titles are at least `threshold` similar (Jaccard over n-grams).
+
+    Only titles that share an LSH band and the same numbers are compared, so the work grows with the number
+    of files rather than the number of pairs. Returns FuzzyGroups, largest first.
+    """
+    by_title = {}
+    for entry in entries:
+        by_title.setdefault(normalize_title(os.path.splitext(entry.name)[0]), []).append(entry)
+    keys = list(by_title)
+    hasher = MinHasher()
+    rows = NUM_PERM // bands
+    buckets = {}
+    start(progress, "fuzzy", len(keys))
+    for index, (text, numbers) in enumerate(keys):
+        signature = hasher.signature(text)
+        for band in range(bands):
+            buckets.setdefault((band, numbers, signature[band * rows:(band + 1) * rows]), []).append(index)
+        if progress:
+            progress.advance()
+
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # N-gram sets are only built for titles that land in a shared bucket.
+    grams = {}
+
+    def title_grams(i):
+        result = grams.get(i)
+        if result is None:
+            result = grams[i] = hasher.grams(keys[i][0])
+        return result
+
+    checked = set()
+    links = []
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        for a, b in _candidate_pairs(members):
+            if (a, b) in checked:
+                continue
+            checked.add((a, b))
+            similarity = jaccard(title_grams(a), title_grams(b))
+            if similarity >= threshold:
+                links.append((a, b, similarity))
+                parent[find(a)] = find(b)
+
+    clusters = {}
+    for index in range(len(keys)):
+        clusters.setdefault(find(index), []).append(index)
+    scores = {}
+    for a, _, similarity in links:
+        root = find(a)
+        scores[root] = min(scores.get(root, 1.0), similarity)
+    groups = []
+    for root, members in clusters.items():
+        files = [entry for index in members for entry in by_title[keys[index]]]
+        if len(files) > 1:
+            files.sort(key=lambda e: e.rel_path)
+            groups.append(FuzzyGroup(round(scores.get(root, 1.0), 3), keys[members[0]][0], files))
+    groups.sort(key=lambda g: (-len(g.entries), -g.score, g.title))
+    return groups
@@ -1,10 +1,22 @@
 import tkinter as tk
 import os
+import time
 from tkinter import filedialog, scrolledtext, messagebox, ttk
-from utils import load_config, save_config
+from utils import load_config, save_config, get_setting, save_setting
+from backup import BACKUP_MODES
+from organizer import DEFAULT_BUCKET_KEY, ORGANIZE_KEYS
+from scanner import scan_folder
+from catalog import open_catalog
+from progress import format_event
+from worker import BackgroundTask
+from sinks import format_record
+from results_view import ResultsView
+from metrics import registry as metrics
+from live_preview import LivePreview, DEBOUNCE_MS
 from file_ops import (
-    get_video_titles, backup_files, detect_duplicates, validate_regex,
-    preview_changes, replace_text_in_filenames, organize_by_timestamp, undo_last_action
+    get_video_titles, backup_files, detect_duplicates, detect_content_duplicates, validate_regex,
+    preview_changes, replace_text_in_filenames, organize_by_timestamp, undo_last_action, redo_last_action,
+    media_report
 )
 
 def print_welcome_note(text_widget=None):
@@ -28,9 +40,13 @@ def create_gui():
     window.title("File Manager - Practical Edition")
     window.geometry("700x600")
     window.resizable(True, True)
+    catalog = open_catalog()
     folder_path_var = tk.StringVar(value=load_config())
     patterns_var = tk.StringVar()
     replacement_var = tk.StringVar()
+    live_var = tk.BooleanVar(value=False)
+    backup_mode_var = tk.StringVar(value=get_setting("backup_mode", "copy"))
+    organize_key_var = tk.StringVar(value=get_setting("organize_key", DEFAULT_BUCKET_KEY))
     folder_frame = tk.Frame(window)
     folder_frame.pack(pady=10, fill=tk.X)
     tk.Label(folder_frame, text="Folder Path:").pack(side=tk.LEFT)
@@ -42,53 +58,160 @@ def create_gui():
     tk.Entry(input_frame, textvariable=patterns_var, width=70).pack(pady=5, fill=tk.X)
     tk.Label(input_frame, text="Replacement Text (for option 2):").pack(anchor='w')
     tk.Entry(input_frame, textvariable=replacement_var, width=70).pack(pady=5, fill=tk.X)
+    tk.Checkbutton(input_frame, text="Live preview (empty replacement previews removal)", variable=live_var).pack(anchor='w')
+    tk.Label(input_frame, text="Backup Mode:").pack(anchor='w')
+    ttk.Combobox(input_frame, textvariable=backup_mode_var, values=BACKUP_MODES, state="readonly", width=12).pack(anchor='w', pady=5)
+    tk.Label(input_frame, text="Organize By:").pack(anchor='w')
+    ttk.Combobox(input_frame, textvariable=organize_key_var, values=ORGANIZE_KEYS, state="readonly", width=16).pack(anchor='w', pady=5)
     progress_bar = ttk.Progressbar(window, maximum=100)
     progress_bar.pack(pady=5, fill=tk.X)
-    output_text = scrolledtext.ScrolledText(window, width=90, height=18, wrap=tk.WORD)
-    output_text.pack(pady=10, fill=tk.BOTH, expand=True)
+    status_var = tk.StringVar()
+    tk.Label(window, textvariable=status_var, anchor='w').pack(fill=tk.X)
+    filter_var = tk.StringVar()
+    filter_frame = tk.Frame(window)
+    filter_frame.pack(fill=tk.X)
+    tk.Label(filter_frame, text="Filter results:").pack(side=tk.LEFT)
+    tk.Entry(filter_frame, textvariable=filter_var, width=40).pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+    results_view = ResultsView(window)
+    results_view.pack(pady=5, fill=tk.BOTH, expand=True)
+    filter_var.trace_add("write", lambda *args: results_view.set_filter(filter_var.get()))
+    output_text = scrolledtext.ScrolledText(window, width=90, height=6, wrap=tk.WORD)
+    output_text.pack(pady=5, fill=tk.X)
+    def show_progress(event):
+        progress_bar['value'] = event.percent or 0
+        status_var.set(format_event(event))
+    def reset_progress():
+        progress_bar['value'] = 0
+        status_var.set("")
+    # Operations run on a worker thread; output and progress are pumped back into the widgets with after().
+    def show_records(records):
+        # Messages and errors go to the log pane; per-file results go to the paged table.
+        with metrics.span("ui update"):
+            rows = []
+            for record in records:
+                if record.kind in ("message", "error"):
+                    output_text.insert(tk.END, format_record(record))
+                else:
+                    rows.append(record)
+            if rows:
+                results_view.append(rows)
+    task = BackgroundTask(window, on_output=show_records, on_progress=show_progress, on_idle=reset_progress)
+    def cancel_action():
+        if task.busy:
+            task.cancel()
+            status_var.set("Cancelling after the current file...")
+    live = {"preview": None, "pending": None}
+    def parse_patterns():
+        return [p.strip() for p in patterns_var.get().split(',') if p.strip()]
+    def update_live_preview():
+        live["pending"] = None
+        folder_path = folder_path_var.get()
+        if not live_var.get() or task.busy or not folder_path or not os.path.isdir(folder_path):
+            return
+        if live["preview"] is None or not live["preview"].matches(folder_path):
+            live["preview"] = LivePreview(folder_path)
+        replacement = replacement_var.get()
+        started = time.perf_counter()
+        records = live["preview"].preview(parse_patterns(), replacement, remove_mode=not replacement)
+        results_view.clear()
+        if records is None:
+            status_var.set("Live preview: invalid regex pattern")
+            return
+        results_view.append(records)
+        changes = sum(1 for r in records if r.kind == "change")
+        status_var.set(f"Live preview: {changes} changes, {len(records) - changes} skipped "
+                       f"({(time.perf_counter() - started) * 1000:.0f} ms)")
+    def schedule_live_preview(*args):
+        # Debounce keystrokes: only the last edit within DEBOUNCE_MS triggers a recompute.
+        if live["pending"] is not None:
+            window.after_cancel(live["pending"])
+        live["pending"] = window.after(DEBOUNCE_MS, update_live_preview)
+    for var in (patterns_var, replacement_var, live_var, folder_path_var):
+        var.trace_add("write", schedule_live_preview)
     def run_action(action, remove_mode=False):
+        if task.busy:
+            messagebox.showinfo("Busy", "Another operation is running. Wait for it to finish or cancel it.")
+            return
         folder_path = folder_path_var.get()
         if not folder_path or not os.path.isdir(folder_path):
             messagebox.showerror("Error", "Please select a valid folder path.")
             return
         save_config(folder_path)
         output_text.delete(1.0, tk.END)
-        progress_bar['value'] = 0
-        window.update()
-        def update_progress(val):
-            progress_bar['value'] = val
-            window.update_idletasks()
-        if messagebox.askyesno("Backup", "Create a backup before proceeding?"):
-            backup_files(folder_path, output_text, progress_callback=update_progress)
-        if action == "scrape":
-            get_video_titles(folder_path, output_text, progress_callback=update_progress)
-        elif action in ["replace", "remove"]:
-            patterns = [p.strip() for p in patterns_var.get().split(',') if p.strip()]
+        results_view.clear()
+        reset_progress()
+        # Any action may change the folder, so the live preview lists it again next time.
+        live["preview"] = None
+        sink, progress = task.sink, task.progress
+        if action in ["replace", "remove"]:
+            patterns = parse_patterns()
             if not patterns:
                 messagebox.showerror("Error", "Please enter at least one regex pattern.")
                 return
             if not validate_regex(patterns, output_text):
                 return
             replacement = replacement_var.get() if action == "replace" else ""
-            if not detect_duplicates(folder_path, output_text, progress_callback=update_progress):
-                if not messagebox.askyesno("Warning", "Duplicates found. Proceed anyway?"):
+        backup = action not in ("dupes", "report", "undo", "redo") and messagebox.askyesno("Backup", "Create a backup before proceeding?")
+        if backup:
+            save_setting("backup_mode", backup_mode_var.get())
+        def prepare():
+            snapshot = scan_folder(folder_path)
+            if backup:
+                backup_files(folder_path, progress_callback=progress, snapshot=snapshot, mode=backup_mode_var.get(),
+                             repository=get_setting("backup_repository"), catalog=catalog, sink=sink)
+            return snapshot
+        if action == "scrape":
+            task.submit(lambda: get_video_titles(folder_path, progress_callback=progress, snapshot=prepare(), sink=sink))
+        elif action in ["replace", "remove"]:
+            def check_duplicates():
+                snapshot = prepare()
+                return snapshot, detect_duplicates(folder_path, progress_callback=progress, snapshot=snapshot, sink=sink)
+            def after_check(result):
+                snapshot, unique = result
+                if not unique and not messagebox.askyesno("Warning", "Duplicates found. Proceed anyway?"):
                     return
-            changes = preview_changes(folder_path, patterns, replacement, remove_mode, output_text, progress_callback=update_progress)
-            if changes and messagebox.askyesno("Confirm", "Apply these changes?"):
-                replace_text_in_filenames(folder_path, patterns, replacement, changes, output_text, progress_callback=update_progress)
-                output_text.insert(tk.END, f" {'Text replacement' if action == 'replace' else 'Text removal'} completed.\n")
+                task.submit(lambda: preview_changes(folder_path, patterns, replacement, remove_mode,
+                                                    progress_callback=progress, snapshot=snapshot, sink=sink),
+                            after_preview)
+            def after_preview(changes):
+                if changes and messagebox.askyesno("Confirm", "Apply these changes?"):
+                    task.submit(lambda: replace_text_in_filenames(folder_path, patterns, replacement, changes,
+                                                                  progress_callback=progress, sink=sink),
+                                lambda _: output_text.insert(tk.END, f" {'Text replacement' if action == 'replace' else 'Text removal'} completed.\n"))
+            task.submit(check_duplicates, after_check)
+        elif action == "dupes":
+            task.submit(lambda: detect_content_duplicates(folder_path, progress_callback=progress, snapshot=prepare(),
+                                                          catalog=catalog, sink=sink))
+        elif action == "report":
+            task.submit(lambda: media_report(folder_path, progress_callback=progress, snapshot=prepare(), catalog=catalog,
+                                             sink=sink))
         elif action == "organize":
-            organize_by_timestamp(folder_path, output_text)
+            save_setting("organize_key", organize_key_var.get())
+            bucket_key = organize_key_var.get()
+            task.submit(lambda: organize_by_timestamp(folder_path, snapshot=prepare(), progress_callback=progress,
+                                                      bucket_key=bucket_key, sink=sink))
         elif action == "undo":
-            undo_last_action(folder_path, output_text)
-        progress_bar['value'] = 0
+            task.submit(lambda: undo_last_action(folder_path, sink=sink))
+        elif action == "redo":
+            task.submit(lambda: redo_last_action(folder_path, sink=sink))
+    def exit_app():
+        task.cancel()
+        window.quit()
     button_frame = tk.Frame(window)
     button_frame.pack(pady=10, fill=tk.X)
     tk.Button(button_frame, text="Scrape File Titles", command=lambda: run_action("scrape"), width=18).pack(side=tk.LEFT, padx=5)
     tk.Button(button_frame, text="Replace Text", command=lambda: run_action("replace"), width=18).pack(side=tk.LEFT, padx=5)
     tk.Button(button_frame, text="Remove Text", command=lambda: run_action("remove", True), width=18).pack(side=tk.LEFT, padx=5)
-    tk.Button(button_frame, text="Organize by Date", command=lambda: run_action("organize"), width=18).pack(side=tk.LEFT, padx=5)
+    tk.Button(button_frame, text="Organize Files", command=lambda: run_action("organize"), width=18).pack(side=tk.LEFT, padx=5)
     tk.Button(button_frame, text="Undo Last Action", command=lambda: run_action("undo"), width=18).pack(side=tk.LEFT, padx=5)
-    tk.Button(button_frame, text="Exit", command=window.quit, width=10).pack(side=tk.RIGHT, padx=5)
+    tk.Button(button_frame, text="Redo", command=lambda: run_action("redo"), width=10).pack(side=tk.LEFT, padx=5)
+    tk.Button(button_frame, text="Find Duplicates", command=lambda: run_action("dupes"), width=18).pack(side=tk.LEFT, padx=5)
+    tk.Button(button_frame, text="Course Report", command=lambda: run_action("report"), width=18).pack(side=tk.LEFT, padx=5)
+    tk.Button(button_frame, text="Exit", command=exit_app, width=10).pack(side=tk.RIGHT, padx=5)
+    tk.Button(button_frame, text="Cancel", command=cancel_action, width=10).pack(side=tk.RIGHT, padx=5)
     print_welcome_note(output_text)
     window.mainloop()
+    # Let a cancelled operation reach its file boundary so its journal is closed before exiting.
+    task.join()
+    if catalog:
+        catalog.close()
@@ -0,0 +1,269 @@
+import os
+import json
+import errno
+import shutil
+import time
+import logging
+from scanner import JOURNAL_DIR
+from progress import OperationCancelled
+from metrics import registry as metrics
+
+# Journals live in a hidden folder inside the managed folder, so undo history follows the folder rather
+# than the process working directory.
+INDEX_FILE = "journal.jsonl"
+FSYNC_EVERY = 256
+UNDO_BATCH = 512
+
+
+def journal_dir(folder_path):
+    return os.path.join(folder_path, JOURNAL_DIR)
+
+
+def _fsync_append(path, line):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_reverse_lines(path, block_size=64 * 1024):
+    """Yield the lines of a file from last to first, reading fixed-size blocks from the end."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.decode("utf-8")
+        if tail.strip():
+            yield tail.decode("utf-8")
+
+
+def _read_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def _parse(lines):
+    # A crash can leave a torn last line; everything before it is intact.
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+class OperationLog:
+    """Write-ahead log of one operation: each move is appended (and periodically fsynced) before it happens."""
+
+    def __init__(self, journal, op_id, path):
+        self.journal = journal
+        self.op_id = op_id
+        self.path = path
+        self.count = 0
+        self._file = open(path, "a", encoding="utf-8")
+        self._unsynced = 0
+
+    def record(self, src, dst):
+        """Log an intended move of absolute path `src` to `dst`. Call before performing it."""
+        self._file.write(json.dumps([src, dst]) + "\n")
+        self.count += 1
+        self._unsynced += 1
+        if self._unsynced >= FSYNC_EVERY:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def commit(self, status="done"):
+        """Close the log and mark the operation finished (`status` may be e.g. "cancelled")."""
+        self.sync()
+        self._file.close()
+        self.journal._append_index({"op": "commit", "id": self.op_id, "status": status, "entries": self.count})
+
+    def abort(self):
+        """Mark an operation whose moves were all rolled back, so it is not offered for undo."""
+        self._file.close()
+        self.journal._append_index({"op": "abort", "id": self.op_id})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._file.closed:
+            if exc_type is None:
+                self.commit("done")
+            else:
+                self.commit("cancelled" if issubclass(exc_type, OperationCancelled) else "interrupted")
+
+
+class Journal:
+    """Per-folder append-only journal of moves with a multi-level undo/redo stack.
+
+    `journal.jsonl` holds one small event per operation state change (begin, commit, abort, undo, redo);
+    each operation's moves are in `op-<id>.jsonl`. Operations interrupted by a crash stay undoable, since
+    their moves were logged before being made.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.dir = journal_dir(folder_path)
+        self.index_path = os.path.join(self.dir, INDEX_FILE)
+
+    def _append_index(self, event):
+        os.makedirs(self.dir, exist_ok=True)
+        event.setdefault("ts", time.time())
+        _fsync_append(self.index_path, json.dumps(event) + "\n")
+
+    def _op_path(self, op_id):
+        return os.path.join(self.dir, f"op-{op_id}.jsonl")
+
+    def begin(self, action, description=""):
+        """Start a new operation and return its OperationLog. Starting one clears the redo stack."""
+        os.makedirs(self.dir, exist_ok=True)
+        op_id = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{int(time.time() * 1e6) % 1000000:06d}"
+        self._append_index({"op": "begin", "id": op_id, "action": action, "description": description})
+        return OperationLog(self, op_id, self._op_path(op_id))
+
+    def _load(self):
+        """Replay the index: return ({id: op}, undo stack ids, redo stack ids), stacks newest last."""
+        ops, undo, redo = {}, [], []
+        if not os.path.exists(self.index_path):
+            return ops, undo, redo
+        for event in _parse(_read_lines(self.index_path)):
+            kind, op_id = event.get("op"), event.get("id")
+            if kind == "begin":
+                ops[op_id] = {"id": op_id, "action": event.get("action"), "description": event.get("description", ""),
+                              "state": "active", "status": "interrupted", "ts": event.get("ts")}
+                undo.append(op_id)
+                # A new operation makes everything undone before it impossible to redo safely.
+                redo = []
+                continue
+            op = ops.get(op_id)
+            if op is None:
+                continue
+            if kind == "commit":
+                op["status"] = event.get("status", "done")
+            elif kind == "abort":
+                op["state"] = "aborted"
+                if op_id in undo:
+                    undo.remove(op_id)
+            elif kind == "undo":
+                op["state"] = "undone"
+                if op_id in undo:
+                    undo.remove(op_id)
+                redo.append(op_id)
+            elif kind == "redo":
+                op["state"] = "active"
+                if op_id in redo:
+                    redo.remove(op_id)
+                undo.append(op_id)
+        return ops, undo, redo
+
+    def operations(self):
+        """Return {id: op} for every operation in journal order. States: active, undone, aborted."""
+        return self._load()[0]
+
+    def undo_stack(self):
+        """Undoable operations, next-to-undo last."""
+        ops, undo, _ = self._load()
+        return [ops[i] for i in undo]
+
+    def redo_stack(self):
+        """Redoable operations, next-to-redo last."""
+        ops, _, redo = self._load()
+        return [ops[i] for i in redo]
+
+    def _replay(self, op_id, reverse, on_move=None):
+        """Apply an operation's moves backwards (undo) or forwards (redo) in batches. Returns (moved, missing)."""
+        path = self._op_path(op_id)
+        if not os.path.exists(path):
+            return 0, 0
+        lines = _read_reverse_lines(path) if reverse else _read_lines(path)
+        moved = missing = 0
+        batch = []
+        with metrics.span("journal replay"):
+            for pair in _parse(lines):
+                batch.append((pair[1], pair[0]) if reverse else (pair[0], pair[1]))
+                if len(batch) >= UNDO_BATCH:
+                    m, x = _apply_batch(batch, on_move)
+                    moved, missing, batch = moved + m, missing + x, []
+            if batch:
+                m, x = _apply_batch(batch, on_move)
+                moved, missing = moved + m, missing + x
+        metrics.count("files_moved", moved)
+        return moved, missing
+
+    def undo(self, on_move=None):
+        """Undo the newest active operation. Returns the operation dict, or None if there is nothing to undo."""
+        stack = self.undo_stack()
+        if not stack:
+            return None
+        op = stack[-1]
+        op["moved"], op["missing"] = self._replay(op["id"], True, on_move)
+        self._append_index({"op": "undo", "id": op["id"]})
+        return op
+
+    def redo(self, on_move=None):
+        """Redo the most recently undone operation. Returns the operation dict, or None."""
+        stack = self.redo_stack()
+        if not stack:
+            return None
+        op = stack[-1]
+        op["moved"], op["missing"] = self._replay(op["id"], False, on_move)
+        self._append_index({"op": "redo", "id": op["id"]})
+        return op
+
+
+def _apply_batch(batch, on_move):
+    """Move each (src, dst) pair whose source exists and whose destination is free.
+
+    Each directory involved is listed once per batch instead of stat-ing every path.
+    """
+    listings = {}
+
+    def names(directory):
+        if directory not in listings:
+            try:
+                listings[directory] = set(os.listdir(directory))
+            except OSError:
+                listings[directory] = set()
+        return listings[directory]
+
+    moved = missing = 0
+    for src, dst in batch:
+        src_dir, src_name = os.path.split(src)
+        dst_dir, dst_name = os.path.split(dst)
+        if src_name not in names(src_dir) or (dst_name in names(dst_dir) and dst != src):
+            # Not moved before a crash, already reverted, or the name has been reused since.
+            missing += 1
+            continue
+        try:
+            os.makedirs(dst_dir, exist_ok=True)
+            try:
+                os.rename(src, dst)
+            except OSError as e:
+                # Moves between devices (organize into another disk) are replayed as copy-then-delete.
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(src, dst)
+        except OSError as e:
+            logging.error("Journal replay failed for %s -> %s: %s", src, dst, e)
+            missing += 1
+            continue
+        names(src_dir).discard(src_name)
+        names(dst_dir).add(dst_name)
+        moved += 1
+        if on_move:
+            on_move(src, dst)
+    return moved, missing
@@ -0,0 +1,55 @@
+from scanner import get_snapshot
+from rules import RenamePipeline
+from planner import name_key
+from file_ops import SUPPORTED_EXTENSIONS, iter_change_records
+
+# Delay after the last keystroke before the GUI recomputes the preview.
+DEBOUNCE_MS = 150
+
+
+class LivePreview:
+    """Rename preview for one folder that is cheap to recompute while patterns are being edited.
+
+    The folder is listed once. The output of every pipeline stage is kept, keyed by the stages before it,
+    so an edit only re-runs the stages from the first changed pattern onward; typing into the last pattern
+    re-evaluates that pattern alone.
+    """
+
+    def __init__(self, folder_path, snapshot=None):
+        self.snapshot = get_snapshot(folder_path, snapshot)
+        files = self.snapshot.supported(SUPPORTED_EXTENSIONS)
+        # (rel_path, directory prefix, stem, extension), so a candidate name is a plain concatenation.
+        self._files = [(rel_path, rel_path[:len(rel_path) - len(stem) - len(ext)], stem, ext)
+                       for rel_path, (stem, ext) in zip(files.rel_paths(), files.split_names())]
+        self._stems = [f[2] for f in self._files]
+        self._existing_keys = {name_key(n) for n in self.snapshot.names()}
+        # [(stage_key, names after that stage)] for the most recently previewed pipeline.
+        self._chain = []
+
+    def matches(self, folder_path):
+        return self.snapshot.matches(folder_path)
+
+    def _names(self, pipeline):
+        names = self._stems
+        chain = []
+        for i in range(len(pipeline.stages)):
+            key = pipeline.stage_key(i)
+            if i < len(self._chain) and self._chain[i][0] == key:
+                names = self._chain[i][1]
+            else:
+                # Cached stages after this one were computed from different input.
+                del self._chain[i:]
+                names = pipeline.apply_stage(i, names)
+            chain.append((key, names))
+        self._chain = chain
+        return names
+
+    def preview(self, patterns, replacement="", remove_mode=False):
+        """Return the preview's `change` and `skip` records, or None if a pattern is invalid."""
+        pipeline = RenamePipeline(patterns, replacement, remove_mode)
+        if not pipeline.valid:
+            return None
+        names = self._names(pipeline)
+        candidates = ((rel_path, prefix + new + ext)
+                      for (rel_path, prefix, stem, ext), new in zip(self._files, names) if new != stem and new.strip())
+        return list(iter_change_records(candidates, self.snapshot, self._existing_keys))
@@ -1,14 +1,28 @@
+import sys
 import platform
-from utils import setup_logging
+from utils import setup_logging, get_setting
+import metrics
 
 def main():
     setup_logging()
-    if platform.system() == "Windows":
-        from gui import create_gui
-        create_gui()
-    else:
-        from cli import cli_main
-        cli_main()
+    if len(sys.argv) > 1:
+        # Subcommands run unattended and never import tkinter.
+        from cli import batch_main
+        sys.exit(batch_main(sys.argv[1:]))
+    # Interactive sessions export metrics on exit when the config names a destination.
+    json_path, prom_path = get_setting("metrics_json"), get_setting("metrics_prom")
+    if json_path or prom_path:
+        metrics.enable()
+    try:
+        if platform.system() == "Windows":
+            from gui import create_gui
+            create_gui()
+        else:
+            from cli import cli_main
+            cli_main()
+    finally:
+        if json_path or prom_path:
+            metrics.export(json_path, prom_path)
 
 if __name__ == "__main__":
     main()
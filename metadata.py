@@ -0,0 +1,422 @@
+import os
+import re
+import mmap
+import zlib
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from progress import start, check
+from metrics import registry as metrics
+
+DEFAULT_WORKERS = 8
+# PDFs put `startxref` in the last few hundred bytes; allow for trailing junk.
+PDF_TAIL = 4096
+
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+
+
+# ---- MP4 / MOV (ISO base media file format) ----
+
+def _boxes(buf, start, end):
+    """Yield (type, payload start, box end) for the boxes between `start` and `end`."""
+    pos = start
+    while pos + 8 <= end:
+        size = _U32.unpack_from(buf, pos)[0]
+        kind = bytes(buf[pos + 4:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = _U64.unpack_from(buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield kind, pos + header, pos + size
+        pos += size
+
+
+def parse_mp4(buf):
+    """Duration from `moov/mvhd` and frame size from the first video `trak/tkhd`. Only those boxes are read."""
+    info = {}
+    for kind, start, end in _boxes(buf, 0, len(buf)):
+        if kind != b"moov":
+            continue
+        for child, cstart, cend in _boxes(buf, start, end):
+            if child == b"mvhd":
+                if buf[cstart] == 1:
+                    timescale, duration = struct.unpack_from(">IQ", buf, cstart + 20)
+                else:
+                    timescale, duration = struct.unpack_from(">II", buf, cstart + 12)
+                if timescale:
+                    info["duration"] = duration / timescale
+            elif child == b"trak" and "width" not in info:
+                for grandchild, gstart, gend in _boxes(buf, cstart, cend):
+                    if grandchild == b"tkhd" and gend - gstart >= 84:
+                        # Width and height are the last two fields, as 16.16 fixed point; audio tracks have zeros.
+                        width, height = struct.unpack_from(">II", buf, gend - 8)
+                        if width and height:
+                            info["width"], info["height"] = width >> 16, height >> 16
+        break
+    return info
+
+
+# ---- Matroska / WebM (EBML) ----
+
+_EBML_SEGMENT = 0x18538067
+_EBML_INFO = 0x1549A966
+_EBML_TRACKS = 0x1654AE6B
+_EBML_CLUSTER = 0x1F43B675
+_EBML_TIMECODE_SCALE = 0x2AD7B1
+_EBML_DURATION = 0x4489
+_EBML_TRACK_ENTRY = 0xAE
+_EBML_VIDEO = 0xE0
+_EBML_PIXEL_WIDTH = 0xB0
+_EBML_PIXEL_HEIGHT = 0xBA
+
+
+def _vint(buf, pos, keep_marker):
+    first = buf[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML variable-length integer")
+    value = first if keep_marker else first & (mask - 1)
+    for i in range(1, length):
+        value = (value << 8) | buf[pos + i]
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _elements(buf, start, end):
+    """Yield (id, data start, data end) for the EBML elements between `start` and `end`."""
+    pos = start
+    while pos < end:
+        element_id, pos, _ = _vint(buf, pos, True)
+        size, pos, unknown = _vint(buf, pos, False)
+        data_end = end if unknown else min(pos + size, end)
+        yield element_id, pos, data_end
+        pos = data_end
+
+
+def _uint(buf, start, end):
+    return int.from_bytes(buf[start:end], "big")
+
+
+def parse_mkv(buf):
+    """Duration from Segment/Info and pixel size from the first video track. Stops at the first Cluster."""
+    info = {}
+    for element_id, start, end in _elements(buf, 0, len(buf)):
+        if element_id != _EBML_SEGMENT:
+            continue
+        scale = 1000000
+        duration = None
+        for child, cstart, cend in _elements(buf, start, end):
+            if child == _EBML_INFO:
+                for field, fstart, fend in _elements(buf, cstart, cend):
+                    if field == _EBML_TIMECODE_SCALE:
+                        scale = _uint(buf, fstart, fend)
+                    elif field == _EBML_DURATION:
+                        duration = struct.unpack_from(">f" if fend - fstart == 4 else ">d", buf, fstart)[0]
+            elif child == _EBML_TRACKS:
+                for track, tstart, tend in _elements(buf, cstart, cend):
+                    if track != _EBML_TRACK_ENTRY or "width" in info:
+                        continue
+                    for field, fstart, fend in _elements(buf, tstart, tend):
+                        if field == _EBML_VIDEO:
+                            for video, vstart, vend in _elements(buf, fstart, fend):
+                                if video == _EBML_PIXEL_WIDTH:
+                                    info["width"] = _uint(buf, vstart, vend)
+                                elif video == _EBML_PIXEL_HEIGHT:
+                                    info["height"] = _uint(buf, vstart, vend)
+            elif child == _EBML_CLUSTER:
+                # Info and Tracks precede the media data in practice.
+                break
+        if duration is not None:
+            info["duration"] = duration * scale / 1e9
+        break
+    return info
+
+
+# ---- AVI (RIFF) ----
+
+def _chunks(buf, start, end):
+    pos = start
+    while pos + 8 <= end:
+        kind = bytes(buf[pos:pos + 4])
+        size = struct.unpack_from("<I", buf, pos + 4)[0]
+        yield kind, pos + 8, min(pos + 8 + size, end)
+        pos += 8 + size + (size & 1)
+
+
+def parse_avi(buf):
+    """Frame size from `avih` and duration from the video stream header (`strh`), falling back to `avih`."""
+    info = {}
+    if bytes(buf[0:4]) != b"RIFF" or bytes(buf[8:12]) != b"AVI ":
+        return info
+    for kind, start, end in _chunks(buf, 12, len(buf)):
+        if kind != b"LIST" or bytes(buf[start:start + 4]) != b"hdrl":
+            continue
+        for child, cstart, cend in _chunks(buf, start + 4, end):
+            if child == b"avih" and cend - cstart >= 40:
+                usec_per_frame, = struct.unpack_from("<I", buf, cstart)
+                frames, = struct.unpack_from("<I", buf, cstart + 16)
+                info["width"], info["height"] = struct.unpack_from("<II", buf, cstart + 32)
+                if usec_per_frame and frames:
+                    info["duration"] = frames * usec_per_frame / 1e6
+            elif child == b"LIST" and bytes(buf[cstart:cstart + 4]) == b"strl":
+                for stream, sstart, send in _chunks(buf, cstart + 4, cend):
+                    if stream == b"strh" and send - sstart >= 36 and bytes(buf[sstart:sstart + 4]) == b"vids":
+                        scale, rate = struct.unpack_from("<II", buf, sstart + 20)
+                        length, = struct.unpack_from("<I", buf, sstart + 32)
+                        if scale and rate and length:
+                            # Unlike avih's frame count, this covers every RIFF part of OpenDML files.
+                            info["duration"] = length * scale / rate
+                        break
+        break
+    return info
+
+
+# ---- PDF ----
+
+_PDF_REF = re.compile(rb"/(Root|Pages|Prev|Size)\s+(\d+)(?:\s+(\d+)\s+R)?")
+_PDF_COUNT = re.compile(rb"/Count\s+(\d+)")
+_PDF_PAGES_TREE = re.compile(rb"/Type\s*/Pages\b")
+_PDF_INT_ARRAY = re.compile(rb"\[([\d\s]*)\]")
+
+
+def _pdf_dict(buf, pos, limit=4096):
+    """The raw text of the dictionary starting at or after `pos` (not nested-aware beyond counting << >>)."""
+    start = buf.find(b"<<", pos, pos + limit)
+    if start < 0:
+        return b""
+    depth = 0
+    i = start
+    end = min(len(buf), start + limit * 4)
+    while i < end - 1:
+        two = buf[i:i + 2]
+        if two == b"<<":
+            depth += 1
+            i += 2
+        elif two == b">>":
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return bytes(buf[start:i])
+        else:
+            i += 1
+    return bytes(buf[start:end])
+
+
+def _pdf_refs(text):
+    refs = {}
+    for name, number, _ in _PDF_REF.findall(text):
+        refs.setdefault(name.decode(), int(number))
+    return refs
+
+
+def _pdf_stream(buf, dict_text, dict_end):
+    """Decode the FlateDecode stream following a dictionary that ends at `dict_end`."""
+    pos = buf.find(b"stream", dict_end, dict_end + 64)
+    if pos < 0:
+        raise ValueError("Missing stream")
+    pos += 6
+    if buf[pos:pos + 2] == b"\r\n":
+        pos += 2
+    elif buf[pos:pos + 1] in (b"\n", b"\r"):
+        pos += 1
+    length = re.search(rb"/Length\s+(\d+)(?!\s+\d+\s+R)", dict_text)
+    end = pos + int(length.group(1)) if length else buf.find(b"endstream", pos)
+    data = bytes(buf[pos:end])
+    return zlib.decompress(data) if b"/FlateDecode" in dict_text else data
+
+
+def _png_unpredict(data, columns):
+    rows = []
+    previous = bytearray(columns)
+    for i in range(0, len(data), columns + 1):
+        row = bytearray(data[i + 1:i + 1 + columns])
+        if data[i] == 2:
+            for j in range(len(row)):
+                row[j] = (row[j] + previous[j]) & 0xFF
+        rows.append(bytes(row))
+        previous = row
+    return b"".join(rows)
+
+
+def _pdf_xref_section(buf, offset, table):
+    """Add the entries of the xref section at `offset` to `table` (newer sections win). Returns its trailer."""
+    if buf[offset:offset + 4] == b"xref":
+        pos = offset + 4
+        trailer = buf.find(b"trailer", pos)
+        header = re.compile(rb"\s*(\d+)\s+(\d+)\s*")
+        while pos < trailer:
+            match = header.match(buf, pos, trailer)
+            if not match:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            pos = match.end()
+            for n in range(count):
+                entry = buf[pos + n * 20:pos + n * 20 + 18]
+                if entry[17:18] == b"n":
+                    table.setdefault(first + n, ("offset", int(entry[:10])))
+            pos += count * 20
+        return _pdf_dict(buf, trailer)
+    # Cross-reference stream (PDF 1.5+): a compressed table of fixed-width binary entries.
+    text = _pdf_dict(buf, offset)
+    dict_end = buf.find(text, offset) + len(text)
+    data = _pdf_stream(buf, text, dict_end)
+    widths = [int(w) for w in _PDF_INT_ARRAY.search(text, text.find(b"/W")).group(1).split()]
+    predictor = re.search(rb"/Predictor\s+(\d+)", text)
+    if predictor and int(predictor.group(1)) >= 10:
+        data = _png_unpredict(data, sum(widths))
+    index_pos = text.find(b"/Index")
+    if index_pos >= 0:
+        numbers = [int(n) for n in _PDF_INT_ARRAY.search(text, index_pos).group(1).split()]
+    else:
+        numbers = [0, _pdf_refs(text)["Size"]]
+    step = sum(widths)
+    pos = 0
+    for first, count in zip(numbers[::2], numbers[1::2]):
+        for n in range(count):
+            fields = []
+            field_pos = pos
+            for width in widths:
+                fields.append(int.from_bytes(data[field_pos:field_pos + width], "big") if width else None)
+                field_pos += width
+            pos += step
+            kind = 1 if fields[0] is None else fields[0]
+            if kind == 1:
+                table.setdefault(first + n, ("offset", fields[1]))
+            elif kind == 2:
+                table.setdefault(first + n, ("stream", fields[1], fields[2]))
+    return text
+
+
+def _pdf_object(buf, table, number):
+    """The dictionary text of object `number`, looking inside object streams when needed."""
+    entry = table.get(number)
+    if entry is None:
+        return b""
+    if entry[0] == "offset":
+        return _pdf_dict(buf, entry[1])
+    container_offset = table[entry[1]][1]
+    container = _pdf_dict(buf, container_offset)
+    data = _pdf_stream(buf, container, buf.find(container, container_offset) + len(container))
+    first = int(re.search(rb"/First\s+(\d+)", container).group(1))
+    pairs = [int(n) for n in data[:first].split()]
+    offsets = dict(zip(pairs[::2], pairs[1::2]))
+    start = first + offsets[number]
+    following = [first + o for o in offsets.values() if first + o > start]
+    return data[start:min(following) if following else len(data)]
+
+
+def _pdf_page_count(buf):
+    tail_start = max(0, len(buf) - PDF_TAIL)
+    startxref = buf.rfind(b"startxref", tail_start)
+    if startxref < 0:
+        raise ValueError("No startxref")
+    offset = int(bytes(buf[startxref + 9:startxref + 40]).split()[0])
+    table = {}
+    root = None
+    seen = set()
+    # Follow the /Prev chain of incremental updates; entries from newer sections take precedence.
+    while offset is not None and offset not in seen:
+        seen.add(offset)
+        refs = _pdf_refs(_pdf_xref_section(buf, offset, table))
+        root = root or refs.get("Root")
+        offset = refs.get("Prev")
+    pages = _pdf_refs(_pdf_object(buf, table, root)).get("Pages")
+    count = _PDF_COUNT.search(_pdf_object(buf, table, pages))
+    return int(count.group(1))
+
+
+def parse_pdf(buf):
+    """Page count from the trailer's /Root -> /Pages -> /Count, found through the xref table."""
+    if bytes(buf[0:5]) != b"%PDF-":
+        return {}
+    try:
+        return {"pages": _pdf_page_count(buf)}
+    except (ValueError, KeyError, IndexError, AttributeError, TypeError, zlib.error):
+        # Damaged or unusual xref data: take the largest page-tree /Count in the file instead.
+        counts = [int(m.group(1)) for match in _PDF_PAGES_TREE.finditer(buf)
+                  for m in [_PDF_COUNT.search(buf, match.start(), match.start() + 512)] if m]
+        return {"pages": max(counts)} if counts else {}
+
+
+PARSERS = {".mp4": parse_mp4, ".m4v": parse_mp4, ".mov": parse_mp4, ".mkv": parse_mkv, ".webm": parse_mkv,
+           ".avi": parse_avi, ".pdf": parse_pdf}
+
+
+def read_metadata(path):
+    """Map the file and parse its container header. Returns a dict (possibly empty) or None if unreadable."""
+    parser = PARSERS.get(os.path.splitext(path)[1].lower())
+    if parser is None:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return parser(buf)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        logging.warning("Cannot read metadata from %s: %s", path, e)
+        return None
+
+
+def extract_metadata(entries, catalog=None, max_workers=DEFAULT_WORKERS, progress=None):
+    """Return {path: metadata dict} for file entries, parsing in parallel and reusing catalog results.
+
+    With a FileCatalog, the entries' folder must already be synced (see FileCatalog.sync) so new results
+    can be stored.
+    """
+    files = [e for e in entries if not e.is_dir and os.path.splitext(e.name)[1].lower() in PARSERS]
+    cached = catalog.lookup(files) if catalog else {}
+    result = {}
+    missing = []
+    for entry in files:
+        row = cached.get(os.path.abspath(entry.path))
+        if row and row["meta"] is not None:
+            result[entry.path] = row["meta"]
+        else:
+            missing.append(entry)
+
+    def work(entry):
+        check(progress)
+        return read_metadata(entry.path)
+
+    start(progress, "metadata", len(missing))
+    fresh = {}
+    with metrics.span("metadata"), ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for entry, info in zip(missing, pool.map(work, missing)):
+            if info is not None:
+                result[entry.path] = fresh[entry.path] = info
+            if progress:
+                progress.advance()
+    metrics.count("files_parsed", len(missing))
+    if catalog:
+        catalog.store_meta(fresh)
+    return result
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+
+def describe(info):
+    """Short text for a metadata dict, e.g. "12:03 1920x1080" or "45 pages"."""
+    parts = []
+    if info.get("duration") is not None:
+        parts.append(format_duration(info["duration"]))
+    if info.get("width"):
+        parts.append(f"{info['width']}x{info['height']}")
+    if info.get("pages") is not None:
+        parts.append(f"{info['pages']} pages")
+    return " ".join(parts) or "no metadata"
@@ -0,0 +1,255 @@
+import os
+import json
+import logging
+import time
+import bisect
+import threading
+
+# Latency buckets (seconds) for operation histograms.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+PROMETHEUS_PREFIX = "pfm_"
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class _NullSpan:
+    elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        stack = self.registry._stack()
+        stack.append(self.name)
+        self.path = "/".join(stack)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._started
+        self.registry._stack().pop()
+        self.registry._record_span(self.path, self.elapsed)
+        return False
+
+
+class Metrics:
+    """Counters, latency histograms and nested phase spans for one process.
+
+    Disabled by default: `span()` then returns a shared no-op context manager and `count()`/`observe()`
+    return immediately, so instrumented code pays one attribute check.
+    """
+
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            # key -> [bucket counts..., sum, count]
+            self.histograms = {}
+            # span path -> [calls, total seconds, max seconds]
+            self.spans = {}
+            self.started = time.time()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name):
+        """Context manager timing a phase; nested spans are recorded by path, e.g. "preview_changes/scan"."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def _record_span(self, path, elapsed):
+        with self._lock:
+            entry = self.spans.get(path)
+            if entry is None:
+                self.spans[path] = [1, elapsed, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value (usually seconds) to a histogram."""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            hist[bisect.bisect_left(self.buckets, value)] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def raw(self):
+        """Picklable copy of the collected data, for merging results from worker processes."""
+        with self._lock:
+            return {"counters": dict(self.counters), "histograms": {k: list(v) for k, v in self.histograms.items()},
+                    "spans": {k: list(v) for k, v in self.spans.items()}}
+
+    def merge(self, raw):
+        with self._lock:
+            for key, value in raw["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in raw["histograms"].items():
+                hist = self.histograms.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0, 0])
+                for i, value in enumerate(values):
+                    hist[i] += value
+            for path, (calls, total, longest) in raw["spans"].items():
+                entry = self.spans.setdefault(path, [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] = max(entry[2], longest)
+
+    def summary(self):
+        """JSON-ready summary: counters, span totals per phase and histogram percentiles-by-bucket."""
+        def label(key):
+            name, labels = key
+            return name + "".join(f"[{k}={v}]" for k, v in labels)
+
+        data = self.raw()
+        histograms = {}
+        for key, hist in data["histograms"].items():
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            histograms[label(key)] = {"count": hist[-1], "sum": round(hist[-2], 6),
+                                      "buckets": {b: n for b, n in zip(bounds, hist) if n}}
+        return {"started": self.started, "duration": round(time.time() - self.started, 3),
+                "counters": {label(k): v for k, v in data["counters"].items()},
+                "spans": {path: {"calls": calls, "seconds": round(total, 6), "max": round(longest, 6)}
+                          for path, (calls, total, longest) in sorted(data["spans"].items())},
+                "histograms": histograms}
+
+    def to_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                                  for k, v in pairs) + "}"
+
+        data = self.raw()
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(data["counters"].items()):
+            metric = f"{PROMETHEUS_PREFIX}{name}_total"
+            declare(metric, "counter")
+            lines.append(f"{metric}{labels_text(labels)} {value}")
+        for (name, labels), hist in sorted(data["histograms"].items()):
+            metric = f"{PROMETHEUS_PREFIX}{name}"
+            declare(metric, "histogram")
+            cumulative = 0
+            for bound, n in zip([str(b) for b in self.buckets] + ["+Inf"], hist):
+                cumulative += n
+                lines.append(f"{metric}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric}_sum{labels_text(labels)} {hist[-2]}")
+            lines.append(f"{metric}_count{labels_text(labels)} {hist[-1]}")
+        for path, (calls, total, _) in sorted(data["spans"].items()):
+            declare(f"{PROMETHEUS_PREFIX}phase_seconds_total", "counter")
+            lines.append(f"{PROMETHEUS_PREFIX}phase_seconds_total{labels_text([('phase', path)])} {total}")
+        for path, (calls, total, _) in sorted(data["spans"].items()):
+            declare(f"{PROMETHEUS_PREFIX}phase_calls_total", "counter")
+            lines.append(f"{PROMETHEUS_PREFIX}phase_calls_total{labels_text([('phase', path)])} {calls}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write a .prom file; the atomic replace keeps node-exporter's textfile collector from reading half a file."""
+        _write_atomic(path, self.to_prometheus())
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# Process-wide registry used by the instrumented modules.
+registry = Metrics()
+
+
+def enable():
+    registry.enabled = True
+
+
+def export(json_path=None, prom_path=None):
+    """Write the registry as a JSON summary and/or a Prometheus text file. Returns False if a write failed."""
+    ok = True
+    for path, write in ((json_path, registry.write_json), (prom_path, registry.write_prometheus)):
+        if not path:
+            continue
+        try:
+            write(path)
+        except OSError as e:
+            logging.error("Error writing metrics to %s: %s", path, e)
+            ok = False
+    return ok
+
+
+def span(name):
+    return registry.span(name)
+
+
+def count(name, value=1, **labels):
+    registry.count(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def instrumented(func):
+    """Decorator: time each call as a span and in the `operation_seconds` histogram."""
+    name = func.__name__
+
+    def wrapper(*args, **kwargs):
+        if not registry.enabled:
+            return func(*args, **kwargs)
+        with registry.span(name) as timer:
+            result = func(*args, **kwargs)
+        registry.observe("operation_seconds", timer.elapsed, operation=name)
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = func.__doc__
+    wrapper.__wrapped__ = func
+    return wrapper
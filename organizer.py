@@ -0,0 +1,136 @@
+import os
+import time
+import errno
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from backup import copy_file, DEFAULT_WORKERS
+from progress import start, check
+from metrics import registry as metrics
+
+DATE_FIELDS = ("ctime", "mtime", "birthtime")
+GRANULARITY_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+DEFAULT_BUCKET_KEY = "ctime:day"
+# Bucket specs offered in the GUI.
+ORGANIZE_KEYS = tuple(f"{field}:{granularity}" for field in DATE_FIELDS
+                      for granularity in GRANULARITY_FORMATS) + ("extension",)
+
+BUCKET_LABELS = {"ctime": "creation date", "mtime": "modification date", "birthtime": "birth time"}
+
+OrganizePlan = namedtuple("OrganizePlan", ["moves", "skipped", "buckets"])
+
+
+def bucket_labels(table, spec=DEFAULT_BUCKET_KEY):
+    """Bucket name for every row of a FileTable, in row order.
+
+    Date buckets are formatted once per distinct 15-minute slot and extension buckets once per distinct
+    extension, over the table's columns, instead of once per file.
+    """
+    if callable(spec):
+        return list(map(spec, table.entries()))
+    if spec == "extension":
+        return table.ext_labels(lambda ext: ext.lstrip(".") or "no_extension")
+    field, _, granularity = spec.partition(":")
+    if field not in DATE_FIELDS:
+        raise ValueError(f"Unknown date field: {field}")
+    fmt = GRANULARITY_FORMATS[granularity or "day"]
+    # Every UTC offset in use is a multiple of 15 minutes, so one slot always maps to one local date.
+    return table.slot_labels(field, 900, lambda ts: time.strftime(fmt, time.localtime(ts)))
+
+
+def describe_bucket_key(spec):
+    if spec == "extension":
+        return "extension"
+    field, _, granularity = str(spec).partition(":")
+    label = BUCKET_LABELS.get(field, field)
+    return f"{label} ({granularity})" if granularity and granularity != "day" else label
+
+
+def plan_organize(entries, dest_root, labels):
+    """Compute every file's destination bucket up front and find collisions.
+
+    `labels` gives the bucket of each entry in order (see bucket_labels). Existing bucket folders are listed
+    once each rather than checking every target path.
+    """
+    moves = []
+    skipped = []
+    buckets = {}
+    occupied = {}
+    for entry, bucket in zip(entries, labels):
+        if bucket not in occupied:
+            bucket_path = os.path.join(dest_root, bucket)
+            try:
+                occupied[bucket] = set(os.listdir(bucket_path))
+            except NotADirectoryError:
+                occupied[bucket] = None
+            except FileNotFoundError:
+                occupied[bucket] = set()
+        names = occupied[bucket]
+        if names is None:
+            skipped.append((entry, bucket, "A file with the folder's name exists"))
+        elif entry.name in names:
+            skipped.append((entry, bucket, "Target exists, skipping to prevent overwrite"))
+        else:
+            names.add(entry.name)
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+            moves.append((entry, bucket))
+    return OrganizePlan(moves, skipped, buckets)
+
+
+def execute_organize(plan, dest_root, op=None, progress=None, on_move=None, max_workers=DEFAULT_WORKERS):
+    """Create each bucket folder once and move the planned files.
+
+    Same-device moves are plain os.rename calls; moves to another device copy in parallel and then delete
+    the source. `op` is an OperationLog that gets each move before it happens. Returns the files moved.
+    """
+    for bucket in plan.buckets:
+        os.makedirs(os.path.join(dest_root, bucket), exist_ok=True)
+    dest_dev = os.stat(dest_root).st_dev
+    local, remote = [], []
+    for entry, bucket in plan.moves:
+        dst = os.path.join(dest_root, bucket, entry.name)
+        # scandir reports st_dev as 0 on Windows; those files try a rename first.
+        (local if entry.dev in (dest_dev, 0) else remote).append((entry, bucket, dst))
+    start(progress, "organize", len(plan.moves))
+    done = 0
+
+    def finished(entry, bucket):
+        nonlocal done
+        done += 1
+        if on_move:
+            on_move(entry, bucket)
+        if progress:
+            progress.advance(1, entry.size)
+
+    with metrics.span("move"):
+        for entry, bucket, dst in local:
+            if op:
+                op.record(os.path.abspath(entry.path), os.path.abspath(dst))
+            try:
+                os.rename(entry.path, dst)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                remote.append((entry, bucket, dst))
+                continue
+            finished(entry, bucket)
+
+        if remote:
+            def cross_device_move(item):
+                entry, bucket, dst = item
+                check(progress)
+                copy_file(entry.path, dst)
+                os.remove(entry.path)
+                return entry, bucket
+
+            if op:
+                for entry, bucket, dst in remote:
+                    if entry.dev != 0:
+                        op.record(os.path.abspath(entry.path), os.path.abspath(dst))
+                op.sync()
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for entry, bucket in pool.map(cross_device_move, remote):
+                    finished(entry, bucket)
+    metrics.count("files_moved", done)
+    logging.info("Organized %s files into %s folders (%s across devices)", done, len(plan.buckets), len(remote))
+    return done
@@ -0,0 +1,149 @@
+import os
+import uuid
+import logging
+from collections import namedtuple
+from progress import start, OperationCancelled
+from metrics import registry as metrics
+
+SkippedRename = namedtuple("SkippedRename", ["src", "dst", "reason"])
+
+TARGET_EXISTS = "Target exists, skipping to prevent overwrite"
+TARGET_CLAIMED = "Another file is renamed to the same target"
+
+
+class RenameTransactionError(Exception):
+    """A planned rename failed; every rename already done in the transaction has been rolled back."""
+
+
+class RenamePlan:
+    """Ordered rename steps for a batch of (src, dst) changes, relative to one folder.
+
+    `changes` are the accepted logical renames, `steps` the physical renames to run in order (including hops
+    through temporary names that break swaps and cycles), and `skipped` the rejected changes with a reason.
+    """
+
+    def __init__(self, changes, steps, skipped):
+        self.changes = changes
+        self.steps = steps
+        self.skipped = skipped
+
+    def __len__(self):
+        return len(self.steps)
+
+
+def name_key(path):
+    """Comparison key for paths on this platform's filesystem (case-insensitive on Windows)."""
+    return os.path.normcase(path)
+
+
+def _temp_name(path):
+    head, tail = os.path.split(path)
+    return os.path.join(head, f".{tail}.pfm-tmp-{uuid.uuid4().hex[:8]}")
+
+
+def plan_renames(changes, existing_names):
+    """Build a RenamePlan from (src, dst) pairs and the names currently present in the folder.
+
+    Targets may be names that other changes in the same batch rename away, so shifts such as 02->03, 03->04
+    and swaps plan cleanly. A change is skipped when its target stays occupied or an earlier change already
+    claimed it; skips cascade to changes that depended on the skipped file moving.
+    """
+    existing = {name_key(n) for n in existing_names}
+    accepted = {}
+    claimed = {}
+    skipped = []
+    for src, dst in changes:
+        if src == dst:
+            continue
+        sk, dk = name_key(src), name_key(dst)
+        if dk in claimed:
+            skipped.append(SkippedRename(src, dst, TARGET_CLAIMED))
+            continue
+        claimed[dk] = sk
+        accepted[sk] = (src, dst)
+
+    # Reject changes whose target is occupied by a file that is not moving away; rejecting one may
+    # strand the change waiting for its name, so work through those dependents as well.
+    waiting_on = {dk: sk for dk, sk in claimed.items() if sk in accepted}
+    pending = [sk for sk, (src, dst) in accepted.items()]
+    while pending:
+        sk = pending.pop()
+        if sk not in accepted:
+            continue
+        src, dst = accepted[sk]
+        dk = name_key(dst)
+        if dk != sk and dk in existing and dk not in accepted:
+            del accepted[sk]
+            skipped.append(SkippedRename(src, dst, TARGET_EXISTS))
+            dependent = waiting_on.get(sk)
+            if dependent is not None:
+                pending.append(dependent)
+
+    # Each name has at most one incoming and one outgoing move, so the moves form simple chains and cycles.
+    # Chains run from the end whose target is free; a cycle is opened by parking one file under a temp name.
+    steps = []
+    done = set()
+    incoming = {name_key(dst): sk for sk, (src, dst) in accepted.items() if name_key(dst) != sk}
+
+    def run_chain(start_key):
+        key = start_key
+        while key is not None and key not in done:
+            done.add(key)
+            steps.append(accepted[key])
+            key = incoming.get(key)
+
+    for sk, (src, dst) in accepted.items():
+        dk = name_key(dst)
+        if dk == sk or dk not in accepted:
+            run_chain(sk)
+    for sk in list(accepted):
+        if sk in done:
+            continue
+        src, dst = accepted[sk]
+        temp = _temp_name(src)
+        steps.append((src, temp))
+        done.add(sk)
+        # Everything that was waiting on `src` can now run, ending with the parked file's real move.
+        run_chain(incoming.get(sk))
+        steps.append((temp, dst))
+    ordered_changes = [accepted[sk] for sk in accepted]
+    return RenamePlan(ordered_changes, steps, skipped)
+
+
+def execute_plan(folder_path, plan, progress=None, on_step=None, before_step=None):
+    """Run a plan's steps as one transaction. On any failure, roll back the renames already done.
+
+    `before_step(src_path, dst_path)` is called with absolute paths before each physical rename (for
+    write-ahead journaling) and `on_step(src, dst)` after it succeeds. Raises RenameTransactionError, or
+    OperationCancelled (also after rolling back) when `progress` is cancelled.
+    """
+    done = []
+    start(progress, "rename", len(plan.steps))
+    with metrics.span("rename"):
+        try:
+            for src, dst in plan.steps:
+                src_path = os.path.join(folder_path, src)
+                dst_path = os.path.join(folder_path, dst)
+                # os.rename silently replaces files on POSIX; never do that if the folder changed since planning.
+                if name_key(src) != name_key(dst) and os.path.lexists(dst_path):
+                    raise FileExistsError(f"Target appeared since planning: {dst}")
+                if before_step:
+                    before_step(src_path, dst_path)
+                os.rename(src_path, dst_path)
+                done.append((src_path, dst_path))
+                if on_step:
+                    on_step(src, dst)
+                if progress:
+                    progress.advance()
+        except BaseException as e:
+            for src_path, dst_path in reversed(done):
+                try:
+                    os.rename(dst_path, src_path)
+                except OSError as rollback_error:
+                    logging.error("Rollback failed for %s -> %s: %s", dst_path, src_path, rollback_error)
+            logging.error("Rename transaction rolled back after %s of %s steps: %s", len(done), len(plan.steps), e)
+            if isinstance(e, Exception) and not isinstance(e, OperationCancelled):
+                raise RenameTransactionError(str(e)) from e
+            raise
+    metrics.count("renames", len(done))
+    return done
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import errno
+import shutil
+import logging
+from journal import Journal
+from planner import name_key, TARGET_EXISTS
+from progress import start
+from metrics import registry as metrics
+
+PLAN_VERSION = 1
+
+SOURCE_CHANGED = "Source changed since the plan was made"
+SOURCE_MISSING = "Source no longer exists"
+CYCLE_SKIPPED = "Another file in the same rename cycle changed since the plan was made"
+
+
+class PlanWriter:
+    """Writes a plan file: JSON lines, with one section per folder and operation.
+
+    A section starts with a header line ({"plan", "action", "folder", "dest", "created", "description"}),
+    followed by one line per physical move in the order it must run: {"src", "dst", "size", "mtime", "ino"},
+    paths relative to the folder and destination root. Swaps and cycles go through a temporary name: the
+    move that parks a file there also carries its "final" target, and the move out of it carries "restore",
+    the original name to fall back to. The file is written to a temporary name and moved into place on close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = 0
+        self._file = open(f"{path}.tmp", "w", encoding="utf-8")
+
+    def section(self, action, folder_path, dest_root=None, description=""):
+        folder_path = os.path.abspath(folder_path)
+        self._write({"plan": PLAN_VERSION, "action": action, "folder": folder_path,
+                     "dest": os.path.abspath(dest_root) if dest_root else folder_path, "created": time.time(),
+                     "description": description})
+
+    def add(self, src, dst, entry=None, final=None, restore=None):
+        """Record a move of `src` to `dst`; `entry` is the source's FileEntry, whose stat data is checked later."""
+        item = {"src": src, "dst": dst}
+        if entry is not None:
+            item.update(size=entry.size, mtime=entry.mtime, ino=entry.ino)
+        if final is not None:
+            item["final"] = final
+        if restore is not None:
+            item["restore"] = restore
+        self._write(item)
+        self.entries += 1
+
+    def _write(self, item):
+        self._file.write(json.dumps(item) + "\n")
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_rename_plan(writer, folder_path, plan, entries):
+    """Append a RenamePlan's steps as a "rename" section. `entries` maps relative paths to FileEntry records."""
+    writer.section("rename", folder_path, description=f"{len(plan.changes)} files")
+    targets = dict(plan.changes)
+    parked = {}
+    for src, dst in plan.steps:
+        if src in parked:
+            writer.add(src, dst, restore=parked.pop(src))
+        elif targets.get(src, dst) != dst:
+            parked[dst] = src
+            writer.add(src, dst, entries.get(src), final=targets[src])
+        else:
+            writer.add(src, dst, entries.get(src))
+
+
+def add_organize_plan(writer, folder_path, dest_root, plan, description=""):
+    """Append an OrganizePlan's moves as an "organize" section."""
+    writer.section("organize", folder_path, dest_root, description)
+    for entry, bucket in plan.moves:
+        writer.add(entry.rel_path, os.path.join(bucket, entry.name), entry)
+
+
+def read_plan(path):
+    """Yield (header, items) per section of a plan file; `items` streams the section's moves from disk."""
+    with open(path, "r", encoding="utf-8") as f:
+        lines = (json.loads(line) for line in f if line.strip())
+        header = next(lines, None)
+        while header is not None:
+            if "plan" not in header:
+                raise ValueError(f"{path} is not a plan file")
+            if header["plan"] != PLAN_VERSION:
+                raise ValueError(f"Unsupported plan version {header['plan']} in {path}")
+            following = []
+
+            def section():
+                for item in lines:
+                    if "plan" in item:
+                        following.append(item)
+                        return
+                    yield item
+            items = section()
+            yield header, items
+            # Skip whatever the caller did not consume, to reach the next header.
+            for _ in items:
+                pass
+            header = following[0] if following else None
+
+
+def plan_folders(path):
+    """Folders and destination roots a plan file moves files in, sorted."""
+    folders = set()
+    for header, _ in read_plan(path):
+        folders.update((header["folder"], header["dest"]))
+    return sorted(folders)
+
+
+def _check_source(path, item):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return SOURCE_MISSING
+    if "size" in item and (st.st_size != item["size"] or st.st_mtime != item["mtime"]
+                           or (item["ino"] and st.st_ino != item["ino"])):
+        return SOURCE_CHANGED
+    return None
+
+
+class _Section:
+    """Applies one plan section's moves, journaled as one operation started at the first move.
+
+    The journal syncs its log every few hundred moves and bucket folders are created once, so moves are
+    applied in bulk while only the current line (or rename cycle) is held in memory.
+    """
+
+    def __init__(self, header, on_move=None, on_skip=None):
+        self.header = header
+        self.folder = header["folder"]
+        self.dest = header["dest"]
+        self.on_move = on_move
+        self.on_skip = on_skip
+        self.op = None
+        self.moved = self.skipped = 0
+        self._made = set()
+        # Moves of a rename cycle, from the one parking a file under a temporary name to the one releasing it.
+        self._cycle = None
+
+    def feed(self, item):
+        if self._cycle is not None:
+            self._cycle.append(item)
+            if "restore" in item:
+                cycle, self._cycle = self._cycle, None
+                self._apply_cycle(cycle)
+        elif "final" in item:
+            self._cycle = [item]
+        else:
+            self._apply(item)
+
+    def _skip(self, src, dst, reason):
+        self.skipped += 1
+        if self.on_skip:
+            self.on_skip(self.header["action"], src, dst, reason)
+
+    def _apply_cycle(self, cycle):
+        # A cycle only works as a whole, so every source is checked before the first move.
+        reasons = [_check_source(os.path.join(self.folder, item["src"]), item) for item in cycle[:-1]]
+        if any(reasons):
+            for item, reason in zip(cycle, reasons):
+                self._skip(item["src"], item.get("final", item["dst"]), reason or CYCLE_SKIPPED)
+            return
+        for item in cycle:
+            self._apply(item)
+
+    def _apply(self, item):
+        src = os.path.join(self.folder, item["src"])
+        dst = os.path.join(self.dest, item["dst"])
+        restore = item.get("restore")
+        if restore is not None and not os.path.lexists(src):
+            # The move that parked this file was skipped, and was reported then.
+            return
+        reason = _check_source(src, item) if restore is None else None
+        if reason is None and name_key(src) != name_key(dst) and os.path.lexists(dst):
+            reason = TARGET_EXISTS
+        if reason is not None:
+            self._skip(restore or item["src"], item.get("final", item["dst"]), reason)
+            if restore is None:
+                return
+            # A target taken since the cycle was checked: put the parked file back under its original name.
+            dst = os.path.join(self.folder, restore)
+            if os.path.lexists(dst):
+                logging.error("Could not move %s back to %s: the name is taken", src, restore)
+                return
+        self._move(src, dst)
+        if reason is None and "final" not in item:
+            self.moved += 1
+            if self.on_move:
+                self.on_move(self.header["action"], restore or item["src"], item["dst"])
+
+    def _move(self, src, dst):
+        if self.op is None:
+            self.op = Journal(self.folder).begin(self.header["action"], f"{self.header['description']} (from plan)")
+        dst_dir = os.path.dirname(dst)
+        if dst_dir not in self._made:
+            os.makedirs(dst_dir, exist_ok=True)
+            self._made.add(dst_dir)
+        self.op.record(os.path.abspath(src), os.path.abspath(dst))
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            # Moves to another device (organize into another disk) are copied and then deleted.
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(src, dst)
+
+    def close(self, exc_type=None):
+        if self._cycle is not None and exc_type is None:
+            for item in self._cycle:
+                self._skip(item["src"], item.get("final", item["dst"]), "The plan file ends inside a rename cycle")
+        if self.op is not None:
+            self.op.__exit__(exc_type, None, None)
+
+
+def apply_plan(path, progress=None, on_move=None, on_skip=None):
+    """Apply a plan file, streaming it line by line. Returns one dict per section: action, folder, moved,
+    skipped and the journal operation id (None if nothing moved).
+
+    Every move is checked against the source's size, mtime and inode recorded in the plan, and skipped when
+    the source changed or its target is taken; no folder is listed and no rename rule runs, and memory use
+    does not grow with the plan. Each section is journaled as one operation, so it can be undone like the
+    rename or organize it came from. `on_move(action, src, dst)` and `on_skip(action, src, dst, reason)` get
+    the paths as written in the plan.
+    """
+    results = []
+    start(progress, "apply")
+    with metrics.span("apply"):
+        for header, items in read_plan(path):
+            section = _Section(header, on_move, on_skip)
+            try:
+                for item in items:
+                    section.feed(item)
+                    if progress:
+                        progress.advance()
+            except BaseException as e:
+                section.close(type(e))
+                raise
+            section.close()
+            results.append({"action": header["action"], "folder": section.folder, "moved": section.moved,
+                            "skipped": section.skipped, "operation": section.op.op_id if section.op else None})
+    metrics.count("files_moved", sum(r["moved"] for r in results))
+    return results
@@ -0,0 +1,159 @@
+import sys
+import time
+from collections import namedtuple
+
+# One progress update. `percent` is None when the total is unknown; `eta` is in seconds or None.
+ProgressEvent = namedtuple("ProgressEvent", ["phase", "done", "total", "bytes_done", "total_bytes", "percent", "eta"])
+
+DEFAULT_INTERVAL = 0.05
+DEFAULT_STEP = 1.0
+
+
+class OperationCancelled(Exception):
+    """Raised at a file boundary once the reporter's cancel event has been set."""
+
+
+class ProgressReporter:
+    """Counts work in hot loops and forwards coalesced ProgressEvents to a callback.
+
+    `advance()` is cheap; the callback only runs when progress has moved by `min_step` percent or
+    `min_interval` seconds have passed, whichever comes first, plus once at the start and end of each phase.
+    With a `cancel_event` (threading.Event), `advance()` and `check()` raise OperationCancelled once it is set.
+    """
+
+    def __init__(self, callback=None, min_interval=DEFAULT_INTERVAL, min_step=DEFAULT_STEP, cancel_event=None):
+        self.callback = callback
+        self.cancel_event = cancel_event
+        self.min_interval = min_interval
+        self.min_step = min_step
+        self.phase = None
+        self.total = None
+        self.total_bytes = 0
+        self.done = self.bytes_done = 0
+        self._started = self._last = 0.0
+        self._next_done = 0
+
+    def start(self, phase, total=None, total_bytes=0):
+        """Begin a new phase with `total` items (None if unknown) and optionally `total_bytes`."""
+        self.phase = phase
+        self.total = total
+        self.total_bytes = total_bytes
+        self.done = self.bytes_done = 0
+        self._started = time.monotonic()
+        self._schedule()
+        self._emit(self._started)
+        return self
+
+    def check(self):
+        """Raise OperationCancelled if cancellation was requested. Safe to call from worker threads."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise OperationCancelled("Operation cancelled")
+
+    def advance(self, n=1, nbytes=0):
+        self.done += n
+        self.bytes_done += nbytes
+        self.check()
+        if self.callback is None:
+            return
+        if self.done >= self._next_done or self.done == self.total:
+            self._emit(time.monotonic())
+            return
+        now = time.monotonic()
+        if now - self._last >= self.min_interval:
+            self._emit(now)
+
+    def finish(self):
+        """Report the current phase as complete."""
+        if self.total and self.done < self.total:
+            self.done = self.total
+        self._emit(time.monotonic())
+
+    def event(self, now=None):
+        now = now or time.monotonic()
+        if self.total_bytes:
+            fraction = min(self.bytes_done / self.total_bytes, 1.0)
+        elif self.total is not None:
+            fraction = min(self.done / self.total, 1.0) if self.total else 1.0
+        else:
+            fraction = None
+        eta = None
+        elapsed = now - self._started
+        if fraction and fraction < 1.0 and elapsed > 0:
+            eta = elapsed * (1 - fraction) / fraction
+        return ProgressEvent(self.phase, self.done, self.total, self.bytes_done, self.total_bytes,
+                             None if fraction is None else fraction * 100, eta)
+
+    def _schedule(self):
+        step = self.total * self.min_step / 100 if self.total else 0
+        self._next_done = self.done + max(1, int(step))
+
+    def _emit(self, now):
+        self._last = now
+        self._schedule()
+        if self.callback is not None:
+            self.callback(self.event(now))
+
+
+def as_reporter(progress_callback):
+    """Wrap a ProgressEvent callback in a ProgressReporter (or pass an existing reporter/None through)."""
+    if progress_callback is None or isinstance(progress_callback, ProgressReporter):
+        return progress_callback
+    return ProgressReporter(progress_callback)
+
+
+def start(progress, phase, total=None, total_bytes=0):
+    """`progress.start(...)` for an optional reporter; returns the reporter."""
+    if progress is not None:
+        progress.start(phase, total, total_bytes)
+    return progress
+
+
+def check(progress):
+    """`progress.check()` for an optional reporter."""
+    if progress is not None:
+        progress.check()
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return ""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def format_event(event):
+    """One-line human-readable description of a ProgressEvent."""
+    from duplicates import format_size
+    parts = [event.phase or "working"]
+    if event.percent is not None:
+        parts.append(f"{event.percent:5.1f}%")
+    parts.append(f"{event.done}/{event.total}" if event.total else str(event.done))
+    if event.total_bytes:
+        parts.append(f"{format_size(event.bytes_done)}/{format_size(event.total_bytes)}")
+    if event.eta is not None:
+        parts.append(f"ETA {format_eta(event.eta)}")
+    return "  ".join(parts)
+
+
+class TerminalProgress:
+    """ProgressEvent callback that redraws a single status line on a terminal (stderr by default)."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.enabled = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self._width = 0
+
+    def __call__(self, event):
+        if not self.enabled:
+            return
+        line = format_event(event)
+        self.stream.write("\r" + line.ljust(self._width))
+        self._width = len(line)
+        if event.percent is not None and event.percent >= 100:
+            self.stream.write("\n")
+            self._width = 0
+        self.stream.flush()
@@ -0,0 +1,176 @@
+import tkinter as tk
+from tkinter import ttk
+from duplicates import format_size
+from metadata import describe
+
+COLUMNS = ("kind", "name", "target", "detail")
+COLUMN_TITLES = {"kind": "Type", "name": "File", "target": "Target", "detail": "Detail"}
+COLUMN_WIDTHS = {"kind": 80, "name": 260, "target": 260, "detail": 200}
+
+
+def record_values(record):
+    """Column values shown for a ResultRecord."""
+    detail = record.detail
+    if record.kind == "duplicate_group":
+        detail = f"{len(detail['files'])} copies, {format_size(detail['reclaimable'])} reclaimable"
+    elif record.kind == "fuzzy_group":
+        detail = f"{len(detail['files'])} files, similarity {detail['score']:.2f}"
+    elif record.kind == "media":
+        detail = describe(detail)
+    return (record.kind, record.name or "", record.target or "", "" if detail is None else str(detail).strip())
+
+
+def _sort_key(column):
+    index = COLUMNS.index(column)
+    if column == "detail":
+        # Duplicate groups sort by the space they would free, near-duplicate clusters by their size and media
+        # rows by duration (or pages), rather than by their label.
+        def key(r):
+            if r.kind == "duplicate_group":
+                return r.detail["reclaimable"], ""
+            if r.kind == "fuzzy_group":
+                return len(r.detail["files"]), ""
+            if r.kind == "media":
+                return r.detail.get("duration") or r.detail.get("pages") or 0, ""
+            return 0, record_values(r)[3]
+        return key
+    return lambda r: record_values(r)[index].lower()
+
+
+class ResultModel:
+    """In-memory list of ResultRecords with a sorted/filtered view over them.
+
+    The view is a list of references into the records, so sorting and filtering never copy row data and
+    the widget only ever asks for the slice it is showing.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.view = []
+        self.sort_column = None
+        self.sort_reverse = False
+        self.filter_text = ""
+
+    def __len__(self):
+        return len(self.view)
+
+    def clear(self):
+        """Drop all records and the sort order; the filter text is kept."""
+        self.records = []
+        self.view = []
+        self.sort_column = None
+        self.sort_reverse = False
+
+    def _matches(self, record):
+        text = self.filter_text
+        return (not text or text in (record.name or "").lower() or text in (record.target or "").lower()
+                or text == record.kind)
+
+    def extend(self, records):
+        """Append records; new rows join the view unless a sort is active, in which case it is rebuilt."""
+        self.records.extend(records)
+        if self.sort_column is not None:
+            self._rebuild()
+        else:
+            self.view.extend(r for r in records if self._matches(r))
+
+    def set_filter(self, text):
+        """Show records whose name or target contains `text` (case-insensitive) or whose kind equals it."""
+        self.filter_text = text.strip().lower()
+        self._rebuild()
+
+    def sort(self, column, reverse=None):
+        """Sort by a column; sorting the current column again flips the order unless `reverse` is given."""
+        if reverse is None:
+            reverse = not self.sort_reverse if column == self.sort_column else False
+        self.sort_column, self.sort_reverse = column, reverse
+        self._rebuild()
+
+    def _rebuild(self):
+        view = [r for r in self.records if self._matches(r)] if self.filter_text else list(self.records)
+        if self.sort_column is not None:
+            view.sort(key=_sort_key(self.sort_column), reverse=self.sort_reverse)
+        self.view = view
+
+    def rows(self, start, stop):
+        return self.view[start:stop]
+
+
+class ResultsView(ttk.Frame):
+    """Treeview that only holds the rows currently on screen.
+
+    The scrollbar is driven by the model's length rather than the Treeview's items, so showing 500k results
+    costs the same as showing one page.
+    """
+
+    def __init__(self, master, model=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.model = model or ResultModel()
+        self.offset = 0
+        self.page_size = 20
+        self.tree = ttk.Treeview(self, columns=COLUMNS, show="headings", height=self.page_size)
+        for column in COLUMNS:
+            self.tree.heading(column, text=COLUMN_TITLES[column], command=lambda c=column: self.sort(c))
+            self.tree.column(column, width=COLUMN_WIDTHS[column], stretch=True)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.bind("<Configure>", self._on_resize)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree.bind(sequence, self._on_wheel)
+
+    def clear(self):
+        self.model.clear()
+        self.offset = 0
+        self.refresh()
+
+    def append(self, records):
+        self.model.extend(records)
+        self.refresh()
+
+    def sort(self, column):
+        self.model.sort(column)
+        self.refresh()
+
+    def set_filter(self, text):
+        self.model.set_filter(text)
+        self.offset = 0
+        self.refresh()
+
+    def scroll_to(self, offset):
+        self.offset = max(0, min(int(offset), len(self.model) - self.page_size))
+        self.refresh()
+
+    def refresh(self):
+        """Redraw the visible page and the scrollbar."""
+        total = len(self.model)
+        self.offset = max(0, min(self.offset, total - self.page_size))
+        self.tree.delete(*self.tree.get_children())
+        for record in self.model.rows(self.offset, self.offset + self.page_size):
+            self.tree.insert("", tk.END, values=record_values(record))
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + self.page_size) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(float(amount) * len(self.model))
+        elif action == "scroll":
+            step = self.page_size if unit == "pages" else 1
+            self.scroll_to(self.offset + int(amount) * step)
+
+    def _on_wheel(self, event):
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self.scroll_to(self.offset - 3)
+        else:
+            self.scroll_to(self.offset + 3)
+        return "break"
+
+    def _on_resize(self, event):
+        row_height = ttk.Style().lookup("Treeview", "rowheight") or 20
+        page_size = max(1, (event.height - row_height) // int(row_height))
+        if page_size != self.page_size:
+            self.page_size = page_size
+            self.tree.configure(height=page_size)
+            self.refresh()
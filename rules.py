@@ -0,0 +1,97 @@
+import re
+from functools import lru_cache
+
+# Characters that end a pattern's leading literal run.
+_META = set(".^$*+?{}[]\\|()")
+_OPTIONAL_QUANTIFIERS = set("*?{")
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern, flags=re.IGNORECASE):
+    """Compile a regex once per process; raises re.error for invalid patterns."""
+    return re.compile(pattern, flags)
+
+
+def literal_prefix(pattern, flags=re.IGNORECASE):
+    """Return the lowercased literal text every match of `pattern` must start with, or None if unknown.
+
+    Only plain ASCII prefixes of patterns without alternation are used, so the check never rejects a
+    filename the regex could match.
+    """
+    if "|" in pattern or flags & re.VERBOSE:
+        return None
+    prefix = []
+    for ch in pattern:
+        if ch in _META:
+            break
+        prefix.append(ch)
+    # A quantifier such as `?` or `{0,2}` after the run makes its last character optional.
+    if len(prefix) < len(pattern) and pattern[len(prefix)] in _OPTIONAL_QUANTIFIERS:
+        prefix.pop()
+    text = "".join(prefix)
+    return text.lower() if text and text.isascii() else None
+
+
+class RenamePipeline:
+    """Rename rules compiled once from patterns, replacement and flags, reusable across folders.
+
+    Patterns always run one after another, and remove mode is replacement with "". They are not merged into
+    one alternation: removing one match can create or hide a match of another pattern, so the result would
+    differ from applying them in order.
+    """
+
+    def __init__(self, patterns, replacement="", remove_mode=False, flags=re.IGNORECASE):
+        self.patterns = list(patterns)
+        self.replacement = "" if remove_mode else replacement
+        self.remove_mode = remove_mode
+        self.flags = flags
+        self.invalid = []
+        compiled = []
+        for pattern in self.patterns:
+            try:
+                compiled.append(compile_pattern(pattern, flags))
+            except re.error:
+                self.invalid.append(pattern)
+        self.stages = []
+        if self.invalid:
+            return
+        for pattern, regex in zip(self.patterns, compiled):
+            prefix = literal_prefix(pattern, flags)
+            self.stages.append((regex, None if prefix is None else [prefix]))
+
+    @property
+    def valid(self):
+        return not self.invalid
+
+    def stage_key(self, index):
+        """Hashable identity of stage `index`, for caching its output across pipelines."""
+        regex, _ = self.stages[index]
+        return regex.pattern, regex.flags, self.replacement
+
+    def apply_stage(self, index, names):
+        """Apply only stage `index` to a list of names and return the new list."""
+        regex, literals = self.stages[index]
+        replacement = self.replacement
+        if literals is None:
+            return [regex.sub(replacement, name) for name in names]
+        result = []
+        for name in names:
+            if name.isascii():
+                lowered = name.lower()
+                if not any(lit in lowered for lit in literals):
+                    result.append(name)
+                    continue
+            result.append(regex.sub(replacement, name))
+        return result
+
+    def apply(self, name):
+        """Return `name` with every rule applied in order."""
+        replacement = self.replacement
+        for regex, literals in self.stages:
+            # Skip the regex when none of its required literals occur in the name.
+            if literals is not None and name.isascii():
+                lowered = name.lower()
+                if not any(lit in lowered for lit in literals):
+                    continue
+            name = regex.sub(replacement, name)
+        return name
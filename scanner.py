@@ -0,0 +1,113 @@
+import os
+import stat
+from collections import namedtuple
+from metrics import registry as metrics
+from file_table import FileTable
+
+# One record per directory entry, with the stat fields every operation needs read exactly once.
+# `birthtime` is None where the platform does not report creation time separately from ctime.
+FileEntry = namedtuple("FileEntry", ["name", "path", "rel_path", "is_dir", "size", "mtime", "ctime", "ino", "dev",
+                                     "birthtime"])
+
+BACKUP_DIR_PREFIX = "backup_"
+# Undo journal folder kept inside managed folders (see journal.py).
+JOURNAL_DIR = ".pfm"
+
+
+class FolderSnapshot:
+    """Immutable listing of a folder, shared by file operations so a folder is only scanned once."""
+
+    def __init__(self, folder_path, entries, recursive=False, names=None):
+        # `names` gives the folder's full listing when `entries` only covers some of its files (watch mode),
+        # so renames are still checked against every name in the folder.
+        self.folder_path = folder_path
+        self.entries = entries
+        self.recursive = recursive
+        self._names = set(names) if names is not None else None
+        self._table = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def files(self):
+        """Return regular-file entries only."""
+        return [e for e in self.entries if not e.is_dir]
+
+    def table(self):
+        """Columnar FileTable over the entries, built on first use and shared by later operations."""
+        if self._table is None:
+            self._table = FileTable(self.entries)
+        return self._table
+
+    def supported(self, extensions):
+        """FileTable of the files whose (lowercased) extension is in `extensions`."""
+        return self.table().select(extensions)
+
+    def supported_files(self, extensions):
+        """Return file entries whose (lowercased) extension is in `extensions`."""
+        return self.supported(extensions).entries()
+
+    def names(self):
+        """Return the set of relative paths in the snapshot (files and directories)."""
+        if self._names is None:
+            self._names = {e.rel_path for e in self.entries}
+        return self._names
+
+    def matches(self, folder_path):
+        """Check whether this snapshot was taken of `folder_path`."""
+        return os.path.normcase(os.path.abspath(folder_path)) == os.path.normcase(os.path.abspath(self.folder_path))
+
+
+def _scan_dir(root, folder_path, recursive, entries):
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            rel_path = os.path.relpath(entry.path, root) if folder_path != root else entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir:
+                    entries.append(FileEntry(entry.name, entry.path, rel_path, True, 0, 0.0, 0.0, 0, 0, None))
+                    # Never descend into our own backup or journal folders.
+                    if recursive and not entry.name.startswith(BACKUP_DIR_PREFIX) and entry.name != JOURNAL_DIR:
+                        _scan_dir(root, entry.path, recursive, entries)
+                    continue
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append(FileEntry(entry.name, entry.path, rel_path, False, st.st_size, st.st_mtime,
+                                     st.st_ctime, st.st_ino, st.st_dev, getattr(st, "st_birthtime", None)))
+
+
+def scan_folder(folder_path, recursive=False):
+    """Scan `folder_path` with os.scandir and return a FolderSnapshot. Subfolders are included when `recursive`."""
+    entries = []
+    with metrics.span("scan"):
+        _scan_dir(folder_path, folder_path, recursive, entries)
+    metrics.count("files_scanned", len(entries))
+    return FolderSnapshot(folder_path, entries, recursive)
+
+
+def stat_entries(folder_path, names):
+    """FileEntry records for the regular files `names` directly inside `folder_path`; missing ones are left out."""
+    entries = []
+    for name in names:
+        path = os.path.join(folder_path, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            entries.append(FileEntry(name, path, name, False, st.st_size, st.st_mtime, st.st_ctime, st.st_ino,
+                                     st.st_dev, getattr(st, "st_birthtime", None)))
+    return entries
+
+
+def get_snapshot(folder_path, snapshot=None, recursive=False):
+    """Reuse `snapshot` if it was taken of `folder_path`, otherwise scan the folder."""
+    if snapshot is not None and snapshot.matches(folder_path):
+        return snapshot
+    return scan_folder(folder_path, recursive)
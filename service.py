@@ -0,0 +1,567 @@
+import os
+import re
+import json
+import time
+import stat
+import socket
+import asyncio
+import argparse
+import logging
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from scanner import scan_folder
+from rules import RenamePipeline
+from plans import PlanWriter, plan_folders
+from sinks import ListSink, ResultRecord, error
+from utils import get_setting
+from cli import build_parser, check_args, run_command, _patterns
+
+# Local service: one process keeps folder snapshots, compiled rename rules and the file catalog warm and runs
+# the batch subcommands for any number of clients. The protocol is JSON-RPC 2.0 with one JSON object per line,
+# over a Unix socket readable only by its owner, or on systems without Unix sockets over localhost TCP with a
+# token read from a file only the owner can read.
+
+DEFAULT_WORKERS = 4
+DEFAULT_PORT = 47163
+# Folders whose snapshots are kept; the least recently used one is dropped first.
+DEFAULT_CACHE_SIZE = 64
+# Without inotify a snapshot is reused for this many seconds, as long as the folder's mtime is unchanged.
+DEFAULT_TTL = 5.0
+# Longest request line accepted from a client.
+MAX_REQUEST = 1024 * 1024
+
+# Methods that run a batch subcommand; params are {"folder": path, "options": {...}} (see `command_argv`).
+READ_COMMANDS = ("scan", "report", "dupes", "preview")
+WRITE_COMMANDS = ("rename", "organize", "backup", "undo", "redo", "apply")
+COMMANDS = READ_COMMANDS + WRITE_COMMANDS
+# Commands given a cached snapshot; the others list the folder again, as they are about to change it.
+SNAPSHOT_COMMANDS = READ_COMMANDS
+
+# JSON-RPC 2.0 error codes.
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+_TCP_ADDRESS = re.compile(r"^([\w.\-]+):(\d+)$")
+
+
+class ServiceError(Exception):
+    """An error response from the service."""
+
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+
+class _RequestParser(argparse.ArgumentParser):
+    """Parser that raises a ServiceError instead of printing to stderr and exiting, so a bad request never
+    touches the process's streams (which other requests running at the same time are using)."""
+
+    def error(self, message):
+        raise ServiceError(INVALID_PARAMS, f"{self.prog}: error: {message}")
+
+    def exit(self, status=0, message=None):
+        raise ServiceError(INVALID_PARAMS, message.strip() if message else "Invalid options")
+
+    def print_usage(self, file=None):
+        pass
+
+    def print_help(self, file=None):
+        pass
+
+
+def unix_sockets():
+    return os.name == "posix" and hasattr(socket, "AF_UNIX")
+
+
+def runtime_dir():
+    """$XDG_RUNTIME_DIR, else a `pfm-<uid>` folder in the temp folder that only this user can enter.
+
+    The temp folder is shared, so the folder is created with mode 0700, and one that is a symlink or belongs to
+    another user is refused rather than used.
+    """
+    uid = os.getuid()
+    xdg = os.environ.get("XDG_RUNTIME_DIR")
+    if xdg and os.path.isdir(xdg) and os.stat(xdg).st_uid == uid:
+        return xdg
+    path = os.path.join(tempfile.gettempdir(), f"pfm-{uid}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid:
+        raise PermissionError(f"{path} is not a folder owned by this user")
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+def default_address():
+    """The `service_address` setting, else `pfm.sock` in the user's runtime folder (localhost TCP on Windows)."""
+    address = get_setting("service_address")
+    if address:
+        return address
+    if unix_sockets():
+        return os.path.join(runtime_dir(), "pfm.sock")
+    return f"127.0.0.1:{DEFAULT_PORT}"
+
+
+def token_path(address):
+    port = _TCP_ADDRESS.match(address).group(2)
+    return os.path.join(tempfile.gettempdir(), f"pfm-{port}.token")
+
+
+def command_argv(method, folder_path, options):
+    """Argument list for cli.build_parser(): options become long flags, True a bare flag, lists a repeated
+    flag, and None, False or "" are left out. {"by": "name"} gives ["dupes", folder, "--by=name"]."""
+    argv = [method, folder_path]
+    for key, value in sorted((options or {}).items()):
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        elif value is None or value is False or value == "":
+            continue
+        else:
+            argv.extend(f"{flag}={v}" for v in (value if isinstance(value, list) else [value]))
+    return argv
+
+
+@lru_cache(maxsize=128)
+def compiled_pipeline(patterns, replacement, remove_mode):
+    """Rename rules compiled once per distinct (patterns, replacement, remove) and shared between requests."""
+    return RenamePipeline(list(patterns), replacement, remove_mode)
+
+
+class SnapshotCache:
+    """Folder snapshots kept between requests, least recently used first out.
+
+    A snapshot is reused while the folder's mtime is unchanged and, where inotify is available, until an
+    event arrives for the folder; elsewhere it also expires after `ttl` seconds, since changes to a file's
+    content or timestamps do not touch the folder's mtime. Thread-safe: requests run on a thread pool.
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_TTL, watcher=None):
+        self.size = size
+        self.ttl = ttl
+        self.watcher = watcher
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, folder_path):
+        """Return (snapshot, cached) for a folder, listing it again when the cached one may be stale."""
+        try:
+            mtime = os.stat(folder_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            item = self._items.get(folder_path)
+            if item is not None:
+                snapshot, cached_mtime, taken, live = item
+                if cached_mtime == mtime and (live or time.monotonic() - taken < self.ttl):
+                    self._items.move_to_end(folder_path)
+                    self.hits += 1
+                    return snapshot, True
+            self.misses += 1
+            generation = self._generations.get(folder_path, 0)
+        # Watch before listing, so nothing that happens during the scan is missed.
+        live = self._watch(folder_path)
+        snapshot = scan_folder(folder_path)
+        with self._lock:
+            # An invalidation during the scan means the listing may already be stale: use it, do not keep it.
+            if self._generations.get(folder_path, 0) == generation:
+                self._items[folder_path] = (snapshot, mtime, time.monotonic(), live)
+                self._items.move_to_end(folder_path)
+                while len(self._items) > self.size:
+                    evicted, _ = self._items.popitem(last=False)
+                    self._unwatch(evicted)
+        return snapshot, False
+
+    def invalidate(self, folder_path=None):
+        """Drop one folder's snapshot, or all of them."""
+        with self._lock:
+            folders = list(self._items) if folder_path is None else [folder_path]
+            for path in folders:
+                self._generations[path] = self._generations.get(path, 0) + 1
+                if self._items.pop(path, None) is not None:
+                    self._unwatch(path)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _watch(self, folder_path):
+        if self.watcher is None:
+            return False
+        try:
+            self.watcher.watch(folder_path)
+            return True
+        except OSError as e:
+            logging.warning("Cannot watch %s, its snapshot will expire after %ss: %s", folder_path, self.ttl, e)
+            return False
+
+    def _unwatch(self, folder_path):
+        if self.watcher is not None:
+            self.watcher.unwatch(folder_path)
+
+
+class FolderLock:
+    """Readers-writer lock for one folder: queries run side by side, a change waits for them and runs alone.
+    Waiting writers hold back new readers, so a steady stream of queries cannot starve them."""
+
+    def __init__(self):
+        self.users = 0
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting = 0
+
+    async def acquire(self, write):
+        async with self._condition:
+            if write:
+                self._waiting += 1
+                try:
+                    await self._condition.wait_for(lambda: not self._writing and not self._readers)
+                finally:
+                    self._waiting -= 1
+                self._writing = True
+            else:
+                await self._condition.wait_for(lambda: not self._writing and not self._waiting)
+                self._readers += 1
+
+    async def release(self, write):
+        async with self._condition:
+            if write:
+                self._writing = False
+            else:
+                self._readers -= 1
+            self._condition.notify_all()
+
+
+class Service:
+    """The service process. `run()` serves until a `shutdown` request or `stop()`; `ready` is set once it
+    is accepting connections."""
+
+    def __init__(self, address=None, workers=None, cache_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_TTL):
+        self.address = address or default_address()
+        self.workers = workers or DEFAULT_WORKERS
+        self.ready = threading.Event()
+        self.requests = 0
+        self._cache_size = cache_size
+        self._ttl = ttl
+        self._locks = {}
+        self._token = None
+        self._loop = None
+        self._stopping = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """Stop serving; callable from any thread."""
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError:
+                # The loop has already finished.
+                pass
+
+    async def serve(self):
+        from catalog import open_catalog
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pfm-service")
+        self._catalog = open_catalog()
+        self._inotify = self._open_inotify()
+        self.cache = SnapshotCache(self._cache_size, self._ttl, self._inotify)
+        self.started = time.monotonic()
+        server = await self._start_server()
+        logging.info("Service listening on %s with %s workers", self.address, self.workers)
+        self.ready.set()
+        try:
+            async with server:
+                await self._stopping.wait()
+        finally:
+            server.close()
+            if self._inotify is not None:
+                self._loop.remove_reader(self._inotify.fd)
+                self._inotify.close()
+            self._executor.shutdown(wait=True)
+            self._catalog.close()
+            self._remove_endpoint()
+            logging.info("Service on %s stopped", self.address)
+
+    def _open_inotify(self):
+        from watcher import InotifySource
+        try:
+            source = InotifySource([])
+        except OSError:
+            return None
+        self._loop.add_reader(source.fd, self._on_inotify)
+        return source
+
+    def _on_inotify(self):
+        for folder_path, _, _ in self._inotify.events(0):
+            self.cache.invalidate(folder_path)
+
+    async def _start_server(self):
+        match = _TCP_ADDRESS.match(self.address)
+        if match:
+            self._token = secrets.token_hex(16)
+            path = token_path(self.address)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self._token)
+            return await asyncio.start_server(self._handle, match.group(1), int(match.group(2)), limit=MAX_REQUEST)
+        if os.path.exists(self.address):
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(self.address)
+                raise OSError(f"A service is already listening on {self.address}")
+            except ConnectionRefusedError:
+                # Left behind by a service that did not shut down cleanly.
+                os.unlink(self.address)
+        # The socket file is created readable and writable by its owner only.
+        umask = os.umask(0o177)
+        try:
+            return await asyncio.start_unix_server(self._handle, self.address, limit=MAX_REQUEST)
+        finally:
+            os.umask(umask)
+
+    def _remove_endpoint(self):
+        try:
+            os.unlink(token_path(self.address) if self._token else self.address)
+        except OSError:
+            pass
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await self._send(writer, _error_response(None, INVALID_REQUEST, "Request too large"))
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    await self._send(writer, await self._respond(line))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, response):
+        writer.write(json.dumps(response).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def _respond(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return _error_response(None, PARSE_ERROR, f"Parse error: {e}")
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" or \
+                not isinstance(request.get("method"), str):
+            return _error_response(None, INVALID_REQUEST, "Invalid request")
+        request_id = request.get("id")
+        params = request.get("params") or {}
+        if not isinstance(params, dict):
+            return _error_response(request_id, INVALID_PARAMS, "params must be an object")
+        if self._token is not None and not secrets.compare_digest(str(params.get("token", "")), self._token):
+            return _error_response(request_id, INVALID_REQUEST, "Missing or wrong token")
+        self.requests += 1
+        try:
+            result = await self._dispatch(request["method"], params)
+        except ServiceError as e:
+            return _error_response(request_id, e.code, str(e), e.data)
+        except Exception as e:
+            logging.error("Error in service request %s: %s", request["method"], e)
+            return _error_response(request_id, INTERNAL_ERROR, str(e))
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+    async def _dispatch(self, method, params):
+        if method == "ping":
+            return "pong"
+        if method == "stats":
+            return {"uptime": round(time.monotonic() - self.started, 3), "requests": self.requests,
+                    "workers": self.workers, "folders": len(self.cache), "hits": self.cache.hits,
+                    "misses": self.cache.misses, "inotify": self._inotify is not None}
+        if method == "invalidate":
+            folder_path = params.get("folder")
+            self.cache.invalidate(os.path.abspath(folder_path) if folder_path else None)
+            return True
+        if method == "shutdown":
+            self._stopping.set()
+            return True
+        if method not in COMMANDS:
+            raise ServiceError(METHOD_NOT_FOUND, f"Method not found: {method}")
+        return await self._run_command(method, params)
+
+    async def _run_command(self, method, params):
+        folder_path = params.get("folder")
+        options = params.get("options") or {}
+        if not isinstance(folder_path, str) or not isinstance(options, dict):
+            raise ServiceError(INVALID_PARAMS, "params need a folder path and an options object")
+        folder_path = os.path.abspath(folder_path)
+        args = build_parser(_RequestParser).parse_args(command_argv(method, folder_path, options))
+        problem = check_args(args)
+        if problem:
+            raise ServiceError(INVALID_PARAMS, problem)
+        for key in ("dest", "plan", "repository"):
+            if getattr(args, key, None):
+                setattr(args, key, os.path.abspath(getattr(args, key)))
+        # Organize only writes its plan file with --plan; the folder is left as it is.
+        write = method in WRITE_COMMANDS and not (method == "organize" and args.plan)
+        loop = asyncio.get_running_loop()
+        if method == "apply":
+            try:
+                folders = await loop.run_in_executor(self._executor, plan_folders, folder_path)
+            except (OSError, ValueError) as e:
+                raise ServiceError(INVALID_PARAMS, f"Not a plan file: {folder_path} ({e})")
+        else:
+            folders = [folder_path] + ([args.dest] if getattr(args, "dest", None) else [])
+        async with self._locked(folders, write):
+            result = await loop.run_in_executor(self._executor, self._execute, args, folder_path)
+        if write:
+            for path in folders:
+                self.cache.invalidate(path)
+        return result
+
+    def _execute(self, args, folder_path):
+        """Run one command on the thread pool, the way batch_runner.run_folder does in a worker process."""
+        sink = ListSink()
+        started = time.perf_counter()
+        snapshot = cached = None
+        plan_writer = None
+        if args.command == "apply" or os.path.isdir(folder_path):
+            try:
+                if args.command in SNAPSHOT_COMMANDS:
+                    snapshot, cached = self.cache.get(folder_path)
+                pipeline = None
+                if getattr(args, "pattern", None):
+                    pipeline = compiled_pipeline(tuple(_patterns(args)), args.replace, args.remove)
+                if getattr(args, "plan", None):
+                    plan_writer = PlanWriter(args.plan)
+                run_command(args, folder_path, sink, catalog=self._catalog, plan_writer=plan_writer,
+                            snapshot=snapshot, pipeline=pipeline)
+            except Exception as e:
+                sink.emit(error(f"Error processing {folder_path}: {str(e)}\n"))
+                logging.error("Error in service command: %s", e)
+            finally:
+                if plan_writer is not None:
+                    plan_writer.close()
+        else:
+            sink.emit(error(f"Not a folder: {folder_path}\n"))
+        return {"records": [record._asdict() for record in sink.records], "errors": sink.errors,
+                "elapsed": round(time.perf_counter() - started, 6), "cached": bool(cached)}
+
+    @asynccontextmanager
+    async def _locked(self, folders, write):
+        # Taken in sorted order, so two requests locking the same folders cannot deadlock.
+        keys = sorted({os.path.normcase(os.path.realpath(f)) for f in folders})
+        locks = []
+        for key in keys:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = FolderLock()
+            lock.users += 1
+            locks.append((key, lock))
+        acquired = []
+        try:
+            for _, lock in locks:
+                await lock.acquire(write)
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                await lock.release(write)
+            for key, lock in locks:
+                lock.users -= 1
+                if not lock.users:
+                    del self._locks[key]
+
+
+def _error_response(request_id, code, message, data=None):
+    response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+    if data is not None:
+        response["error"]["data"] = data
+    return response
+
+
+class ServiceClient:
+    """Blocking client for a running service. Connection failures raise OSError; error responses raise
+    ServiceError. Commands return {"records": [ResultRecord...], "errors", "elapsed", "cached"}."""
+
+    def __init__(self, address=None, timeout=None):
+        self.address = address or default_address()
+        self.timeout = timeout
+        self._socket = None
+        self._file = None
+        self._token = None
+        self._next_id = 0
+
+    def connect(self):
+        if self._socket is not None:
+            return
+        match = _TCP_ADDRESS.match(self.address)
+        if match:
+            with open(token_path(self.address), "r") as f:
+                self._token = f.read().strip()
+            self._socket = socket.create_connection((match.group(1), int(match.group(2))), self.timeout)
+        else:
+            # Only talk to a socket this user created; another user's would receive our paths and commands.
+            if os.stat(self.address).st_uid != os.getuid():
+                raise PermissionError(f"{self.address} is not owned by this user")
+            self._socket = socket.socket(socket.AF_UNIX)
+            self._socket.settimeout(self.timeout)
+            try:
+                self._socket.connect(self.address)
+            except OSError:
+                self.close()
+                raise
+        self._file = self._socket.makefile("rwb")
+
+    def call(self, method, **params):
+        self.connect()
+        if self._token is not None:
+            params["token"] = self._token
+        self._next_id += 1
+        request = {"jsonrpc": "2.0", "id": self._next_id, "method": method, "params": params}
+        self._file.write(json.dumps(request).encode("utf-8") + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            self.close()
+            raise ConnectionResetError(f"The service at {self.address} closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            err = response["error"]
+            raise ServiceError(err["code"], err["message"], err.get("data"))
+        result = response["result"]
+        if isinstance(result, dict) and "records" in result:
+            result["records"] = [ResultRecord(**record) for record in result["records"]]
+        return result
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
@@ -0,0 +1,158 @@
+import sys
+import json
+from collections import namedtuple
+from duplicates import format_size
+from metadata import describe
+from metrics import registry as metrics
+
+# Structured result of a file operation. `kind` is one of: title, change, skip, duplicate, duplicate_group,
+# fuzzy_group, renamed, moved, undone, media, message, error. `detail` carries the reason for skips, the
+# metadata dict of media rows and the text of messages and errors.
+ResultRecord = namedtuple("ResultRecord", ["kind", "name", "target", "detail"], defaults=(None, None, None))
+
+DEFAULT_BATCH_SIZE = 256
+
+
+def message(text):
+    return ResultRecord("message", detail=text)
+
+
+def error(text):
+    return ResultRecord("error", detail=text)
+
+
+def format_record(record):
+    """Render a record as the human-readable line used by the console and the GUI."""
+    kind = record.kind
+    if kind in ("message", "error"):
+        return record.detail
+    if kind in ("title", "duplicate"):
+        return f"- {record.name}\n"
+    if kind == "duplicate_group":
+        info = record.detail
+        return (f"- {len(info['files'])} copies of {format_size(info['size'])} "
+                f"({format_size(info['reclaimable'])} reclaimable):\n" + "".join(f"    {p}\n" for p in info["files"]))
+    if kind == "fuzzy_group":
+        info = record.detail
+        return (f"- {len(info['files'])} files titled like \"{info['title']}\" (similarity {info['score']:.2f}):\n"
+                + "".join(f"    {p}\n" for p in info["files"]))
+    if kind == "change":
+        return f"{record.name} -> {record.target}\n"
+    if kind == "media":
+        return f"- {record.name} [{describe(record.detail)}]\n"
+    if kind == "skip":
+        return f"[SKIP] {record.name} -> {record.target} ({record.detail})\n"
+    if kind == "renamed":
+        return f"Renamed: {record.name} -> {record.target}\n"
+    if kind == "moved":
+        return f"Moved: {record.name} -> {record.target}\n"
+    if kind == "undone":
+        return f"Undid: {record.name} -> {record.target}\n"
+    return f"{kind}: {record.name}\n"
+
+
+class OutputSink:
+    """Destination for operation output. Writes are buffered and handed to `_write_batch` in batches."""
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._buffer = []
+        self.errors = 0
+
+    def _count(self, record):
+        """Count errors (see `errors`) and skips; every `emit` calls this first."""
+        if record.kind == "error":
+            self.errors += 1
+            metrics.count("errors")
+        elif record.kind == "skip":
+            metrics.count("skips")
+
+    def emit(self, record):
+        self._count(record)
+        self._buffer.append(self._render(record))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write(self, text):
+        """Emit free-form text as a message record."""
+        self.emit(message(text))
+
+    def flush(self):
+        if self._buffer:
+            chunks, self._buffer = self._buffer, []
+            self._write_batch(chunks)
+
+    def close(self):
+        self.flush()
+
+    def _render(self, record):
+        return format_record(record)
+
+    def _write_batch(self, chunks):
+        raise NotImplementedError
+
+
+class ConsoleSink(OutputSink):
+    def __init__(self, stream=None, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.stream = stream
+
+    def _write_batch(self, chunks):
+        # Resolved at write time so redirect_stdout and friends keep working.
+        stream = self.stream or sys.stdout
+        stream.write("".join(chunks))
+        stream.flush()
+
+
+class TextWidgetSink(OutputSink):
+    """Inserts into a Tk text widget with one insert call per batch."""
+
+    def __init__(self, text_widget, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.text_widget = text_widget
+
+    def _write_batch(self, chunks):
+        self.text_widget.insert('end', "".join(chunks))
+
+
+class JsonLinesSink(OutputSink):
+    """Writes one JSON object per record, for scripts and pipelines."""
+
+    def __init__(self, stream=None, batch_size=DEFAULT_BATCH_SIZE, **context):
+        super().__init__(batch_size)
+        self.stream = stream
+        self.context = context
+
+    def _render(self, record):
+        data = {k: v for k, v in record._asdict().items() if v is not None}
+        if record.kind in ("message", "error") and isinstance(record.detail, str):
+            data["detail"] = record.detail.strip()
+        data.update(self.context)
+        return json.dumps(data) + "\n"
+
+    def _write_batch(self, chunks):
+        stream = self.stream or sys.stdout
+        stream.write("".join(chunks))
+        stream.flush()
+
+
+class ListSink(OutputSink):
+    """Collects records in memory, mainly for tests and callers that post-process results."""
+
+    def __init__(self):
+        super().__init__(batch_size=1)
+        self.records = []
+
+    def emit(self, record):
+        self._count(record)
+        self.records.append(record)
+
+
+class NullSink(OutputSink):
+    def emit(self, record):
+        self._count(record)
+
+
+def make_sink(text_widget=None):
+    """Default sink for the classic `text_widget` argument: the widget if given, otherwise the console."""
+    return TextWidgetSink(text_widget) if text_widget is not None else ConsoleSink()
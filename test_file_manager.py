@@ -1,7 +1,40 @@
 import unittest
 import os
+import multiprocessing
 import shutil
-from file_ops import detect_duplicates, get_video_titles
+from file_ops import (media_report, detect_duplicates, detect_content_duplicates, detect_fuzzy_duplicates,
+                      get_video_titles, preview_changes, iter_preview_changes, replace_text_in_filenames,
+                      organize_by_timestamp, undo_last_action, redo_last_action, apply_plan_file, iter_renames,
+                      iter_undo, iter_organize)
+from journal import Journal
+from planner import plan_renames, execute_plan, RenameTransactionError, TARGET_EXISTS
+from scanner import scan_folder
+from file_table import FileTable
+from organizer import bucket_labels
+from catalog import FileCatalog
+from backup import run_backup, find_previous_backup
+from backup_repo import BackupRepository
+from rules import RenamePipeline, literal_prefix
+from sinks import JsonLinesSink, ListSink, ResultRecord
+from progress import ProgressReporter
+from worker import BackgroundTask
+from results_view import ResultModel
+from live_preview import LivePreview
+from cli import batch_main, EXIT_OK, EXIT_ERROR, EXIT_USAGE
+from benchmark import benchmark, compare
+from watcher import FolderWatcher, apply_rules
+from plans import PlanWriter, add_rename_plan
+from service import Service, ServiceClient, ServiceError, unix_sockets, runtime_dir, INVALID_PARAMS
+import batch_runner
+
+_run_folder = batch_runner.run_folder
+
+
+def _crash_in_worker(args, folder_path):
+    """Stand-in for batch_runner.run_folder that kills its worker process on folders named "crash"."""
+    if os.path.basename(folder_path) == "crash":
+        os._exit(1)
+    return _run_folder(args, folder_path)
 
 class TestFileManager(unittest.TestCase):
     def setUp(self):
@@ -32,5 +65,605 @@ class TestFileManager(unittest.TestCase):
         self.assertIn("test1", output)
         self.assertIn("test2", output)
 
+    def test_scan_folder_snapshot(self):
+        os.makedirs(os.path.join(self.test_dir, "sub"))
+        with open(os.path.join(self.test_dir, "sub", "test3.mkv"), "w") as f:
+            f.write("video")
+        snapshot = scan_folder(self.test_dir)
+        self.assertEqual(sorted(e.name for e in snapshot.files()), ["test1.mp4", "test1.pdf", "test2.mp4"])
+        self.assertEqual(snapshot.files()[0].size, 4)
+        recursive = scan_folder(self.test_dir, recursive=True)
+        self.assertIn(os.path.join("sub", "test3.mkv"), recursive.names())
+        # A snapshot passed in is reused instead of listing the folder again.
+        os.remove(os.path.join(self.test_dir, "test2.mp4"))
+        changes = preview_changes(self.test_dir, ["test"], "lesson", snapshot=snapshot)
+        self.assertIn(("test2.mp4", "lesson2.mp4"), changes)
+
+    def test_detect_content_duplicates(self):
+        payload = os.urandom(20000)
+        for name in ("lecture.mp4", "lecture (copy).mp4"):
+            with open(os.path.join(self.test_dir, name), "wb") as f:
+                f.write(payload)
+        # Same size and same head/tail, different middle: only a full hash tells them apart.
+        with open(os.path.join(self.test_dir, "other.mp4"), "wb") as f:
+            f.write(payload[:10000] + bytes(reversed(payload[10000:15000])) + payload[15000:])
+        groups = detect_content_duplicates(self.test_dir)
+        sizes = sorted(len(g.entries) for g in groups)
+        self.assertEqual(sizes, [2, 3])
+        big = [g for g in groups if g.size == 20000][0]
+        self.assertEqual(sorted(e.name for e in big.entries), ["lecture (copy).mp4", "lecture.mp4"])
+
+    def test_detect_fuzzy_duplicates(self):
+        for name in ("Lesson 5 - Intro.mp4", "Lesson 5 - Intro (1).mp4", "05 lesson intro [720p].mkv",
+                     "Lesson 6 - Intro.mp4", "Lesson 5 - Routing.mp4"):
+            open(os.path.join(self.test_dir, name), "w").close()
+        sink = ListSink()
+        groups = detect_fuzzy_duplicates(self.test_dir, sink=sink)
+        files = sorted(tuple(r.detail["files"]) for r in groups)
+        # Lesson 6 differs only in its number and Routing only in its words: neither joins the cluster.
+        self.assertEqual(files, [("05 lesson intro [720p].mkv", "Lesson 5 - Intro (1).mp4", "Lesson 5 - Intro.mp4"),
+                                 ("test1.mp4", "test1.pdf")])
+        self.assertEqual({r.detail["score"] for r in groups}, {1.0})
+        self.assertEqual(len([r for r in sink.records if r.kind == "fuzzy_group"]), 2)
+
+    def test_file_table_filters_and_groups(self):
+        for name, size in (("a.MP4", 5), ("b.pdf", 5), ("c.txt", 5), ("d.mkv", 7), (".hidden", 5)):
+            with open(os.path.join(self.test_dir, name), "wb") as f:
+                f.write(b"x" * size)
+        os.link(os.path.join(self.test_dir, "a.MP4"), os.path.join(self.test_dir, "a (link).mp4"))
+        snapshot = scan_folder(self.test_dir)
+        table = snapshot.supported({".mp4", ".pdf", ".mkv"})
+        # FileEntry records are rebuilt from the columns alone.
+        self.assertEqual(sorted(table.entries()),
+                         sorted(e for e in snapshot.files() if e.name not in ("c.txt", ".hidden")))
+        self.assertEqual(sorted(table.names()), ["a (link).mp4", "a.MP4", "b.pdf", "d.mkv", "test1.mp4", "test1.pdf",
+                                                 "test2.mp4"])
+        self.assertIn(("a", ".MP4"), table.split_names())
+        # The hard link counts once, so the 5-byte group is one of the two names plus b.pdf.
+        groups = sorted(sorted(e.name for e in g) for g in table.distinct_inodes().size_groups())
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(groups[0][1:], ["b.pdf"])
+        self.assertIn(groups[0][0], ("a (link).mp4", "a.MP4"))
+        self.assertEqual(groups[1], ["test1.mp4", "test1.pdf", "test2.mp4"])
+        # Noon UTC on 2024-03-15 is that date in every time zone.
+        for name in table.names():
+            os.utime(os.path.join(self.test_dir, name), (1710504000, 1710504000))
+        table = scan_folder(self.test_dir).supported({".mp4", ".pdf", ".mkv"})
+        self.assertEqual(set(bucket_labels(table, "mtime:day")), {"2024-03-15"})
+        self.assertEqual(set(bucket_labels(table, "mtime:month")), {"2024-03"})
+        self.assertEqual(dict(zip(table.names(), bucket_labels(table, "extension"))),
+                         {"a (link).mp4": "mp4", "a.MP4": "mp4", "b.pdf": "pdf", "d.mkv": "mkv", "test1.mp4": "mp4",
+                          "test1.pdf": "pdf", "test2.mp4": "mp4"})
+        self.assertEqual(len(FileTable([]).select({".mp4"})), 0)
+
+    def test_catalog_incremental_sync(self):
+        with open(os.path.join(self.test_dir, "a.mp4"), "wb") as f:
+            f.write(b"x" * 10000)
+        with open(os.path.join(self.test_dir, "b.mp4"), "wb") as f:
+            f.write(b"x" * 10000)
+        with FileCatalog(os.path.join(self.test_dir, "catalog.db")) as catalog:
+            snapshot = scan_folder(self.test_dir)
+            self.assertEqual(len(catalog.sync(snapshot)), len(snapshot.files()))
+            detect_content_duplicates(self.test_dir, snapshot=snapshot, catalog=catalog)
+            rows = catalog.lookup(snapshot.files())
+            self.assertTrue(rows[os.path.abspath(os.path.join(self.test_dir, "a.mp4"))]["full_hash"])
+            # Only new or modified files are reported on a rescan.
+            with open(os.path.join(self.test_dir, "b.mp4"), "ab") as f:
+                f.write(b"y")
+            changed = catalog.sync(scan_folder(self.test_dir))
+            self.assertEqual([e.name for e in changed if e.name.endswith(".mp4")], ["b.mp4"])
+
+    def test_incremental_backup(self):
+        files = scan_folder(self.test_dir).files()
+        first = os.path.join(self.test_dir, "backup_20250101_000000")
+        os.makedirs(first)
+        self.assertEqual(run_backup(files, first)["copied"], 3)
+        with open(os.path.join(self.test_dir, "test2.mp4"), "a") as f:
+            f.write("changed")
+        second = os.path.join(self.test_dir, "backup_20250102_000000")
+        os.makedirs(second)
+        previous = find_previous_backup(self.test_dir, exclude=second)
+        self.assertEqual(previous[0], first)
+        stats = run_backup(scan_folder(self.test_dir).files(), second, "hardlink", previous)
+        self.assertEqual((stats["copied"], stats["linked"]), (1, 2))
+        with open(os.path.join(second, "test2.mp4")) as f:
+            self.assertEqual(f.read(), "testchanged")
+
+    def test_backup_repository_dedup_prune_restore(self):
+        repo = BackupRepository(os.path.join("test_repo"))
+        self.addCleanup(shutil.rmtree, "test_repo", True)
+        first, stats = repo.backup(scan_folder(self.test_dir))
+        # The three files share identical content, so one object is stored.
+        self.assertEqual((stats["files"], stats["new_objects"]), (3, 1))
+        second, stats = repo.backup(scan_folder(self.test_dir))
+        self.assertEqual(stats["new_objects"], 0)
+        self.assertEqual(repo.prune(keep_last=1), [first])
+        self.assertEqual(repo.gc()[0], 0)
+        restore_dir = os.path.join(self.test_dir, "restored")
+        self.assertEqual(repo.restore(second, restore_dir, path="test2.mp4"), 1)
+        self.assertEqual(os.listdir(restore_dir), ["test2.mp4"])
+        # A failed copy does not mark its digest as stored: the next file with that content writes the object.
+        with self.assertRaises(OSError):
+            repo._store_object(os.path.join(self.test_dir, "missing.mp4"), "ab" * 32)
+        self.assertEqual(repo._store_object(os.path.join(self.test_dir, "test1.mp4"), "ab" * 32), 4)
+        self.assertTrue(os.path.exists(repo.object_path("ab" * 32)))
+
+    def test_rename_pipeline(self):
+        self.assertEqual(literal_prefix("part[0-9]+"), "part")
+        self.assertEqual(literal_prefix("lessons?"), "lesson")
+        self.assertIsNone(literal_prefix("intro|outro"))
+        remove = RenamePipeline(["part[0-9]+", " ?- ?Copy", "zzz?"], remove_mode=True)
+        self.assertEqual(remove.apply("Intro Part12 - copy"), "Intro ")
+        # Removing matches must give the same names as replacing them with "" pattern by pattern.
+        for patterns, name in ((["b", "ab"], "ab"), (["x", "ab"], "axb")):
+            self.assertEqual(RenamePipeline(patterns, remove_mode=True).apply(name),
+                             RenamePipeline(patterns, "").apply(name))
+        self.assertEqual(RenamePipeline(["x", "ab"], remove_mode=True).apply("axb"), "")
+        replace = RenamePipeline([r"(\d+)_", "lesson"], "L")
+        self.assertEqual(replace.apply("02_Lesson intro"), "LL intro")
+        self.assertEqual(RenamePipeline(["[bad"]).invalid, ["[bad"])
+
+    def test_mutating_operations_stream_records(self):
+        changes = preview_changes(self.test_dir, ["test"], "lesson", sink=ListSink())
+        records = list(iter_renames(self.test_dir, ["test"], "lesson", changes))
+        self.assertEqual(sorted(r.target for r in records if r.kind == "renamed"),
+                         ["lesson1.mp4", "lesson1.pdf", "lesson2.mp4"])
+        self.assertEqual(len([r for r in iter_undo(self.test_dir) if r.kind == "undone"]), 3)
+        organize = iter_organize(self.test_dir, bucket_key="extension")
+        self.assertEqual(sorted(r.target for r in organize if r.kind == "moved"), ["mp4", "mp4", "pdf"])
+
+    def test_streaming_preview_and_sinks(self):
+        records = list(iter_preview_changes(self.test_dir, RenamePipeline(["test"], "lesson")))
+        self.assertEqual(sorted((r.kind, r.name, r.target) for r in records),
+                         [("change", "test1.mp4", "lesson1.mp4"), ("change", "test1.pdf", "lesson1.pdf"),
+                          ("change", "test2.mp4", "lesson2.mp4")])
+        import io
+        import json
+        stream = io.StringIO()
+        sink = JsonLinesSink(stream, folder="x")
+        self.assertFalse(detect_duplicates(self.test_dir, sink=sink))
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertIn({"kind": "duplicate", "name": "test1", "folder": "x"}, lines)
+        sink = ListSink()
+        get_video_titles(self.test_dir, sink=sink)
+        self.assertEqual([r.name for r in sink.records if r.kind == "title"], ["test1", "test2"])
+
+    def _write_files(self, contents):
+        for name, text in contents.items():
+            with open(os.path.join(self.test_dir, name), "w") as f:
+                f.write(text)
+
+    def _read_files(self):
+        result = {}
+        for name in os.listdir(self.test_dir):
+            if os.path.isdir(os.path.join(self.test_dir, name)):
+                continue
+            with open(os.path.join(self.test_dir, name)) as f:
+                result[name] = f.read()
+        return result
+
+    def test_rename_planner_chains_and_swaps(self):
+        for name in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, name))
+        self._write_files({"02.mp4": "two", "03.mp4": "three", "a.mp4": "a", "b.mp4": "b", "keep.mp4": "k"})
+        changes = [("02.mp4", "03.mp4"), ("03.mp4", "04.mp4"), ("a.mp4", "b.mp4"), ("b.mp4", "a.mp4"),
+                   ("x.mp4", "keep.mp4")]
+        plan = plan_renames(changes, os.listdir(self.test_dir) + ["x.mp4"])
+        self.assertEqual([s.src for s in plan.skipped], ["x.mp4"])
+        changes.pop()
+        replace_text_in_filenames(self.test_dir, [], "", changes)
+        self.assertEqual(self._read_files(), {"03.mp4": "two", "04.mp4": "three", "a.mp4": "b", "b.mp4": "a",
+                                              "keep.mp4": "k"})
+
+    def test_rename_plan_rolls_back_on_failure(self):
+        plan = plan_renames([("test1.mp4", "one.mp4"), ("test2.mp4", "two.mp4")], os.listdir(self.test_dir))
+        # Simulate another process taking the second target after planning.
+        self._write_files({"two.mp4": "intruder"})
+        with self.assertRaises(RenameTransactionError):
+            execute_plan(self.test_dir, plan)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["test1.mp4", "test1.pdf", "test2.mp4", "two.mp4"])
+
+    def test_journal_multi_level_undo_redo(self):
+        replace_text_in_filenames(self.test_dir, [], "", [("test1.mp4", "one.mp4")])
+        organize_by_timestamp(self.test_dir)
+        self.assertEqual(len(Journal(self.test_dir).undo_stack()), 2)
+        undo_last_action(self.test_dir)
+        self.assertEqual(sorted(self._read_files()), ["one.mp4", "test1.pdf", "test2.mp4"])
+        undo_last_action(self.test_dir)
+        self.assertEqual(sorted(self._read_files()), ["test1.mp4", "test1.pdf", "test2.mp4"])
+        redo_last_action(self.test_dir)
+        self.assertEqual(sorted(self._read_files()), ["one.mp4", "test1.pdf", "test2.mp4"])
+
+    def test_journal_undo_after_crash(self):
+        journal = Journal(self.test_dir)
+        op = journal.begin("rename")
+        src = os.path.abspath(os.path.join(self.test_dir, "test1.mp4"))
+        op.record(src, src + ".renamed")
+        os.rename(src, src + ".renamed")
+        # The second move was logged but the process died before making it.
+        op.record(src.replace("test1", "test2"), src + ".never")
+        op.sync()
+        self.assertEqual(journal.undo_stack()[-1]["status"], "interrupted")
+        op = journal.undo()
+        self.assertEqual((op["moved"], op["missing"]), (1, 1))
+        self.assertTrue(os.path.exists(src))
+
+    def test_organize_by_pluggable_keys(self):
+        organize_by_timestamp(self.test_dir, bucket_key="extension")
+        self.assertEqual(sorted(os.listdir(os.path.join(self.test_dir, "mp4"))), ["test1.mp4", "test2.mp4"])
+        self.assertEqual(os.listdir(os.path.join(self.test_dir, "pdf")), ["test1.pdf"])
+        undo_last_action(self.test_dir)
+        os.utime(os.path.join(self.test_dir, "test1.mp4"), (0, 1700000000))
+        dest = os.path.join(self.test_dir, "sorted")
+        organize_by_timestamp(self.test_dir, bucket_key="mtime:year", dest_root=dest)
+        import time
+        year = time.strftime("%Y", time.localtime(1700000000))
+        self.assertEqual(os.listdir(os.path.join(dest, year)), ["test1.mp4"])
+
+    def test_progress_reporter_coalesces_events(self):
+        events = []
+        reporter = ProgressReporter(events.append, min_interval=3600)
+        reporter.start("hash", 1000, total_bytes=4000)
+        for _ in range(1000):
+            reporter.advance(1, 4)
+        # One event at the start, one per 1% step, and the last one at 100%.
+        self.assertEqual(len(events), 101)
+        self.assertEqual((events[-1].phase, events[-1].done, events[-1].percent), ("hash", 1000, 100.0))
+        events.clear()
+        get_video_titles(self.test_dir, progress_callback=events.append, sink=ListSink())
+        self.assertEqual(events[-1].percent, 100.0)
+
+    def test_cancel_stops_at_file_boundary(self):
+        import threading
+        cancel = threading.Event()
+
+        def cancel_after_first(event):
+            if event.done == 1:
+                cancel.set()
+        organize_by_timestamp(self.test_dir, bucket_key="extension", sink=ListSink(),
+                              progress_callback=ProgressReporter(cancel_after_first, cancel_event=cancel))
+        self.assertEqual(Journal(self.test_dir).undo_stack()[-1]["status"], "cancelled")
+        undo_last_action(self.test_dir, sink=ListSink())
+        self.assertEqual(sorted(self._read_files()), ["test1.mp4", "test1.pdf", "test2.mp4"])
+        # A cancelled rename transaction is rolled back and never offered for undo.
+        cancel.clear()
+        replace_text_in_filenames(self.test_dir, ["test"], "lesson", preview_changes(self.test_dir, ["test"], "lesson",
+                                  sink=ListSink()), sink=ListSink(),
+                                  progress_callback=ProgressReporter(cancel_after_first, cancel_event=cancel))
+        self.assertEqual(sorted(self._read_files()), ["test1.mp4", "test1.pdf", "test2.mp4"])
+        self.assertEqual(Journal(self.test_dir).undo_stack(), [])
+
+    def test_background_task_pumps_results(self):
+        class FakeWidget:
+            def __init__(self):
+                self.pending = []
+
+            def after(self, ms, func):
+                self.pending.append(func)
+
+        widget, output, results = FakeWidget(), [], []
+        task = BackgroundTask(widget, on_output=output.append)
+        task.submit(lambda: get_video_titles(self.test_dir, sink=task.sink, progress_callback=task.progress),
+                    lambda _: task.submit(lambda: 42, results.append))
+        while widget.pending:
+            task.join()
+            widget.pending.pop(0)()
+        self.assertEqual(results, [42])
+        self.assertIn(ResultRecord("title", "test2"), [r for batch in output for r in batch])
+        self.assertFalse(task.busy)
+
+    def test_result_model_sort_filter_and_paging(self):
+        model = ResultModel()
+        model.extend([ResultRecord("change", f"part{i:05d}.mp4", f"lesson{i:05d}.mp4") for i in range(50000)])
+        model.extend([ResultRecord("skip", "intro.mp4", "intro.mp4", "Target exists")])
+        self.assertEqual(len(model), 50001)
+        model.sort("name", reverse=True)
+        self.assertEqual(model.rows(0, 2)[0].name, "part49999.mp4")
+        model.set_filter("skip")
+        self.assertEqual([r.name for r in model.rows(0, 10)], ["intro.mp4"])
+        model.set_filter("LESSON0001")
+        self.assertEqual(len(model), 10)
+        self.assertEqual(model.rows(0, 1)[0].name, "part00019.mp4")
+
+    def test_live_preview_reuses_unchanged_stages(self):
+        live = LivePreview(self.test_dir)
+        records = live.preview(["test", "1"], "x")
+        expected = preview_changes(self.test_dir, ["test", "1"], "x", sink=ListSink())
+        self.assertEqual([(r.name, r.target) for r in records if r.kind == "change"], expected)
+        first_stage = live._chain[0][1]
+        # Editing the last pattern keeps the first stage's output and only re-runs the second stage.
+        records = live.preview(["test", "2"], "x")
+        self.assertIs(live._chain[0][1], first_stage)
+        self.assertIn(("test2.mp4", "xx.mp4"), [(r.name, r.target) for r in records])
+        self.assertIsNone(live.preview(["[bad"], "x"))
+
+    def test_batch_cli_subcommands(self):
+        import io
+        import json
+        from contextlib import redirect_stdout, redirect_stderr
+        out = io.StringIO()
+        with redirect_stdout(out):
+            status = batch_main(["rename", "-p", "test", "-r", "lesson"], stdin=io.StringIO(self.test_dir + "\n"))
+        self.assertEqual(status, EXIT_OK)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertIn({"kind": "renamed", "name": "test2.mp4", "target": "lesson2.mp4", "command": "rename",
+                       "folder": self.test_dir}, records)
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(batch_main(["undo", self.test_dir]), EXIT_OK)
+            self.assertEqual(batch_main(["scan", self.test_dir, os.path.join(self.test_dir, "missing")]), EXIT_ERROR)
+        self.assertIn("test2.mp4", os.listdir(self.test_dir))
+        with redirect_stderr(io.StringIO()):
+            self.assertEqual(batch_main(["preview", "-p", "[bad", self.test_dir]), EXIT_USAGE)
+            self.assertEqual(batch_main(["nonsense"]), EXIT_USAGE)
+
+    def test_batch_runs_subfolders_in_parallel(self):
+        import io
+        import json
+        from contextlib import redirect_stdout
+        for course in ("1-Basics", "2-ORM", "backup_20240101_000000"):
+            os.makedirs(os.path.join(self.test_dir, course))
+            for name in ("part1 intro.mp4", "part2 models.mp4"):
+                with open(os.path.join(self.test_dir, course, name), "w") as f:
+                    f.write(course)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            status = batch_main(["--jobs", "2", "--subfolders", "rename", "-p", r"part\d+\s", "--remove",
+                                 self.test_dir])
+        self.assertEqual(status, EXIT_OK)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        renamed = [r for r in records if r["kind"] == "renamed"]
+        self.assertEqual(len(renamed), 4)
+        self.assertTrue(all(r["operation"] for r in renamed))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.test_dir, "2-ORM"))), [".pfm", "intro.mp4", "models.mp4"])
+        # Backup folders are never treated as course folders.
+        self.assertIn("part1 intro.mp4", os.listdir(os.path.join(self.test_dir, "backup_20240101_000000")))
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == "fork", "workers must inherit the patched runner")
+    def test_batch_survives_a_crashed_worker(self):
+        from unittest import mock
+        from cli import build_parser
+        folders = [os.path.join(self.test_dir, name) for name in ("a", "crash", "b")]
+        for folder_path in folders:
+            os.makedirs(folder_path)
+        with mock.patch.object(batch_runner, "run_folder", _crash_in_worker):
+            results = list(batch_runner.run_batch(build_parser().parse_args(["scan"]), folders, max_workers=1))
+        self.assertEqual({os.path.basename(r.folder): r.errors for r in results}, {"a": 0, "crash": 1, "b": 0})
+
+    def test_benchmark_report(self):
+        report = benchmark(files=60, root=os.path.join(self.test_dir, "lib"), files_per_folder=30)
+        self.assertEqual([r["op"] for r in report["results"]],
+                         ["scan", "dupes_cold", "dupes_warm", "preview", "rename", "undo_rename", "organize",
+                          "undo_organize", "backup"])
+        self.assertEqual(report["meta"]["folders"], 2)
+        rename = report["results"][4]
+        self.assertEqual(rename["files"], 60)
+        self.assertGreater(rename["syscalls"]["rename"], 0)
+        slower = {"results": [dict(r, seconds=r["seconds"] * 2 + 1) for r in report["results"]]}
+        self.assertIn("scan", [op for op, _, _ in compare(report, slower)])
+        self.assertEqual(compare(report, report), [])
+
+    def test_metrics_export(self):
+        import io
+        import json
+        from contextlib import redirect_stdout
+        from metrics import registry
+        json_path = os.path.join(self.test_dir, "metrics.json")
+        prom_path = os.path.join(self.test_dir, "metrics.prom")
+        registry.reset()
+        try:
+            with redirect_stdout(io.StringIO()):
+                status = batch_main(["--metrics-json", json_path, "--metrics-prom", prom_path,
+                                     "rename", "-p", "test", "-r", "lesson", self.test_dir])
+        finally:
+            registry.enabled = False
+        self.assertEqual(status, EXIT_OK)
+        with open(json_path) as f:
+            summary = json.load(f)
+        self.assertEqual(summary["counters"]["renames"], 3)
+        self.assertIn("replace_text_in_filenames/rename", summary["spans"])
+        self.assertEqual(summary["histograms"]["operation_seconds[operation=preview_changes]"]["count"], 1)
+        with open(prom_path) as f:
+            prom = f.read()
+        self.assertIn("pfm_renames_total 3", prom)
+        self.assertIn('pfm_operation_seconds_bucket{operation="preview_changes",le="+Inf"} 1', prom)
+        # Disabled metrics record nothing.
+        registry.reset()
+        get_video_titles(self.test_dir, sink=ListSink())
+        self.assertEqual(registry.raw()["counters"], {})
+
+    def test_log_summary_batches_file_events(self):
+        import logging
+        from utils import SummaryHandler
+        lines = []
+
+        class Collect(logging.Handler):
+            def emit(self, record):
+                lines.append(record.getMessage())
+
+        handler = SummaryHandler(Collect(), batch_size=3)
+        logger = logging.getLogger("pfm.test.summary")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for i in range(4):
+                logger.warning("Renamed: %s -> %s", f"a{i}", f"b{i}", extra={"file_event": "renamed"})
+            logger.warning("Saved undo journal")
+            logger.warning("Renamed: %s -> %s", "c", "d", extra={"file_event": "renamed"})
+            handler.close()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(lines, ["Renamed 3 files (first: Renamed: a0 -> b0; last: Renamed: a2 -> b2)",
+                                 "Renamed: a3 -> b3", "Saved undo journal", "Renamed: c -> d"])
+
+    def test_watch_applies_rules_to_new_files_only(self):
+        import time
+        sink = ListSink()
+        pipeline = RenamePipeline([r"\s*part\d"], "", remove_mode=True)
+        watcher = FolderWatcher([self.test_dir], lambda folder, names, listing: apply_rules(
+            folder, names, listing, sink, pipeline), settle=0.2, interval=0.05, polling=True)
+        with open(os.path.join(self.test_dir, "test1 part1.mp4"), "w") as f:
+            f.write("growing")
+            watcher.step()
+            f.write(" still growing")
+            f.flush()
+            watcher.step()
+        deadline = time.time() + 2
+        while time.time() < deadline and not any(r.kind == "skip" for r in sink.records):
+            watcher.step()
+        # The new file collides with the existing test1.mp4, which is never touched.
+        self.assertIn(ResultRecord("skip", "test1 part1.mp4", "test1.mp4", TARGET_EXISTS), sink.records)
+        os.rename(os.path.join(self.test_dir, "test1 part1.mp4"), os.path.join(self.test_dir, "new part2.mp4"))
+        deadline = time.time() + 2
+        while time.time() < deadline and not any(r.kind == "renamed" for r in sink.records):
+            watcher.step()
+        self.assertEqual([r for r in sink.records if r.kind == "renamed"],
+                         [ResultRecord("renamed", "new part2.mp4", "new.mp4")])
+        for _ in range(5):
+            watcher.step()
+        # Our own rename is not picked up again as a new arrival.
+        self.assertEqual(watcher.pending[watcher.folders[0]], {})
+        self.assertEqual(Journal(self.test_dir).undo_stack()[-1]["action"], "rename")
+
+    def test_media_report_reads_container_headers(self):
+        import struct
+
+        def box(kind, payload):
+            return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+        def element(element_id, payload):
+            return element_id + bytes([0x80 | len(payload)]) + payload
+
+        def chunk(kind, payload):
+            return kind + struct.pack("<I", len(payload)) + payload
+
+        mp4 = box(b"ftyp", b"isom\0\0\0\0") + box(b"mdat", b"x" * 100) + box(b"moov", box(
+            b"mvhd", b"\0" * 12 + struct.pack(">II", 1000, 90500) + b"\0" * 80) + box(
+            b"trak", box(b"tkhd", b"\0" * 76 + struct.pack(">II", 1280 << 16, 720 << 16))))
+        info = element(b"\x15\x49\xa9\x66", element(b"\x2a\xd7\xb1", (1000000).to_bytes(3, "big")) +
+                       element(b"\x44\x89", struct.pack(">d", 61000.0)))
+        tracks = element(b"\x16\x54\xae\x6b", element(b"\xae", element(b"\xe0", element(
+            b"\xb0", (1920).to_bytes(2, "big")) + element(b"\xba", (1080).to_bytes(2, "big")))))
+        mkv = (element(b"\x1a\x45\xdf\xa3", b"\x42\x86\x81\x01") + b"\x18\x53\x80\x67\x01" + b"\xff" * 7 +
+               info + tracks + element(b"\x1f\x43\xb6\x75", b"\0" * 10))
+        hdrl = chunk(b"LIST", b"hdrl" + chunk(b"avih", struct.pack("<10I", 40000, 0, 0, 0, 250, 0, 1, 0, 640, 480)) +
+                     chunk(b"LIST", b"strl" + chunk(b"strh", b"vids" + b"\0" * 16 +
+                                                    struct.pack("<4I", 1, 25, 0, 300) + b"\0" * 20)))
+        avi = b"RIFF" + struct.pack("<I", 4 + len(hdrl)) + b"AVI " + hdrl
+        pdf = b"%PDF-1.4\n"
+        offsets = []
+        for obj in (b"<< /Type /Catalog /Pages 2 0 R >>", b"<< /Type /Pages /Kids [] /Count 42 >>"):
+            offsets.append(len(pdf))
+            pdf += b"%d 0 obj\n%s\nendobj\n" % (len(offsets), obj)
+        xref = len(pdf)
+        pdf += b"xref\n0 3\n0000000000 65535 f \n" + b"".join(b"%010d 00000 n \n" % o for o in offsets)
+        pdf += b"trailer\n<< /Size 3 /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % xref
+        for name, data in (("10 - outro.mp4", mp4), ("2 - intro.mkv", mkv), ("3 - setup.avi", avi),
+                           ("slides.pdf", pdf), ("test1.mp4", b"not a video")):
+            with open(os.path.join(self.test_dir, name), "wb") as f:
+                f.write(data)
+        sink = ListSink()
+        with FileCatalog(os.path.join(self.test_dir, "catalog.db")) as catalog:
+            totals = media_report(self.test_dir, catalog=catalog, sink=sink)
+            media = {r.name: r.detail for r in sink.records if r.kind == "media"}
+            self.assertEqual(media["10 - outro.mp4"], {"duration": 90.5, "width": 1280, "height": 720})
+            self.assertEqual(media["2 - intro.mkv"], {"duration": 61.0, "width": 1920, "height": 1080})
+            self.assertEqual(media["3 - setup.avi"], {"duration": 12.0, "width": 640, "height": 480})
+            self.assertEqual(media["slides.pdf"], {"pages": 42})
+            self.assertEqual(media["test1.mp4"], {})
+            names = [r.name for r in sink.records if r.kind == "media"]
+            self.assertLess(names.index("2 - intro.mkv"), names.index("10 - outro.mp4"))
+            self.assertEqual(totals, {"videos": 3, "duration": 163.5, "pdfs": 1, "pages": 42})
+            self.assertIn("\n Total: 3 videos, 2:44; 1 PDFs, 42 pages\n", [r.detail for r in sink.records])
+            cached = catalog.lookup(scan_folder(self.test_dir).files())
+            self.assertEqual(cached[os.path.abspath(os.path.join(self.test_dir, "slides.pdf"))]["meta"], {"pages": 42})
+
+    def test_plan_file_applied_later(self):
+        for name in ("a.mp4", "b.mp4"):
+            with open(os.path.join(self.test_dir, name), "w") as f:
+                f.write(name)
+        plan_path = os.path.join(self.test_dir, "swap.plan")
+        snapshot = scan_folder(self.test_dir)
+        with PlanWriter(plan_path) as writer:
+            preview_changes(self.test_dir, ["^test"], "lesson", snapshot=snapshot, sink=ListSink(), plan_writer=writer)
+            # A swap is a cycle, run through a temporary name.
+            swap = plan_renames([("a.mp4", "b.mp4"), ("b.mp4", "a.mp4")], snapshot.names())
+            add_rename_plan(writer, self.test_dir, swap, {e.rel_path: e for e in snapshot.files()})
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, "a.mp4")))
+        with open(os.path.join(self.test_dir, "test2.mp4"), "a") as f:
+            f.write("changed")
+        sink = ListSink()
+        results = apply_plan_file(plan_path, sink=sink)
+        self.assertEqual([(r["moved"], r["skipped"]) for r in results], [(2, 1), (2, 0)])
+        self.assertIn(("skip", "test2.mp4"), [(r.kind, r.name) for r in sink.records])
+        with open(os.path.join(self.test_dir, "a.mp4")) as f:
+            self.assertEqual(f.read(), "b.mp4")
+        self.assertEqual(sorted(n for n in os.listdir(self.test_dir) if n.endswith(".mp4")),
+                         ["a.mp4", "b.mp4", "lesson1.mp4", "test2.mp4"])
+        # Applying again finds every source moved or changed, and the applied plan can be undone.
+        self.assertEqual([r["moved"] for r in apply_plan_file(plan_path, sink=ListSink())], [0, 0])
+        undo_last_action(self.test_dir, sink=ListSink())
+        undo_last_action(self.test_dir, sink=ListSink())
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, "test1.mp4")))
+        with open(os.path.join(self.test_dir, "a.mp4")) as f:
+            self.assertEqual(f.read(), "a.mp4")
+
+        organize_plan = os.path.join(self.test_dir, "organize.plan")
+        self.assertEqual(batch_main(["--text", "organize", "--key", "extension", "--plan", organize_plan,
+                                     self.test_dir]), EXIT_OK)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, "mp4")))
+        self.assertEqual(batch_main(["--text", "apply", organize_plan]), EXIT_OK)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.test_dir, "mp4"))),
+                         ["a.mp4", "b.mp4", "test1.mp4", "test2.mp4"])
+        self.assertEqual(batch_main(["-j", "2", "organize", "--plan", organize_plan, self.test_dir]), EXIT_USAGE)
+
+    @unittest.skipUnless(unix_sockets(), "needs Unix sockets")
+    def test_service_keeps_snapshots_warm(self):
+        import threading
+        address = os.path.join(os.path.abspath(self.test_dir), "service.sock")
+        service = Service(address, workers=2)
+        thread = threading.Thread(target=service.run)
+        thread.start()
+        self.assertTrue(service.ready.wait(10))
+        try:
+            with ServiceClient(address, timeout=10) as client:
+                first = client.call("scan", folder=self.test_dir)
+                self.assertFalse(first["cached"])
+                self.assertTrue(client.call("scan", folder=self.test_dir)["cached"])
+                preview = client.call("preview", folder=self.test_dir, options={"pattern": ["test"], "replace": "a"})
+                self.assertTrue(preview["cached"])
+                self.assertIn(("test1.mp4", "a1.mp4"), [(r.name, r.target) for r in preview["records"]])
+                client.call("rename", folder=self.test_dir, options={"pattern": ["test"], "replace": "a"})
+                # The write dropped the snapshot, so the next query lists the folder again.
+                rescan = client.call("scan", folder=self.test_dir)
+                self.assertFalse(rescan["cached"])
+                self.assertIn("a1", [r.name for r in rescan["records"] if r.kind == "title"])
+                with self.assertRaises(ServiceError) as raised:
+                    client.call("dupes", folder=self.test_dir, options={"by": "size"})
+                self.assertEqual(raised.exception.code, INVALID_PARAMS)
+                self.assertEqual(client.call("stats")["hits"], 2)
+                from unittest import mock
+                with mock.patch("os.getuid", return_value=os.getuid() + 1):
+                    with self.assertRaises(PermissionError):
+                        ServiceClient(address).connect()
+                client.call("shutdown")
+        finally:
+            service.stop()
+            thread.join(10)
+        self.assertFalse(os.path.exists(address))
+
+    @unittest.skipUnless(unix_sockets(), "needs Unix sockets")
+    def test_service_runtime_dir_is_private(self):
+        from unittest import mock
+        with mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": ""}), mock.patch("tempfile.tempdir", self.test_dir):
+            path = runtime_dir()
+            self.assertEqual(path, os.path.join(self.test_dir, f"pfm-{os.getuid()}"))
+            os.chmod(path, 0o755)
+            self.assertEqual(runtime_dir(), path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+            os.rmdir(path)
+            os.symlink(self.test_dir, path)
+            with self.assertRaises(PermissionError):
+                runtime_dir()
+
 if __name__ == "__main__":
     unittest.main()
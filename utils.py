@@ -1,31 +1,185 @@
 import os
 import json
+import queue
+import atexit
 import logging
+import multiprocessing
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 CONFIG_FILE = "config.json"
+LOG_FILE = "file_manager.log"
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+# Per-file events collapsed into one summary line when summarizing is on.
+LOG_SUMMARY_BATCH = 1000
 
-def setup_logging():
-    logging.basicConfig(filename='file_manager.log', level=logging.INFO,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+_listener = None
 
-def load_config():
-    """Load last folder path from config file."""
+class SummaryHandler(logging.Handler):
+    """Collapses per-file records into summary records before passing them to `target`.
+
+    Per-file records are those logged with `extra={"file_event": kind}`. Every `batch_size` records of a kind
+    become one line with the count and the first and last file; other records flush the pending summaries
+    first, so the log keeps its order.
+    """
+
+    def __init__(self, target, batch_size=LOG_SUMMARY_BATCH):
+        super().__init__()
+        self.target = target
+        self.batch_size = batch_size
+        self._pending = {}
+
+    def emit(self, record):
+        kind = getattr(record, "file_event", None)
+        if kind is None:
+            self._flush_pending()
+            self.target.handle(record)
+            return
+        pending = self._pending.setdefault(kind, [0, record, record])
+        pending[0] += 1
+        pending[2] = record
+        if pending[0] >= self.batch_size:
+            self._emit_summary(kind)
+
+    def _emit_summary(self, kind):
+        count, first, last = self._pending.pop(kind)
+        if count == 1:
+            self.target.handle(first)
+            return
+        summary = logging.makeLogRecord(dict(last.__dict__, file_event=None, exc_info=None, exc_text=None,
+                                             msg="%s %d files (first: %s; last: %s)",
+                                             args=(kind.capitalize(), count, first.getMessage(), last.getMessage())))
+        self.target.handle(summary)
+
+    def _flush_pending(self):
+        for kind in list(self._pending):
+            self._emit_summary(kind)
+
+    def flush(self):
+        self._flush_pending()
+        self.target.flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._flush_pending()
+        finally:
+            self.release()
+        self.target.close()
+        super().close()
+
+class _LocalQueueHandler(QueueHandler):
+    # Records stay in this process, so they are queued as they are and the listener thread does the
+    # %-formatting instead of the thread that logged them.
+    def prepare(self, record):
+        return record
+
+class _RelayHandler(logging.Handler):
+    """Hands records received from worker processes to this process's own handlers."""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+def _log_level():
+    level = logging.getLevelName(str(get_setting("log_level", "INFO")).upper())
+    return level if isinstance(level, int) else logging.INFO
+
+def setup_logging(log_queue=None, summarize=None, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUPS):
+    """Route log records through a queue to a background thread that writes a rotating `file_manager.log`.
+
+    Logging calls only enqueue the record, and records below the `log_level` setting are never formatted.
+    `summarize` (default: the `log_summarize` setting) collapses per-file events into batched summary lines.
+    Pool workers pass the parent's `log_queue` (see worker_log_queue) so only one process writes the file.
+    """
+    global _listener
+    root = logging.getLogger()
+    level = _log_level()
+    if log_queue is not None:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(QueueHandler(log_queue))
+        root.setLevel(level)
+        return
+    if _listener is not None:
+        return
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if summarize is None:
+        summarize = get_setting("log_summarize", False)
+    if summarize:
+        handler = SummaryHandler(handler)
+    records = queue.SimpleQueue()
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    root.addHandler(_LocalQueueHandler(records))
+    root.setLevel(level)
+    atexit.register(_stop_listener, handler)
+
+def _stop_listener(handler):
+    # Drain the queue, then write out any pending summaries.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    handler.close()
+
+@contextmanager
+def worker_log_queue():
+    """A multiprocessing queue for pool workers' log records, relayed to this process's handlers while open."""
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(log_queue, _RelayHandler())
+    listener.start()
     try:
-        if os.path.exists(CONFIG_FILE):
+        yield log_queue
+    finally:
+        listener.stop()
+        log_queue.close()
+
+# (path, mtime, size) of the config file last read, and its settings; see load_settings.
+_settings_cache = (None, {})
+
+def load_settings():
+    """Load all settings from config file. The file is only read again once its mtime or size changes."""
+    global _settings_cache
+    try:
+        if not os.path.exists(CONFIG_FILE):
+            return {}
+        st = os.stat(CONFIG_FILE)
+        key = (os.path.abspath(CONFIG_FILE), st.st_mtime_ns, st.st_size)
+        if _settings_cache[0] != key:
             with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
-                return config.get("last_folder", "")
-        return ""
+                _settings_cache = (key, json.load(f))
+        return dict(_settings_cache[1])
     except Exception as e:
-        logging.error(f"Error loading config: {str(e)}")
-        return ""
+        logging.error("Error loading config: %s", e)
+        return {}
 
-def save_config(folder_path):
-    """Save folder path to config file."""
+def get_setting(key, default=None):
+    """Return a single setting from config file."""
+    return load_settings().get(key, default)
+
+def save_setting(key, value):
+    """Save a single setting to config file, keeping the others."""
+    global _settings_cache
     try:
-        config = {"last_folder": folder_path}
+        config = load_settings()
+        config[key] = value
         with open(CONFIG_FILE, "w") as f:
             json.dump(config, f)
-        logging.info(f"Saved config with folder: {folder_path}")
+        # The rewrite can land within the same mtime tick and keep the size, so it must not be trusted.
+        _settings_cache = (None, {})
+        return True
     except Exception as e:
-        logging.error(f"Error saving config: {str(e)}")
+        logging.error("Error saving config: %s", e)
+        return False
+
+def load_config():
+    """Load last folder path from config file."""
+    return get_setting("last_folder", "")
+
+def save_config(folder_path):
+    """Save folder path to config file."""
+    if save_setting("last_folder", folder_path):
+        logging.info("Saved config with folder: %s", folder_path)
@@ -0,0 +1,275 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+from scanner import FolderSnapshot, stat_entries, JOURNAL_DIR
+from file_ops import iter_preview_changes, replace_text_in_filenames, organize_by_timestamp
+
+# Seconds a new file's size and mtime must stay unchanged before rules are applied to it.
+DEFAULT_SETTLE = 2.0
+# Seconds between scans when polling, and the longest wait for events when nothing is pending.
+DEFAULT_POLL_INTERVAL = 1.0
+
+# inotify(7) event bits.
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifySource:
+    """Directory events from Linux inotify, via ctypes. Raises OSError where inotify is unavailable."""
+
+    def __init__(self, folders):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "libc has no inotify support")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._get_errno = ctypes.get_errno
+        self._folders = {}
+        # watch() and unwatch() may run on other threads than events() (see service.SnapshotCache).
+        self._lock = threading.Lock()
+        try:
+            for folder_path in folders:
+                self.watch(folder_path)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch(self, folder_path):
+        """Start reporting events for one more folder."""
+        with self._lock:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder_path), WATCH_MASK)
+            if wd < 0:
+                raise OSError(self._get_errno(), f"Cannot watch {folder_path}")
+            self._folders[wd] = folder_path
+
+    def unwatch(self, folder_path):
+        """Stop reporting events for a folder (a no-op if it is not watched)."""
+        with self._lock:
+            for wd in [wd for wd, path in self._folders.items() if path == folder_path]:
+                del self._folders[wd]
+                # Fails harmlessly when the kernel already dropped the watch (the folder was deleted).
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def events(self, timeout):
+        """Wait up to `timeout` seconds. Returns (folder, name, present) tuples, or (folder, None, None) when
+        events were lost and the folder must be listed again."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        with self._lock:
+            folders = dict(self._folders)
+        result = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                result.extend((folder_path, None, None) for folder_path in folders.values())
+                continue
+            folder_path = folders.get(wd)
+            # Directories are reported too: their names still block renames.
+            if folder_path is None or not name:
+                continue
+            result.append((folder_path, name, not mask & (IN_MOVED_FROM | IN_DELETE)))
+        return result
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingSource:
+    """Fallback event source that lists each folder every `interval` seconds and reports what differs."""
+
+    def __init__(self, folders, interval=DEFAULT_POLL_INTERVAL, stop_event=None):
+        self.interval = interval
+        self.stop_event = stop_event or threading.Event()
+        self._state = {folder_path: self._list(folder_path) for folder_path in folders}
+
+    @staticmethod
+    def _list(folder_path):
+        state = {}
+        try:
+            with os.scandir(folder_path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            state[entry.name] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.error("Error listing %s: %s", folder_path, e)
+        return state
+
+    def events(self, timeout):
+        self.stop_event.wait(min(timeout, self.interval))
+        result = []
+        for folder_path, before in self._state.items():
+            after = self._list(folder_path)
+            result.extend((folder_path, name, True) for name, info in after.items() if before.get(name) != info)
+            result.extend((folder_path, name, False) for name in before.keys() - after.keys())
+            self._state[folder_path] = after
+        return result
+
+    def close(self):
+        pass
+
+
+def open_event_source(folders, polling=False, interval=DEFAULT_POLL_INTERVAL, stop_event=None):
+    """inotify where it works, polling otherwise (or when `polling` is set)."""
+    if not polling:
+        try:
+            return InotifySource(folders)
+        except OSError as e:
+            logging.info("inotify unavailable, polling every %ss: %s", interval, e)
+    return PollingSource(folders, interval, stop_event)
+
+
+class FolderWatcher:
+    """Watch folders and hand each batch of newly arrived, settled files to `on_ready`.
+
+    `on_ready(folder_path, names, listing)` gets the settled names and the folder's current listing, and
+    returns the names it created in the folder (rename targets), which are not treated as new arrivals.
+    Files already present when watching starts are left alone.
+    """
+
+    def __init__(self, folders, on_ready, settle=DEFAULT_SETTLE, interval=DEFAULT_POLL_INTERVAL, polling=False):
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.on_ready = on_ready
+        self.settle = settle
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.listing = {f: self._listdir(f) for f in self.folders}
+        # name -> (size, mtime_ns, time the size or mtime last changed)
+        self.pending = {f: {} for f in self.folders}
+        self.produced = {f: set() for f in self.folders}
+        self.source = open_event_source(self.folders, polling, interval, self.stop_event)
+
+    @staticmethod
+    def _listdir(folder_path):
+        try:
+            return set(os.listdir(folder_path))
+        except OSError as e:
+            logging.error("Error listing %s: %s", folder_path, e)
+            return set()
+
+    def _on_event(self, folder_path, name, present):
+        if name is None:
+            # Events were dropped; anything unknown in a fresh listing counts as new.
+            current = self._listdir(folder_path)
+            for new_name in current - self.listing[folder_path]:
+                self._on_event(folder_path, new_name, True)
+            self.listing[folder_path] = current
+            return
+        if name == JOURNAL_DIR:
+            return
+        if not present:
+            self.listing[folder_path].discard(name)
+            self.pending[folder_path].pop(name, None)
+            return
+        self.listing[folder_path].add(name)
+        if name in self.produced[folder_path]:
+            self.produced[folder_path].discard(name)
+            return
+        self.pending[folder_path].setdefault(name, (None, None, time.monotonic()))
+
+    def _settled(self, folder_path):
+        """Names whose size and mtime have not changed for `settle` seconds. Only pending files are stat'ed."""
+        now = time.monotonic()
+        pending = self.pending[folder_path]
+        ready = []
+        for name, (size, mtime, since) in list(pending.items()):
+            try:
+                st = os.stat(os.path.join(folder_path, name))
+            except OSError:
+                del pending[name]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                pending[name] = (st.st_size, st.st_mtime_ns, now)
+            elif now - since >= self.settle:
+                ready.append(name)
+                del pending[name]
+        return ready
+
+    def step(self, timeout=None):
+        """Wait for events once and process every folder whose pending files have settled."""
+        if timeout is None:
+            busy = any(self.pending.values())
+            timeout = min(self.interval, self.settle / 2) if busy else self.interval
+        for folder_path, name, present in self.source.events(timeout):
+            self._on_event(folder_path, name, present)
+        for folder_path in self.folders:
+            if not self.pending[folder_path]:
+                continue
+            ready = self._settled(folder_path)
+            if ready:
+                try:
+                    produced = self.on_ready(folder_path, ready, self.listing[folder_path]) or ()
+                except Exception as e:
+                    logging.error("Error in watch handler for %s: %s", folder_path, e)
+                    continue
+                self.produced[folder_path].update(produced)
+
+    def run(self):
+        """Process events until `stop()` is called (or KeyboardInterrupt)."""
+        try:
+            while not self.stop_event.is_set():
+                self.step()
+        finally:
+            self.source.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def apply_rules(folder_path, names, listing, sink, pipeline=None, bucket_key=None, dest_root=None):
+    """Apply the rename pipeline and then organizing to the files `names` only. Returns the new names created.
+
+    Each step is a normal journaled operation, so every batch can be undone like a manual rename or organize.
+    """
+    entries = stat_entries(folder_path, names)
+    produced = set()
+    if pipeline is not None and entries:
+        snapshot = FolderSnapshot(folder_path, entries, names=listing)
+        changes = []
+        for record in iter_preview_changes(folder_path, pipeline, snapshot):
+            if record.kind == "change":
+                changes.append((record.name, record.target))
+            else:
+                sink.emit(record)
+        if changes:
+            replace_text_in_filenames(folder_path, pipeline.patterns, pipeline.replacement, changes, sink=sink,
+                                      snapshot=snapshot)
+            renamed = dict(changes)
+            produced = {name for name in renamed.values() if os.path.lexists(os.path.join(folder_path, name))}
+            names = [renamed[name] if renamed.get(name) in produced else name for name in names]
+            entries = stat_entries(folder_path, names)
+    if bucket_key is not None and entries:
+        organize_by_timestamp(folder_path, snapshot=FolderSnapshot(folder_path, entries, names=listing), sink=sink,
+                              bucket_key=bucket_key, dest_root=dest_root)
+    sink.flush()
+    # Names organized away again are gone, and must not hide a later file that arrives under the same name.
+    return {name for name in produced if os.path.lexists(os.path.join(folder_path, name))}
@@ -0,0 +1,117 @@
+import queue
+import logging
+import threading
+from sinks import OutputSink, DEFAULT_BATCH_SIZE
+from progress import ProgressReporter
+
+POLL_INTERVAL_MS = 50
+
+
+class QueueSink(OutputSink):
+    """Sink for worker threads: hands each batch of ResultRecords to a queue that the UI thread drains."""
+
+    def __init__(self, output_queue, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.queue = output_queue
+
+    def _render(self, record):
+        # Records stay structured so the UI can show them in a table.
+        return record
+
+    def _write_batch(self, records):
+        self.queue.put(("output", records))
+
+
+class BackgroundTask:
+    """Runs file operations one at a time on a worker thread on behalf of a Tk window.
+
+    Output (lists of ResultRecords, passed to `on_output`) and progress come back through a queue that the Tk
+    thread polls with `widget.after()`, so no widget is touched off the main thread. `cancel()` stops the
+    running operation at the next file boundary and drops the rest of the chain. Pass `sink` and `progress`
+    to the file_ops functions run here.
+    """
+
+    def __init__(self, widget, on_output, on_progress=None, on_idle=None):
+        self.widget = widget
+        self.on_output = on_output
+        self.on_progress = on_progress
+        self.on_idle = on_idle
+        self.queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.sink = QueueSink(self.queue)
+        self.progress = ProgressReporter(lambda event: self.queue.put(("progress", event)),
+                                         cancel_event=self.cancel_event)
+        self._thread = None
+        self._on_done = None
+
+    @property
+    def busy(self):
+        return self._thread is not None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def submit(self, func, on_done=None):
+        """Run `func()` on a worker thread, then `on_done(result)` on the Tk thread unless cancelled.
+
+        `on_done` may submit the next step of the same action; a new action clears an earlier cancel.
+        """
+        if self._on_done is None:
+            self.cancel_event.clear()
+        self._on_done = on_done or (lambda result: None)
+        self._thread = threading.Thread(target=self._run, args=(func,), daemon=True)
+        self._thread.start()
+        self.widget.after(POLL_INTERVAL_MS, self._poll)
+
+    def cancel(self):
+        if self.busy:
+            self.cancel_event.set()
+
+    def join(self, timeout=None):
+        """Wait for the worker thread, e.g. before closing the catalog on exit."""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self, func):
+        result = None
+        try:
+            result = func()
+        except Exception as e:
+            self.sink.write(f"Error: {str(e)}\n")
+            logging.error("Error in background task: %s", e)
+        finally:
+            self.sink.flush()
+            self.queue.put(("done", result))
+
+    def _poll(self):
+        latest = None
+        finished = False
+        result = None
+        records = []
+        try:
+            while not finished:
+                kind, payload = self.queue.get_nowait()
+                if kind == "output":
+                    records.extend(payload)
+                elif kind == "progress":
+                    latest = payload
+                else:
+                    finished, result = True, payload
+        except queue.Empty:
+            pass
+        # Everything that arrived since the last poll is drawn at once, and only the newest progress event.
+        if records:
+            self.on_output(records)
+        if latest is not None and self.on_progress:
+            self.on_progress(latest)
+        if not finished:
+            self.widget.after(POLL_INTERVAL_MS, self._poll)
+            return
+        self._thread = None
+        on_done, self._on_done = self._on_done, None
+        if not self.cancelled:
+            on_done(result)
+        if not self.busy and self.on_idle:
+            self.on_idle()